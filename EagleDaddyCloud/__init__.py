@@ -1,6 +1,8 @@
+import os
 from pathlib import Path
 
 import yaml
+from django.core.exceptions import ImproperlyConfigured
 
 
 class _dotdict(dict):
@@ -27,4 +29,12 @@ class YamlLoader:
     def load(path: Path):
         with open(path, 'r') as config:
             data = yaml.load(config, Loader=yaml.CLoader)
-        return _dotdict(data)
\ No newline at end of file
+        return _dotdict(data)
+
+
+def required_env(name, profile):
+    """value of environment variable `name`, which `profile` can't run without"""
+    value = os.getenv(name, '').strip()
+    if not value:
+        raise ImproperlyConfigured(f"{name} must be set in {profile}")
+    return value
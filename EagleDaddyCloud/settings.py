@@ -11,7 +11,6 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
 from pathlib import Path
-from django.contrib.auth import get_user_model
 
 from . import YamlLoader
 
@@ -52,10 +51,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'broker.routers.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'EagleDaddyCloud.urls'
 
+# serve the dashboard ajax views with their asyncio versions,
+# only enable when running under an ASGI server (see asgi.py)
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '0') == '1'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -84,10 +88,30 @@ DATABASES = {
         'USER': os.getenv("POSTGRES_USER"),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'HOST': os.getenv('DATABASE_HOST'),
-        'PORT': os.getenv('DATABASE_PORT')
+        'PORT': os.getenv('DATABASE_PORT'),
+        # seconds a connection is kept between requests/callbacks, 0 closes
+        # it every time, long running workers (mqtt manager) raise this
+        'CONN_MAX_AGE': int(os.getenv('DJANGO_CONN_MAX_AGE', 0)),
+        # pgbouncer in transaction pooling mode can't hold server side
+        # cursors open across transactions
+        'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DATABASE_PGBOUNCER', '0') == '1',
     }
 }
 
+# read replicas for dashboard reads, comma separated host[:port][/name],
+# the rest of the connection settings are the primary's.
+# see broker/routers.py
+for i, replica in enumerate(
+        filter(None, os.getenv('DATABASE_REPLICAS', '').split(','))):
+    address, _, name = replica.strip().partition('/')
+    host, _, port = address.partition(':')
+    DATABASES[f'replica_{i}'] = dict(DATABASES['default'],
+                                     HOST=host,
+                                     PORT=port or DATABASES['default']['PORT'],
+                                     NAME=name or DATABASES['default']['NAME'])
+
+DATABASE_ROUTERS = ['broker.routers.ReplicaRouter']
+
 GRAPH_MODELS = {
     'pygraphviz':
     False,
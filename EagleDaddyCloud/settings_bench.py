@@ -0,0 +1,21 @@
+"""
+Settings for the benchmark suite (`bin/bench-suite.py`).
+
+The development settings on an in-memory SQLite database, created by
+the suite on startup, so benchmarks run anywhere without PostgreSQL
+and every run starts from the same empty tables. Replicas and the
+router are dropped, DEBUG is off so timed queries aren't logged.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+DATABASE_ROUTERS = []
+
+DEBUG = False
+ASYNC_VIEWS = False
@@ -0,0 +1,43 @@
+"""
+Settings for the MQTT manager (`bin/mqtt-manager.py`).
+
+Builds on the development settings and keeps only the apps the
+manager's models need: `broker` and what its models reference
+(accounts and through them the auth user). The admin, sessions,
+templates and form apps of the web app are neither imported nor
+checked at startup, so startup time and memory of manager processes
+don't grow with the web app.
+
+Like the production settings DEBUG is off, which also keeps the
+long running manager from recording every query it makes, and
+DJANGO_SECRET_KEY must be set. The database credentials come from the
+environment (see settings.py).
+
+Select with DJANGO_SETTINGS_MODULE=EagleDaddyCloud.settings_manager,
+the manager defaults to it.
+"""
+
+from . import required_env
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+DEBUG = False
+
+# never the development key committed in settings.py
+SECRET_KEY = required_env('DJANGO_SECRET_KEY', 'the manager')
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'ClientAccount',
+    'broker',
+]
+
+MIDDLEWARE = []
+TEMPLATES = []
+ROOT_URLCONF = None
+AUTH_PASSWORD_VALIDATORS = []
+
+# the manager reads what it writes, replicas are for dashboard reads
+DATABASES = {'default': DATABASES['default']}
+DATABASE_ROUTERS = []
@@ -0,0 +1,48 @@
+"""
+Production settings for EagleDaddyCloud.
+
+Builds on the development settings, select with
+DJANGO_SETTINGS_MODULE=EagleDaddyCloud.settings_production
+(see `bin/serve.sh`). DJANGO_SECRET_KEY and DJANGO_ALLOWED_HOSTS
+must be set, startup fails without them.
+
+Static files are collected with hashed filenames, pre-compressed
+(gzip, and brotli when installed) by whitenoise and served from the
+app server with far-future cache headers.
+"""
+import os
+
+from . import required_env
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, MIDDLEWARE
+
+
+DEBUG = False
+
+# never the development key committed in settings.py
+SECRET_KEY = required_env('DJANGO_SECRET_KEY', 'production')
+
+# comma separated, ie: ed.qubixat.com,.qubixat.com
+ALLOWED_HOSTS = [
+    host.strip()
+    for host in required_env('DJANGO_ALLOWED_HOSTS', 'production').split(',')
+    if host.strip()
+]
+
+# whitenoise right after the security middleware, ahead of sessions etc.
+MIDDLEWARE = MIDDLEWARE[:1] + ['whitenoise.middleware.WhiteNoiseMiddleware'
+                               ] + MIDDLEWARE[1:]
+
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# hashed files get a year automatically, this covers the unhashed ones
+WHITENOISE_MAX_AGE = 3600
+
+# keep database connections between requests instead of one per request,
+# on the primary and the read replicas (copies of it, see settings.py)
+CONN_MAX_AGE = int(os.getenv('DJANGO_CONN_MAX_AGE', 60))
+for alias in DATABASES:  # noqa: F405
+    DATABASES[alias]['CONN_MAX_AGE'] = CONN_MAX_AGE  # noqa: F405
+
+ASYNC_VIEWS = True
@@ -0,0 +1,34 @@
+"""
+Settings for the test suite and for trying the replica router locally.
+
+    python manage.py test --settings=EagleDaddyCloud.settings_test
+    python manage.py runserver --settings=EagleDaddyCloud.settings_test
+
+The development settings on SQLite, with a second alias `replica_0`
+on the same database file so reads routed to the replica (see
+`broker.routers`) work without a PostgreSQL replica. In the tests the
+replica mirrors the test database of `default`.
+
+Tests that need redis use REDIS_HOST (config.yml's proxy host if unset)
+and are skipped when it is unreachable.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, CONFIG
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': str(BASE_DIR / 'test.sqlite3'),
+    },
+}
+DATABASES['replica_0'] = dict(DATABASES['default'],
+                              TEST={'MIRROR': 'default'})
+
+ASYNC_VIEWS = False
+
+# on its own channel, a running manager never sees the tests' commands
+CONFIG.proxy.host = os.getenv('REDIS_HOST', CONFIG.proxy.host)
+CONFIG.proxy.channel = f"{CONFIG.proxy.channel}/test"
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_migrate, post_save
 
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        from accounts.availability import add_username, create_username_index
+        post_migrate.connect(create_username_index, sender=self)
+        post_save.connect(add_username, sender=get_user_model())
@@ -0,0 +1,181 @@
+"""
+Username availability lookups for the signup form.
+
+A Bloom filter over lower cased usernames, kept in a redis bitmap,
+answers "definitely free" without touching the database. Only names
+the filter reports as possibly taken (real ones plus ~`bloom_error_rate`
+false positives) are checked against postgres, through the
+`lower(username)` index created by `create_username_index`.
+
+The filter is built with `manage.py build_username_filter` and kept in
+sync by a post_save hook on user creation. A rebuild fills a separate
+key and swaps it in, while it runs the hook adds new names to both so
+none is lost by the swap. Until it has been built, or
+whenever redis is unavailable, every lookup goes to the database.
+Deleted users are never removed from the filter, they only add to the
+false positives. The filter only speeds up the hint shown while typing,
+uniqueness is still enforced by the signup form and the database.
+"""
+
+import hashlib
+import logging
+import math
+
+import redis
+from django.contrib.auth import get_user_model
+from django.db.models.functions import Lower
+
+from EagleDaddyCloud.settings import CONFIG
+
+_FILTER_KEY = "eagledaddy/signup/usernames"
+_READY_KEY = f"{_FILTER_KEY}/ready"
+_BUILDING_KEY = f"{_FILTER_KEY}/building"
+# set while a rebuild runs, refreshed with every chunk
+_BUILDING_MARKER = f"{_BUILDING_KEY}/active"
+_BUILDING_TIMEOUT = 600
+
+_REDIS_POOL = redis.ConnectionPool(host=CONFIG.proxy.host,
+                                   port=int(CONFIG.proxy.port),
+                                   health_check_interval=15)
+
+_INDEX_NAME = "auth_user_username_lower"
+
+
+def create_username_index(sender=None, using='default', **kwargs):
+    """
+    post_migrate hook creating the functional index used by
+    case insensitive username lookups (PostgreSQL only).
+    """
+    from django.db import connections
+    conn = connections[using]
+    if conn.vendor != 'postgresql':
+        return
+
+    table = get_user_model()._meta.db_table
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {_INDEX_NAME} "
+                       f"ON {table} (lower(username))")
+
+
+class BloomFilter:
+    """
+    Bloom filter stored in a redis bitmap.
+
+    Args:
+        capacity (int): number of items the filter is sized for.
+        error_rate (float): false positive rate at `capacity`.
+    """
+    def __init__(self, connection_pool, key, capacity, error_rate):
+        self.pool = connection_pool
+        self.key = key
+        self.size = int(-capacity * math.log(error_rate) / math.log(2)**2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+
+    def positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, *items: str, pipeline_size=10000):
+        with redis.Redis(connection_pool=self.pool) as r:
+            pipe = r.pipeline(transaction=False)
+            for n, item in enumerate(items, 1):
+                for pos in self.positions(item):
+                    pipe.setbit(self.key, pos, 1)
+                if n % pipeline_size == 0:
+                    pipe.execute()
+            pipe.execute()
+
+    def __contains__(self, item: str) -> bool:
+        with redis.Redis(connection_pool=self.pool) as r:
+            pipe = r.pipeline(transaction=False)
+            for pos in self.positions(item):
+                pipe.getbit(self.key, pos)
+            return all(pipe.execute())
+
+
+def username_filter(key=_FILTER_KEY) -> BloomFilter:
+    return BloomFilter(_REDIS_POOL,
+                       key,
+                       capacity=int(CONFIG.signup.bloom_capacity),
+                       error_rate=float(CONFIG.signup.bloom_error_rate))
+
+
+def build_filter(chunk_size=10000) -> int:
+    """
+    (Re)builds the filter from every username in the database into a
+    fresh key, then swaps it in so lookups never see a partial filter.
+    """
+    building = username_filter(_BUILDING_KEY)
+    with redis.Redis(connection_pool=_REDIS_POOL) as r:
+        # new users go to both filters from here on, see `add_username`
+        r.set(_BUILDING_MARKER, 1, ex=_BUILDING_TIMEOUT)
+        r.delete(building.key)
+
+    usernames = get_user_model().objects.annotate(
+        lower_name=Lower('username')).values_list(
+            'lower_name', flat=True).iterator(chunk_size=chunk_size)
+
+    count = 0
+    batch = list()
+    for name in usernames:
+        batch.append(name)
+        if len(batch) == chunk_size:
+            building.add(*batch)
+            count += len(batch)
+            batch = list()
+            with redis.Redis(connection_pool=_REDIS_POOL) as r:
+                r.set(_BUILDING_MARKER, 1, ex=_BUILDING_TIMEOUT)
+    building.add(*batch)
+    count += len(batch)
+
+    with redis.Redis(connection_pool=_REDIS_POOL) as r:
+        with r.pipeline() as pipe:
+            if count:
+                pipe.rename(building.key, _FILTER_KEY)
+            pipe.delete(_BUILDING_MARKER)
+            pipe.set(_READY_KEY, count)
+            pipe.execute()
+    return count
+
+
+def add_username(sender, instance, created, **kwargs):
+    """post_save hook keeping the filter in sync with new users"""
+    if not created:
+        return
+    name = instance.username.lower()
+    try:
+        with redis.Redis(connection_pool=_REDIS_POOL) as r:
+            building = r.exists(_BUILDING_MARKER)
+        username_filter().add(name)
+        if building:
+            username_filter(_BUILDING_KEY).add(name)
+    except redis.RedisError as e:
+        logging.error(f"unable to add username to availability filter: {e}")
+
+
+def username_taken_in_db(username: str) -> bool:
+    return get_user_model().objects.annotate(
+        lower_name=Lower('username')).filter(
+            lower_name=username.lower()).exists()
+
+
+def is_username_taken(username: str) -> bool:
+    if not username:
+        return False
+
+    bloom = username_filter()
+    try:
+        with redis.Redis(connection_pool=_REDIS_POOL) as r:
+            pipe = r.pipeline(transaction=False)
+            pipe.exists(_READY_KEY)
+            for pos in bloom.positions(username.lower()):
+                pipe.getbit(bloom.key, pos)
+            ready, *bits = pipe.execute()
+        if ready and not all(bits):
+            return False
+    except redis.RedisError as e:
+        logging.error(f"availability filter unavailable: {e}")
+
+    return username_taken_in_db(username)
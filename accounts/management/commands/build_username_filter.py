@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from accounts.availability import build_filter
+
+
+class Command(BaseCommand):
+    help = "Build the redis username availability filter used by signup"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        count = build_filter(chunk_size=options['chunk_size'])
+        self.stdout.write(f"username filter built from {count} users")
@@ -5,6 +5,10 @@ from django.urls import reverse_lazy
 from django.views import generic
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+from EagleDaddyCloud.settings import CONFIG
+from accounts.availability import is_username_taken
 
 from ClientAccount.models import ClientAccount
 
@@ -29,7 +33,12 @@ class SignUpView(generic.CreateView):
 def validate_username(request):
     """ Check username availablility"""
     username = request.GET.get('username', None)
-    response = {
-        'is_taken': User.objects.filter(username__iexact=username).exists()
-    }
-    return JsonResponse(response)
\ No newline at end of file
+    is_taken = is_username_taken(username)
+    response = JsonResponse({'is_taken': is_taken})
+
+    # let the browser answer repeated keystrokes, names rarely free up
+    # again so "taken" can be cached longer than "available"
+    max_age = CONFIG.signup.taken_max_age if is_taken else CONFIG.signup.free_max_age
+    patch_cache_control(response, private=True, max_age=int(max_age))
+    patch_vary_headers(response, ('Cookie', ))
+    return response
\ No newline at end of file
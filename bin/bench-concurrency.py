@@ -0,0 +1,101 @@
+"""
+Concurrency benchmark for the dashboard ajax endpoints.
+
+Fires `requests` GETs at `url` with `concurrency` connections open at
+once and reports throughput and latency percentiles. Run it once
+against the sync WSGI server and once against the ASGI server to
+compare them, ie:
+
+    python manage.py runserver 8080
+    python bin/bench-concurrency.py "http://localhost:8080/dashboard/check_for_nodes/" 200 5000
+
+    uvicorn EagleDaddyCloud.asgi:application --port 8081
+    python bin/bench-concurrency.py "http://localhost:8081/dashboard/check_for_nodes/" 200 5000
+
+Uses plain asyncio streams, no extra dependencies.
+
+usage: python bin/bench-concurrency.py url [concurrency] [requests]
+"""
+import asyncio
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+
+async def worker(url, queue, latencies, errors):
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    request = (f"GET {path or '/'} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+               f"Connection: keep-alive\r\n\r\n").encode()
+    reader = writer = None
+
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    parts.hostname, parts.port or 80)
+            writer.write(request)
+            await writer.drain()
+
+            status = await reader.readline()
+            length, close = 0, False
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+                elif name.lower() == "connection":
+                    close = value.strip().lower() == "close"
+            await reader.readexactly(length)
+
+            if not status.split()[1:2] == [b"200"]:
+                errors.append(status)
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError) as e:
+            errors.append(e)
+            writer = None
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    if writer is not None:
+        writer.close()
+
+
+async def run(url, concurrency, requests):
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    latencies, errors = list(), list()
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        worker(url, queue, latencies, errors) for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{url}")
+    print(f"  concurrency {concurrency}, {requests} requests in {elapsed:.2f}s")
+    print(f"  throughput  {len(latencies) / elapsed:,.0f} req/s, {len(errors)} errors")
+    if latencies:
+        p99 = latencies[max(0, int(len(latencies) * .99) - 1)]
+        print(f"  latency     p50 {statistics.median(latencies):.1f}ms "
+              f"p99 {p99:.1f}ms max {latencies[-1]:.1f}ms")
+
+
+if __name__ == "__main__":
+    url = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    asyncio.run(run(url, concurrency, requests))
@@ -0,0 +1,89 @@
+"""
+Storage benchmark for NodeModule's compact column layout.
+
+Creates two scratch tables in the configured PostgreSQL database, the
+old layout (hex varchar address, varchar mode/network id) and the
+compact one (bigint address, smallint mode/network id), each with a
+(hub_id, address) index, seeds both with the same `rows` nodes and
+reports table/index size and (hub, address) lookup latency.
+
+usage: python bin/bench-nodes.py [rows] [lookups]
+"""
+import os
+import sys
+import time
+import random
+import statistics
+import django
+
+sys.path.insert(0, sys.path[0] + "/..")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "EagleDaddyCloud.settings")
+django.setup()
+
+from django.db import connection
+from broker.models import address_to_int
+
+LAYOUTS = {
+    'bench_nodes_hex': """
+        hub_id integer NOT NULL, address varchar(16) NOT NULL,
+        hub_node_id varchar(16) NOT NULL, node_id varchar(512) NOT NULL,
+        operating_mode varchar(512) NOT NULL, network_id varchar(512) NOT NULL""",
+    'bench_nodes_compact': """
+        hub_id integer NOT NULL, address bigint NOT NULL,
+        hub_node_id bigint NOT NULL, node_id varchar(512) NOT NULL,
+        operating_mode smallint NOT NULL, network_id smallint NOT NULL""",
+}
+
+
+def seed_rows(rows, hubs):
+    for i in range(rows):
+        address = (0x0013A200 << 32) | random.getrandbits(32)
+        yield (i % hubs + 1, f"{address:016x}", "0013a20041bd3346",
+               f"node_{i}", "01", "7fff")
+
+
+def compact(row):
+    hub, address, parent, node_id, mode, network = row
+    return (hub, address_to_int(address), address_to_int(parent), node_id,
+            int(mode, 16), int(network, 16))
+
+
+def main(rows=1000000, lookups=5000):
+    if connection.vendor != 'postgresql':
+        sys.exit("bench-nodes needs postgresql")
+
+    data = list(seed_rows(rows, hubs=max(1, rows // 50)))
+    probes = random.sample(data, min(lookups, rows))
+
+    with connection.cursor() as cursor:
+        for table, columns in LAYOUTS.items():
+            convert = compact if table.endswith('compact') else (lambda r: r)
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            cursor.execute(f"CREATE TABLE {table} (id bigserial PRIMARY KEY, {columns})")
+            for i in range(0, rows, 10000):
+                cursor.executemany(
+                    f"INSERT INTO {table} (hub_id, address, hub_node_id, node_id, "
+                    f"operating_mode, network_id) VALUES (%s, %s, %s, %s, %s, %s)",
+                    [convert(r) for r in data[i:i + 10000]])
+            cursor.execute(f"CREATE INDEX {table}_hub_address ON {table} (hub_id, address)")
+            cursor.execute(f"VACUUM ANALYZE {table}")
+
+            cursor.execute(f"SELECT pg_relation_size('{table}'), pg_indexes_size('{table}')")
+            table_size, index_size = cursor.fetchone()
+
+            samples = list()
+            for probe in probes:
+                hub, address = convert(probe)[:2]
+                started = time.perf_counter()
+                cursor.execute(f"SELECT * FROM {table} WHERE hub_id = %s AND address = %s",
+                               (hub, address))
+                cursor.fetchall()
+                samples.append((time.perf_counter() - started) * 1000)
+
+            print(f"{table}: table {table_size / 1e6:.1f}MB, indexes {index_size / 1e6:.1f}MB, "
+                  f"lookup p50 {statistics.median(samples):.3f}ms")
+            cursor.execute(f"DROP TABLE {table}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,141 @@
+"""
+Benchmark of outbound fan-out with and without a publisher pool.
+
+Publishes `messages` commands to `hubs` hubs as fast as possible while
+a simulated hub sends `rate` messages/s to the receiving connection,
+once publishing on the receiving connection itself (pool size 0, the
+manager without a pool) and once per given pool size. Reports publish
+throughput (until the broker acknowledged every message) and the
+latency of inbound messages during the burst.
+
+Needs a broker, defaults to the one in config.yml.
+
+usage: python bin/bench-publishers.py [messages] [pool sizes...]
+            [--host H] [--port P] [--hubs N] [--rate N]
+"""
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+
+import django
+
+sys.path.insert(0, sys.path[0] + "/..")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "EagleDaddyCloud.settings")
+django.setup()
+
+import paho.mqtt.client as mqtt
+from edcomms import EDChannel, EDClient, EDCommand
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.publishers import PublisherPool
+
+_TIMESTAMP = struct.Struct("<d")
+_TIMEOUT = 120  # s, give up waiting for acknowledgements
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(host, port, pool_size, messages, hubs, rate):
+    root = CONFIG.mqtt.root_channel
+    manager_id = uuid.uuid4()
+    latencies = list()
+    acked = [0]
+    burst = threading.Event()
+
+    def on_message(client, userdata, msg):
+        if burst.is_set():
+            latencies.append(time.perf_counter() -
+                             _TIMESTAMP.unpack(msg.payload)[0])
+
+    def on_publish(client, userdata, mid):
+        acked[0] += 1
+
+    receiver = EDClient(manager_id, host, port)
+    receiver.on_message = on_message
+    receiver.init()
+    receiver.subscribe(f"{root}/bench/+/in", qos=1)
+    receiver.loop_start()
+
+    pool = None
+    publish_clients = [receiver]
+    if pool_size:
+        pool = PublisherPool(manager_id, host, port, size=pool_size)
+        pool.start()
+        publish_clients = pool._clients
+    for client in publish_clients:
+        client.on_publish = on_publish
+
+    # simulated hub sending to the manager during the burst
+    stopped = threading.Event()
+    hub = mqtt.Client(client_id=f"bench-hub-{uuid.uuid4()}")
+    hub.connect(host, port)
+    hub.loop_start()
+
+    def send_inbound():
+        while not stopped.is_set():
+            hub.publish(f"{root}/bench/{manager_id}/in",
+                        _TIMESTAMP.pack(time.perf_counter()),
+                        qos=1)
+            time.sleep(1 / rate)
+
+    time.sleep(0.5)  # let subscriptions settle
+    sender = threading.Thread(target=send_inbound, daemon=True)
+    sender.start()
+
+    hub_ids = [uuid.uuid4() for _ in range(hubs)]
+    channels = [EDChannel(f"bench/{hub_id}/cloud/") for hub_id in hub_ids]
+    packet = receiver.create_packet(EDCommand.discovery, payload=None)
+
+    burst.set()
+    started = time.perf_counter()
+    for i in range(messages):
+        n = i % hubs
+        if pool is None:
+            receiver.publish(channels[n], packet)
+        else:
+            pool.publish(hub_ids[n], channels[n], packet)
+
+    deadline = time.monotonic() + _TIMEOUT
+    while acked[0] < messages and time.monotonic() < deadline:
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    burst.clear()
+
+    stopped.set()
+    sender.join()
+    for client in [receiver, hub] + (pool._clients if pool else []):
+        client.loop_stop()
+        client.disconnect()
+
+    label = f"pool of {pool_size}" if pool_size else "receiving connection"
+    print(f"{label:<22} {acked[0]}/{messages} published in {elapsed:.2f}s, "
+          f"{acked[0] / elapsed:.0f} msg/s")
+    if latencies:
+        print(f"{'':<22} inbound latency during burst, n={len(latencies)}: " +
+              " ".join(f"p{p}={percentile(latencies, p) * 1000:.1f}ms"
+                       for p in (50, 95, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("messages", type=int, nargs="?", default=20000)
+    parser.add_argument("sizes", type=int, nargs="*", default=[1, 4])
+    parser.add_argument("--host", default=CONFIG.mqtt.host)
+    parser.add_argument("--port", type=int, default=int(CONFIG.mqtt.port))
+    parser.add_argument("--hubs", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=200)
+    args = parser.parse_args()
+
+    for size in [0] + [s for s in args.sizes if s]:
+        run(args.host, args.port, size, args.messages, args.hubs, args.rate)
+
+
+if __name__ == "__main__":
+    main()
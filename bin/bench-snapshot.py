@@ -0,0 +1,74 @@
+"""
+Benchmark of the MQTT manager's time-to-ready on restart.
+
+Compares subscribing `hubs` hubs from a registry snapshot (warm restart)
+with loading them from the hubs table (cold start, only when `--db`
+is given and the configured database holds the hubs).
+
+No broker connection is made, subscriptions are registered locally
+exactly as on startup.
+
+usage: python bin/bench-snapshot.py [hubs] [--db]
+"""
+import importlib.util
+import logging
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+_MANAGER = Path(__file__).resolve().parent / "mqtt-manager.py"
+
+
+def load_manager_module():
+    spec = importlib.util.spec_from_file_location("mqtt_manager", _MANAGER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fresh_manager(mm):
+    manager = mm.ChannelManager(uuid.uuid4(), host="localhost")
+    manager.add_subscription(mm.EDChannel("announce/"),
+                             callback=mm.AnnounceCallback)
+    manager.add_subscription(mm.EDChannel("+/"),
+                             callback=mm.HubDispatchCallback)
+    return manager
+
+
+def main(hubs=100000, db=False):
+    mm = load_manager_module()
+    logging.getLogger().setLevel(logging.WARNING)
+    registry = {str(uuid.uuid4()): pk for pk in range(1, hubs + 1)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "registry.snapshot"
+
+        started = time.perf_counter()
+        mm.write_snapshot(path, registry)
+        print(f"write snapshot ({path.stat().st_size / 1e6:.1f}MB): "
+              f"{(time.perf_counter() - started) * 1000:.1f}ms")
+
+        started = time.perf_counter()
+        _, loaded = mm.read_snapshot(path)
+        read = time.perf_counter() - started
+
+        manager = fresh_manager(mm)
+        for hub_id, pk in loaded.items():
+            manager.subscribe_hub(hub_id, pk)
+        ready = time.perf_counter() - started
+        print(f"warm start, {len(loaded)} hubs: read {read * 1000:.1f}ms, "
+              f"ready {ready * 1000:.1f}ms")
+
+    if db:
+        manager = fresh_manager(mm)
+        started = time.perf_counter()
+        manager.reconcile_subscriptions()
+        print(f"cold start, {len(manager._hub_pks)} hubs from database: "
+              f"ready {(time.perf_counter() - started) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    main(int(args[0]) if args else 100000, db="--db" in sys.argv)
@@ -0,0 +1,516 @@
+"""
+Micro-benchmarks of the message path and the dashboard endpoints.
+
+    comms     `comms.Message` encode/decode and the pickled `EDPacket`
+              the hubs actually send, at several payload sizes
+    callback  `DiretMessageCallback` discovery and diagnostics at several
+              payload sizes, `AnnounceCallback` for new and existing hubs
+    manager   `ChannelManager.send_hub_command` fan-out
+    views     the dashboard ajax endpoints, through the full middleware
+              stack with a logged in user
+
+Runs on an in-memory SQLite database (EagleDaddyCloud/settings_bench.py)
+and a manager whose MQTT publishes are pickled and counted instead of
+sent, no broker or PostgreSQL needed. The views that publish commands
+(discover, diag_report) need redis, they publish to a `/bench` channel
+nobody else listens to and are skipped when redis is unreachable.
+
+Each benchmark reports the median and min time per call, and the
+number of database queries of one call. Benchmarks with a query budget
+fail when they exceed it, whatever the timings.
+
+Results are saved to .benchmarks/<name>.json with --save and compared
+with --compare, medians slower by more than --threshold are reported
+as regressions. A change is checked with:
+
+    git stash; python bin/bench-suite.py --save baseline; git stash pop
+    python bin/bench-suite.py --compare baseline
+
+Exits non zero when a query budget is exceeded or a benchmark regressed.
+
+usage: python bin/bench-suite.py [filter...] [--save NAME] [--compare NAME]
+            [--threshold 1.25] [--min-time S] [--redis HOST[:PORT]]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import pickle
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, sys.path[0] + "/..")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                      "EagleDaddyCloud.settings_bench")
+# configured before the manager module would log debug to a file
+logging.basicConfig(level=logging.WARNING)
+django.setup()
+
+import paho.mqtt.client as mqtt
+import redis
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from edcomms import EDCommand, EDPacket
+
+import comms
+from ClientAccount.models import ClientAccount
+from EagleDaddyCloud.settings import CONFIG
+from broker import utils as broker_utils
+from broker.models import (ClientHubDevice, CommandDiagnosticsResponse,
+                           CommandResponseFlag, NodeModule)
+from broker.ratelimit import RateLimiter
+
+_ROOT = Path(__file__).resolve().parent.parent
+_MANAGER = _ROOT / "bin" / "mqtt-manager.py"
+_RESULTS = _ROOT / ".benchmarks"
+
+PAYLOAD_SIZES = (1, 10, 100, 1000)  # nodes / report entries per message
+FAN_OUT = (1, 100, 1000)  # hubs per send_hub_command
+HUBS = 1000
+NODES = 200  # nodes listed by check_for_nodes
+ROUNDS = 7
+
+
+def load_manager_module():
+    spec = importlib.util.spec_from_file_location("mqtt_manager", _MANAGER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Case:
+    """
+    A benchmark: `fn` is timed, `setup` runs untimed before every call
+    (and turns calibration off, one call per sample), `teardown` once
+    after the last one. `max_queries` is the query budget of one call.
+    """
+    def __init__(self,
+                 name,
+                 fn,
+                 setup=None,
+                 teardown=None,
+                 max_queries=None,
+                 needs_redis=False):
+        self.name = name
+        self.fn = fn
+        self.setup = setup
+        self.teardown = teardown
+        self.max_queries = max_queries
+        self.needs_redis = needs_redis
+
+
+def discovery_payload(count):
+    return [{
+        'address64': f"0013a2004{i:07x}",
+        'node_id': f"node-{i}",
+        'operating_mode': '01',
+        'network_id': '7fff',
+        'parent_device': '0013a20041bd3346',
+    } for i in range(count)]
+
+
+def diagnostics_payload(count):
+    return json.dumps({f"metric_{i}": i * 0.5 for i in range(count)})
+
+
+def mqtt_message(topic: str, packet: EDPacket) -> mqtt.MQTTMessage:
+    msg = mqtt.MQTTMessage(topic=topic.encode())
+    msg.payload = pickle.dumps(packet)
+    return msg
+
+
+class Fixtures:
+    """seeded database, fake manager, logged in client and redis"""
+    def __init__(self, mm, proxy):
+        call_command('migrate', verbosity=0)
+        self.mm = mm
+        self.proxy = proxy
+
+        # bulk_create skips the signup signals, which would add the
+        # username to the availability filter in redis
+        User = get_user_model()
+        User.objects.bulk_create([User(username='bench')])
+        user = User.objects.get(username='bench')
+        self.account = ClientAccount.objects.create(user=user)
+        ClientHubDevice.objects.bulk_create(
+            ClientHubDevice(account=self.account,
+                            hub_id=uuid.uuid4(),
+                            hub_name=f"hub-{i}",
+                            connect_passphrase='bench') for i in range(HUBS))
+        self.hubs = list(ClientHubDevice.objects.order_by('pk'))
+        CommandResponseFlag.objects.bulk_create(
+            CommandResponseFlag(hub=hub) for hub in self.hubs)
+
+        self.hub = self.hubs[0]
+        NodeModule.objects.bulk_create(
+            NodeModule(hub=self.hub,
+                       address=int(node['address64'], 16),
+                       node_id=node['node_id'],
+                       operating_mode=1,
+                       network_id=0x7fff,
+                       hub_node_id=int(node['parent_device'], 16),
+                       last_seen=timezone.now())
+            for node in discovery_payload(NODES))
+        CommandDiagnosticsResponse.objects.create(
+            hub=self.hub, report=json.loads(diagnostics_payload(10)))
+        self.hub.diagnostics_ready(True)
+
+        self.manager = fake_manager(mm)
+        for hub in self.hubs:
+            self.manager.subscribe_hub(hub.hub_id, hub.pk)
+
+        self.client = Client()
+        self.client.force_login(user)
+
+        self.subscriber = None
+        if proxy is not None:
+            # a receiver, so the views take the path of a sent command
+            self.subscriber = proxy.pubsub()
+            self.subscriber.subscribe(CONFIG.proxy.channel)
+
+    def drain(self):
+        while self.subscriber.get_message(timeout=0):
+            pass
+
+
+def fake_manager(mm):
+    class FakeMQTTManager(mm.ChannelManager):
+        """publishes are pickled as on the wire and counted, not sent"""
+        published = 0
+        published_bytes = 0
+
+        def publish(self, channel, packet):
+            self.published += 1
+            self.published_bytes += len(pickle.dumps(packet))
+
+    return FakeMQTTManager(uuid.uuid4(), host="localhost")
+
+
+def comms_cases(fx):
+    for size in PAYLOAD_SIZES:
+        message = comms.Message(nodes=discovery_payload(size))
+        msg = mqtt.MQTTMessage()
+        msg.payload = message.encode().encode()
+        yield Case(f"comms.Message.encode[{size}]", message.encode)
+        yield Case(f"comms.Message.decode[{size}]",
+                   lambda msg=msg: comms.Message.decode(msg))
+
+        packet = fx.manager.create_packet(EDCommand.discovery,
+                                          payload=discovery_payload(size))
+        encoded = pickle.dumps(packet)
+        yield Case(f"EDPacket.pickle.dumps[{size}]",
+                   lambda packet=packet: pickle.dumps(packet))
+        yield Case(f"EDPacket.pickle.loads[{size}]",
+                   lambda encoded=encoded: pickle.loads(encoded))
+
+
+def callback_cases(fx):
+    mm, manager = fx.mm, fx.manager
+
+    def hub_message(hub, cmd, payload):
+        packet = EDPacket().set_command(cmd).set_payload(payload).set_sender(
+            hub.hub_id)
+        return mqtt_message(f"{mm._ROOT_CHANNEL}/{hub.hub_id}", packet)
+
+    for i, size in enumerate(PAYLOAD_SIZES):
+        hub = fx.hubs[1 + i]
+        msg = hub_message(hub, EDCommand.discovery, discovery_payload(size))
+        clear = lambda hub=hub: NodeModule.objects.filter(hub=hub).delete()
+
+        # every node created, then every node already known
+        yield Case(f"callback.discovery.new[{size}]",
+                   lambda msg=msg: mm.DiretMessageCallback.callback(
+                       manager, None, msg),
+                   setup=clear,
+                   max_queries=1 + 5 * size)
+        yield Case(f"callback.discovery.known[{size}]",
+                   lambda msg=msg: mm.DiretMessageCallback.callback(
+                       manager, None, msg),
+                   teardown=clear,
+                   max_queries=1 + 3 * size)
+
+        msg = hub_message(hub, EDCommand.diagnostics,
+                          diagnostics_payload(size))
+        yield Case(f"callback.diagnostics[{size}]",
+                   lambda msg=msg: mm.DiretMessageCallback.callback(
+                       manager, None, msg),
+                   max_queries=9)
+
+    def announce(hub_id):
+        packet = EDPacket().set_command(EDCommand.announce).set_payload({
+            'hub_id': str(hub_id),
+            'connect_passphrase': 'bench',
+            'hub_name': 'bench',
+        }).set_sender(hub_id)
+        return mqtt_message(f"{mm._ROOT_CHANNEL}/announce", packet)
+
+    new = list()
+    yield Case("callback.announce.new",
+               lambda: mm.AnnounceCallback.callback(manager, None, new[-1]),
+               setup=lambda: new.append(announce(uuid.uuid4())),
+               max_queries=4)
+    existing = announce(fx.hubs[-1].hub_id)
+    yield Case("callback.announce.existing",
+               lambda: mm.AnnounceCallback.callback(manager, None, existing),
+               max_queries=2)
+
+
+def manager_cases(fx):
+    for size in FAN_OUT:
+        hubs = fx.hubs[:size]
+        yield Case(f"manager.send_hub_command[{size}]",
+                   lambda hubs=hubs: fx.manager.send_hub_command(
+                       hubs, EDCommand.ping),
+                   max_queries=0)
+
+
+def view_cases(fx):
+    client, hub = fx.client, fx.hub
+    params = {'hub_id': str(hub.hub_id)}
+    # commands reset the diagnostics flag of their hub, sent to another
+    # one so diag_rcv always reads a ready report
+    command_hub = fx.hubs[-2]
+    command_params = {'hub_id': str(command_hub.hub_id)}
+
+    def get(name, data=None):
+        response = client.get(reverse(name), data)
+        assert response.status_code == 200, (name, response.status_code)
+        return response
+
+    def resend(cmd):
+        def setup():
+            fx.proxy.delete(
+                broker_utils.inflight_key(command_hub.hub_id, cmd))
+            fx.drain()
+
+        return setup
+
+    yield Case("views.discover",
+               lambda: get('ajax_discover_nodes', command_params),
+               setup=resend(EDCommand.discovery),
+               max_queries=1,
+               needs_redis=True)
+    yield Case("views.diag_report",
+               lambda: get('ajax_diagnostics_report', command_params),
+               setup=resend(EDCommand.diagnostics),
+               max_queries=3,
+               needs_redis=True)
+    yield Case("views.diag_rcv",
+               lambda: get('ajax_diagnostics_rcv', params),
+               max_queries=3)
+    yield Case(f"views.check_for_nodes[{NODES}]",
+               lambda: get('ajax_check_for_nodes'),
+               max_queries=1)
+    yield Case("views.search", lambda: get('search_fleet', {'q': 'node-1'}),
+               max_queries=5)
+
+
+class QueryCounter:
+    """execute wrapper counting queries, see `run_case`"""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def time_case(case, min_time):
+    """seconds per call, one sample per round"""
+    samples = list()
+    if case.setup is not None:
+        started = time.perf_counter()
+        while len(samples) < ROUNDS or \
+                (time.perf_counter() - started < min_time and
+                 len(samples) < 100 * ROUNDS):
+            case.setup()
+            t = time.perf_counter()
+            case.fn()
+            samples.append(time.perf_counter() - t)
+        return samples
+
+    # calls per round so a round takes min_time / ROUNDS
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            case.fn()
+        elapsed = time.perf_counter() - t
+        if elapsed >= min_time / ROUNDS / 10 or number >= 1000000:
+            break
+        number *= 10
+    number = max(1, int(number * (min_time / ROUNDS) / max(elapsed, 1e-9)))
+
+    for _ in range(ROUNDS):
+        t = time.perf_counter()
+        for _ in range(number):
+            case.fn()
+        samples.append((time.perf_counter() - t) / number)
+    return samples
+
+
+def run_case(case, min_time):
+    if case.setup:
+        case.setup()
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        case.fn()  # also the warmup
+
+    samples = time_case(case, min_time)
+    if case.teardown:
+        case.teardown()
+    return {
+        'median_us': round(statistics.median(samples) * 1e6, 2),
+        'min_us': round(min(samples) * 1e6, 2),
+        'samples': len(samples),
+        'queries': queries.count,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=_ROOT,
+                              capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def connect_redis(address):
+    host, _, port = (address or CONFIG.proxy.host).partition(':')
+    CONFIG.proxy.host = host
+    CONFIG.proxy.port = int(port or CONFIG.proxy.port)
+    # never reach a manager listening on the real channel
+    CONFIG.proxy.channel = f"{CONFIG.proxy.channel}/bench"
+
+    proxy = redis.Redis(host=CONFIG.proxy.host, port=CONFIG.proxy.port)
+    try:
+        proxy.ping()
+    except redis.RedisError as e:
+        print(f"redis at {host} unavailable, skipping views that publish: {e}")
+        return None
+
+    # the publish path including the limit check, without ever limiting
+    unlimited = {'burst': 10**9, 'per_minute': 10**9}
+    broker_utils._LIMITER = RateLimiter('bench', {
+        cmd.name: {
+            'account': unlimited,
+            'hub': unlimited
+        }
+        for cmd in (EDCommand.discovery, EDCommand.diagnostics)
+    })
+    return proxy
+
+
+def compare(results, baseline, threshold):
+    """report lines and number of regressions against `baseline`"""
+    lines, regressions = list(), 0
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            lines.append(f"{name}: new")
+            continue
+
+        ratio = result['median_us'] / before['median_us']
+        status = ''
+        if ratio > threshold:
+            status = 'SLOWER'
+            regressions += 1
+        elif ratio < 1 / threshold:
+            status = 'faster'
+        if result['queries'] > before['queries']:
+            status = f"{status} +{result['queries'] - before['queries']} queries".strip()
+            regressions += 1
+        if status:
+            lines.append(f"{name}: {before['median_us']:.1f}us -> "
+                         f"{result['median_us']:.1f}us ({ratio:.2f}x) {status}")
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filters', nargs='*', help="run benchmarks whose "
+                        "name contains one of these")
+    parser.add_argument('--save', help="save results as .benchmarks/NAME.json")
+    parser.add_argument('--compare', help="compare with .benchmarks/NAME.json")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="median ratio reported as a regression")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="s, minimum time spent timing each benchmark")
+    parser.add_argument('--redis', help="HOST[:PORT], defaults to config.yml")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        path = _RESULTS / f"{args.compare}.json"
+        if not path.exists():
+            sys.exit(f"no saved results {path}")
+        baseline = json.loads(path.read_text())['results']
+
+    proxy = connect_redis(args.redis)
+    fx = Fixtures(load_manager_module(), proxy)
+    # the manager module configures logging again when loaded
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results, over_budget = dict(), list()
+    for group in (comms_cases, callback_cases, manager_cases, view_cases):
+        for case in group(fx):
+            if args.filters and not any(f in case.name for f in args.filters):
+                continue
+            if case.needs_redis and proxy is None:
+                continue
+
+            result = run_case(case, args.min_time)
+            results[case.name] = result
+            budget = ''
+            if case.max_queries is not None:
+                budget = f"/{case.max_queries}"
+                if result['queries'] > case.max_queries:
+                    over_budget.append(case.name)
+            print(f"{case.name:<36} {result['median_us']:>12.1f}us "
+                  f"(min {result['min_us']:.1f}us) "
+                  f"{result['queries']}{budget} queries")
+
+    failed = bool(over_budget)
+    for name in over_budget:
+        print(f"{name}: over its query budget")
+
+    if baseline is not None:
+        lines, regressions = compare(results, baseline, args.threshold)
+        print(f"\ncompared with {args.compare}:")
+        print("\n".join(lines) or "no changes")
+        failed = failed or regressions > 0
+
+    if args.save:
+        _RESULTS.mkdir(exist_ok=True)
+        path = _RESULTS / f"{args.save}.json"
+        path.write_text(
+            json.dumps(
+                {
+                    'saved_at': time.time(),
+                    'commit': commit(),
+                    'python': platform.python_version(),
+                    'machine': platform.platform(),
+                    'results': results,
+                },
+                indent=2))
+        print(f"saved {path}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
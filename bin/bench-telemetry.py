@@ -0,0 +1,65 @@
+"""
+Benchmark harness for the telemetry ingestion pipeline.
+
+Simulates a fleet of hubs publishing telemetry batches and pushes
+them through the same decode + `TelemetryWriter` path the MQTT manager
+uses, against the configured database. Reports sustained readings/sec.
+
+usage: python bin/bench-telemetry.py [hubs] [nodes_per_hub] [batches_per_hub]
+"""
+import os
+import sys
+import time
+import random
+import django
+
+sys.path.insert(0, sys.path[0] + "/..")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "EagleDaddyCloud.settings")
+django.setup()
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.models import NodeTelemetry
+from broker.telemetry import TelemetryWriter, create_telemetry_table, readings_from_payload
+
+_BENCH_KIND = "__bench__"
+
+
+def simulated_payload(nodes, now):
+    return [{
+        'address64': f"{node:016x}",
+        'kind': _BENCH_KIND,
+        'value': random.random() * 100,
+        'ts': now
+    } for node in nodes]
+
+
+def main(hubs=100, nodes_per_hub=50, batches_per_hub=20):
+    create_telemetry_table()
+    writer = TelemetryWriter.from_config(CONFIG.telemetry)
+    writer.start()
+
+    total = hubs * nodes_per_hub * batches_per_hub
+    print(f"simulating {hubs} hubs x {nodes_per_hub} nodes x {batches_per_hub} batches = {total} readings")
+
+    started = time.perf_counter()
+    for _ in range(batches_per_hub):
+        now = time.time()
+        for hub_pk in range(1, hubs + 1):
+            nodes = range(hub_pk * 1000, hub_pk * 1000 + nodes_per_hub)
+            writer.put(readings_from_payload(hub_pk, simulated_payload(nodes, now)))
+    ingested = time.perf_counter() - started
+
+    writer.stop()
+    writer.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"decode + enqueue: {total / ingested:,.0f} readings/s")
+    print(f"end to end:       {writer.written / elapsed:,.0f} readings/s ({elapsed:.2f}s)")
+    print(f"writer stats:     {writer.describe()}")
+
+    NodeTelemetry.objects.filter(kind=_BENCH_KIND)._raw_delete(
+        NodeTelemetry.objects.db)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:4]])
@@ -0,0 +1,81 @@
+"""
+Benchmark of the signup username availability check.
+
+Seeds `users` synthetic accounts (bulk inserted), builds the redis
+availability filter and compares lookup latency of:
+
+    * legacy:  username__iexact (UPPER(username) = UPPER(...))
+    * db:      lower(username) through the functional index
+    * filter:  full `is_username_taken` path, free and taken names
+
+Needs the configured database and redis.
+
+usage: python bin/bench-username.py [users] [lookups]
+"""
+import os
+import sys
+import time
+import statistics
+import django
+
+sys.path.insert(0, sys.path[0] + "/..")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "EagleDaddyCloud.settings")
+django.setup()
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from accounts.availability import build_filter, create_username_index, is_username_taken, username_taken_in_db
+
+User = get_user_model()
+_PREFIX = "bench_user_"
+
+
+def seed(users, chunk=10000):
+    existing = User.objects.filter(username__startswith=_PREFIX).count()
+    password = make_password(None)
+    for start in range(existing, users, chunk):
+        User.objects.bulk_create([
+            User(username=f"{_PREFIX}{i}", password=password)
+            for i in range(start, min(users, start + chunk))
+        ])
+
+
+def timed(fn, names):
+    samples = list()
+    for name in names:
+        started = time.perf_counter()
+        fn(name)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return (f"p50 {statistics.median(samples):.3f}ms  "
+            f"p99 {samples[int(len(samples) * .99) - 1]:.3f}ms")
+
+
+def main(users=1000000, lookups=2000):
+    print(f"seeding {users} users...")
+    seed(users)
+    create_username_index()
+
+    started = time.perf_counter()
+    count = build_filter()
+    print(f"filter built from {count} users in {time.perf_counter() - started:.1f}s")
+
+    step = max(1, users // lookups)
+    taken = [f"{_PREFIX.upper()}{i}" for i in range(0, users, step)][:lookups]
+    free = [f"free_{_PREFIX}{i}" for i in range(lookups)]
+
+    legacy = lambda name: User.objects.filter(username__iexact=name).exists()
+    print(f"legacy iexact, taken:   {timed(legacy, taken)}")
+    print(f"lower() index, taken:   {timed(username_taken_in_db, taken)}")
+    print(f"availability, taken:    {timed(is_username_taken, taken)}")
+    print(f"availability, free:     {timed(is_username_taken, free)}")
+
+    wrong = sum(1 for name in free if username_taken_in_db(name) !=
+                          is_username_taken(name))
+    print(f"incorrect answers:      {wrong}")
+
+    User.objects.filter(username__startswith=_PREFIX)._raw_delete(User.objects.db)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,22 @@
+"""
+gunicorn configuration for the production profile, see `bin/serve.sh`.
+
+Runs the ASGI app in uvicorn workers, one worker per core plus
+one by default (each worker runs its own event loop).
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
+
+# recycle workers now and then to bound memory growth
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = "-"
+errorlog = "-"
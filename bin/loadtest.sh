@@ -0,0 +1,13 @@
+#!/bin/bash
+# Local load test of the dashboard pages, reports requests/sec per page.
+# Start the server first (ie: bin/serve.sh or manage.py runserver).
+#
+# usage: bin/loadtest.sh [base_url] [concurrency] [requests]
+BASE=${1:-http://127.0.0.1:8080}
+CONCURRENCY=${2:-100}
+REQUESTS=${3:-5000}
+
+cd "$(dirname "$0")/.."
+for page in /dashboard/ /accounts/login /dashboard/check_for_nodes/ /static/css/dashboard.css; do
+    python bin/bench-concurrency.py "$BASE$page" "$CONCURRENCY" "$REQUESTS"
+done
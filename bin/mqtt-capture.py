@@ -0,0 +1,207 @@
+"""
+Record and replay MQTT traffic for regression benchmarking.
+
+`record` subscribes to everything under the root channel and appends
+each message, with its arrival time, to a capture file (see
+`broker.capture`). `replay` publishes a capture back to a broker with
+the original spacing, 10x faster, or as fast as possible.
+
+With `--manager` the replay also runs the MQTT manager in-process
+against the configured database, and reports how it kept up: messages
+handled per second, callback latency percentiles and database writes.
+Point it at a throwaway broker and database, replayed announces and
+discovery responses are written like real ones.
+
+usage:
+    python bin/mqtt-capture.py record <file> [--host H] [--port P] [--seconds N]
+    python bin/mqtt-capture.py replay <file> [--host H] [--port P]
+                                      [--speed 1|10|max] [--manager]
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import django
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, sys.path[0] + "/..")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "EagleDaddyCloud.settings")
+django.setup()
+
+from django.db.backends.signals import connection_created
+from EagleDaddyCloud.settings import CONFIG
+from broker.capture import CaptureWriter, read_capture
+
+_MANAGER = Path(__file__).resolve().parent / "mqtt-manager.py"
+_MAX_INFLIGHT = 1000
+_IDLE_TIMEOUT = 2.0  # s, the manager is done once no message arrived for this long
+_WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def _client(host, port):
+    client = mqtt.Client(client_id=f"capture-{uuid.uuid4()}")
+    client.max_inflight_messages_set(_MAX_INFLIGHT)
+    client.connect(host, port)
+    client.loop_start()
+    return client
+
+
+def record(path, host, port, seconds=None):
+    writer = CaptureWriter(path)
+    topic = CONFIG.mqtt.root_channel + "/#"
+
+    def on_message(client, userdata, msg):
+        writer.write(msg.topic, msg.payload, msg.qos)
+
+    client = _client(host, port)
+    client.on_message = on_message
+    client.subscribe(topic, qos=int(CONFIG.mqtt.qos))
+    print(f"recording {topic} from {host}:{port} to {path}, ctrl-c to stop")
+
+    try:
+        time.sleep(seconds) if seconds else threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        writer.close()
+    print(f"recorded {writer.count} messages")
+
+
+class ReplayStats:
+    """callback timings and database writes of the in-process manager"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.writes = defaultdict(int)
+        self.last_handled = time.monotonic()
+
+    def timed(self, name, callback):
+        def wrapper(client, obj, msg):
+            started = time.perf_counter()
+            try:
+                callback(client, obj, msg)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.latencies[name].append(elapsed)
+                    self.last_handled = time.monotonic()
+
+        return wrapper
+
+    def count_writes(self, execute, sql, params, many, context):
+        statement = sql.lstrip().split(None, 1)[0].upper()
+        if statement in _WRITES:
+            with self._lock:
+                self.writes[statement] += len(params) if many else 1
+        return execute(sql, params, many, context)
+
+    def watch_connection(self, sender, connection, **kwargs):
+        # fired again on every reconnect of the same thread's connection
+        if self.count_writes not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.count_writes)
+
+    def report(self, elapsed):
+        handled = sum(len(v) for v in self.latencies.values())
+        print(f"manager handled {handled} messages, "
+              f"{handled / elapsed:.0f} msg/s")
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            pct = {
+                p: values[min(len(values) - 1, int(len(values) * p / 100))]
+                for p in (50, 95, 99)
+            }
+            print(f"  {name:<22} n={len(values):<7} " + " ".join(
+                f"p{p}={v * 1000:.2f}ms" for p, v in pct.items()) +
+                  f" max={values[-1] * 1000:.2f}ms")
+        print(f"database write statements: {dict(self.writes) or 0}")
+
+
+def start_manager(host, port, stats):
+    spec = importlib.util.spec_from_file_location("mqtt_manager", _MANAGER)
+    mm = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mm)
+
+    # only the callbacks registered with paho, dispatch to
+    # direct messages is timed as part of HubDispatchCallback
+    for cls in (mm.AnnounceCallback, mm.HubDispatchCallback,
+                mm.TelemetryCallback, mm.BatchCallback):
+        cls.callback = staticmethod(stats.timed(cls.__name__, cls.callback))
+
+    connection_created.connect(stats.watch_connection, weak=False)
+    manager = mm.ChannelManager(uuid.uuid4(), host=host, port=port)
+    manager.run()
+    return manager
+
+
+def replay(path, host, port, speed, with_manager=False):
+    stats = ReplayStats()
+    manager = start_manager(host, port, stats) if with_manager else None
+    client = _client(host, port)
+
+    # offsets are scaled by 1/speed, `max` publishes back to back
+    factor = None if speed == "max" else 1 / float(speed)
+    published = 0
+    info = None
+    started = time.perf_counter()
+    started_monotonic = time.monotonic()
+    for msg in read_capture(path):
+        if factor is not None:
+            wait = msg.offset * factor - (time.perf_counter() - started)
+            if wait > 0:
+                time.sleep(wait)
+        info = client.publish(msg.topic, msg.payload, qos=msg.qos)
+        published += 1
+
+    if info is not None:
+        info.wait_for_publish()
+    elapsed = time.perf_counter() - started
+    print(f"published {published} messages in {elapsed:.2f}s, "
+          f"{published / max(elapsed, 1e-9):.0f} msg/s (speed {speed})")
+
+    if manager is not None:
+        published_at = time.monotonic()
+        while time.monotonic() - max(stats.last_handled,
+                                     published_at) < _IDLE_TIMEOUT \
+                or manager.telemetry.pending:
+            time.sleep(0.1)
+        # let the writer finish its last batch
+        time.sleep(manager.telemetry.flush_interval)
+        stats.report(stats.last_handled - started_monotonic)
+        print(f"telemetry: {manager.telemetry.describe()}")
+        manager.loop_stop()
+
+    client.loop_stop()
+    client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("mode", choices=("record", "replay"))
+    parser.add_argument("file", type=Path)
+    parser.add_argument("--host", default=CONFIG.mqtt.host)
+    parser.add_argument("--port", type=int, default=int(CONFIG.mqtt.port))
+    parser.add_argument("--seconds", type=float, help="recording length")
+    parser.add_argument("--speed", default="1", choices=("1", "10", "max"))
+    parser.add_argument("--manager",
+                        action="store_true",
+                        help="run the manager in-process and report on it")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.mode == "record":
+        record(args.file, args.host, args.port, args.seconds)
+    else:
+        replay(args.file, args.host, args.port, args.speed, args.manager)
+
+
+if __name__ == "__main__":
+    main()
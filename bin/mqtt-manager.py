@@ -1,23 +1,53 @@
+import time
+# startup phases, reported once the manager is subscribed
+_STARTUP = [('start', time.perf_counter())]
+
 import logging
+import pickle
 from typing import Any, Dict, List
 import redis
+import resource
 import sys
 import json
 import os
+import threading
 import django
 import uuid
 
 from datetime import datetime
+from pathlib import Path
 from edcomms import EDChannel, EDClient, EDPacket, EDCommand, MessageCallback, _ROOT_CHANNEL
 
 sys.path.insert(0, sys.path[0] + "/..")
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "EagleDaddyCloud.settings")
+# only the apps the manager needs, see EagleDaddyCloud/settings_manager.py
+os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                      "EagleDaddyCloud.settings_manager")
+# long lived worker, keep per thread connections open between callbacks
+os.environ.setdefault("DJANGO_CONN_MAX_AGE", "600")
+_STARTUP.append(('imports', time.perf_counter()))
 django.setup()
+_STARTUP.append(('django setup', time.perf_counter()))
 
+from django.db import InterfaceError, OperationalError, connection, transaction
+from django.db.models import CharField
+from django.db.models.functions import Cast
 from django.utils import timezone
 from EagleDaddyCloud.settings import CONFIG
 from utils.utils import is_iter, lazy_property, make_iter
-from broker.models import ClientHubDevice, CommandDiagnosticsResponse, CommandResponseFlag, NodeModule
+from broker.models import ClientHubDevice, CommandDiagnosticsResponse, CommandResponseFlag, NodeModule, address_to_int, hex_to_int
+from broker.telemetry import TelemetryWriter, readings_from_payload
+from broker.scheduler import CommandScheduler
+from broker.utils import clear_inflight
+from broker.db import STATS as DB_STATS, db_resilient
+from broker.snapshot import SnapshotError, read_snapshot, write_snapshot
+from broker.profiling import PROFILER, ProfiledCallback
+from broker.topology import update_topology
+from broker.publishers import PublisherPool
+from broker.ratelimit import RateLimited, RateLimiter, throttled_counts
+from broker import fleet
+from broker.lanes import LANES, SCHEDULED, CommandLanes
+
+_STARTUP.append(('broker modules', time.perf_counter()))
 
 #TODO: convert this in edcomms package to change root channel
 # globally
@@ -31,9 +61,22 @@ _REDIS_PORT = 6379
 _REDIS_CMD_CHANNEL = "redis/eagledaddy/cmds"
 _REDIS_TIMEOUT = 0.01
 _MANAGER_ID = uuid.UUID("ffffffff-ffff-ffff-ffff-ffffffffffff")
+_STATS_INTERVAL = 60  # s, how often runtime stats are logged
+
 
+def report_startup():
+    """logs the time from process start to subscribed, by phase"""
+    marks = _STARTUP + [('connect and subscribe', time.perf_counter())]
+    phases = ", ".join(f"{name} {(end - start) * 1000:.0f}ms"
+                       for (_, start), (name, end) in zip(marks, marks[1:]))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logging.info(f"subscribed {marks[-1][1] - marks[0][1]:.2f}s after start "
+                 f"({phases}), max rss {rss:.0f}MB")
 
-class DiretMessageCallback(MessageCallback):
+
+class DiretMessageCallback(ProfiledCallback):
+    # on paho's network thread, retries must not block it
+    @db_resilient(defer=True)
     def process(self):
         hub_id = self.packet.sender_id
         hub: ClientHubDevice = self.client.objects.filter(
@@ -51,6 +94,11 @@ class DiretMessageCallback(MessageCallback):
             logging.warning(f"{self.packet.describe()}")
             return
 
+        if cmd in (EDCommand.discovery, EDCommand.diagnostics):
+            # the response settles the command, the next identical
+            # request from the web app is sent to the hub again
+            self.client.clear_inflight(hub_id, cmd)
+
         if cmd == EDCommand.pong:
             logging.debug("{self.packet.sender_id} responded to PING")
 
@@ -63,19 +111,34 @@ class DiretMessageCallback(MessageCallback):
                 logging.info("No nodes found for {self.packet.sender_id}")
                 return
 
+            discovered = list()
+            created = 0
             for node in nodes:
-                defaults = {
-                    'address': node['address64'],
-                    'node_id': node['node_id'],
-                    'operating_mode': node['operating_mode'],
-                    'network_id': node['network_id'],
-                    'hub_node_id': node['parent_device'],
-                }
+                # hub sends hex encoded bytes, stored compact as integers
+                try:
+                    address = address_to_int(node['address64'])
+                    defaults = {
+                        'address': address,
+                        'node_id': node['node_id'],
+                        'operating_mode': hex_to_int(node['operating_mode']),
+                        'network_id': hex_to_int(node['network_id']),
+                        'hub_node_id': address_to_int(node['parent_device']),
+                        'last_seen': timezone.now(),
+                    }
+                except (KeyError, TypeError, ValueError) as e:
+                    logging.error(f"malformed node in discovery: {node}, {e}")
+                    continue
 
                 result = NodeModule.objects.update_or_create(
-                    hub=hub, address=node['address64'], defaults=defaults)
+                    hub=hub, address=address, defaults=defaults)
+                created += result[1]
+                discovered.append((address, defaults['hub_node_id'],
+                                   defaults['node_id']))
                 logging.debug(f"Node creation, {result}, {node['address64']}")
 
+            self.client.update_topology(hub.pk, discovered)
+            self.client.add_nodes(hub, created)
+
             # logging.debug("setting discovery ready flag")
             # hub.discover_ready(True)
         
@@ -91,7 +154,8 @@ class DiretMessageCallback(MessageCallback):
             logging.info(f"setting diagnostics flag @ {datetime.now()},{hub.diagnostics_ready()}")
 
 
-class AnnounceCallback(MessageCallback):
+class AnnounceCallback(ProfiledCallback):
+    @db_resilient(defer=True)
     def process(self):
         """
         Announce channel is used by hubs to either checkin
@@ -111,58 +175,355 @@ class AnnounceCallback(MessageCallback):
         existing_hub = self.client.objects.filter(hub_id=hub_id).first()
         if not existing_hub:
             logging.info("Hub not found, creating new entry")
-            new_hub = ClientHubDevice(hub_id=hub_id,
-                                      connect_passphrase=connect_passphrase,
-                                      hub_name=hub_name,
-                                      last_checkin=timezone.now())
-            new_hub.save()
-
-            # attach new command response flag record to this  hub
-            flags = CommandResponseFlag(hub=new_hub)
-            flags.save()
-
-            channel = EDChannel(f"{hub_id}/")
-
-            logging.info(f"Subscribing to hubs' channel: {channel}")
-            self.client.add_subscription(channel,
-                                         callback=DiretMessageCallback)
+            # hub and its flags are created together so a retried
+            # callback never finds a hub without its flags record
+            with transaction.atomic():
+                new_hub = ClientHubDevice(hub_id=hub_id,
+                                          connect_passphrase=connect_passphrase,
+                                          hub_name=hub_name,
+                                          last_checkin=timezone.now())
+                new_hub.save()
+
+                # attach new command response flag record to this  hub
+                flags = CommandResponseFlag(hub=new_hub)
+                flags.save()
+
+            self.client.subscribe_hub(new_hub.hub_id, new_hub.pk)
             existing_hub = new_hub
         else:
             logging.info(f"{existing_hub.hub_id} checking in....")
-            existing_hub.last_checking = timezone.now()
-            existing_hub.save()
+            existing_hub.last_checkin = timezone.now()
+            existing_hub.save(update_fields=['last_checkin'])
+            self.client.subscribe_hub(existing_hub.hub_id, existing_hub.pk)
+            self.client.record_checkin(existing_hub)
 
         # send acknowledgement back that announced was recieved
         packet = self.client.create_packet(EDCommand.ack, payload=None)
-        self.client.publish(existing_hub.dedicated_channel, packet)
+        self.client.publish_to_hub(existing_hub, packet)
+
+
+class HubDispatchCallback(MessageCallback):
+    """
+    Single callback for /<root>/+, routes messages of every registered
+    hub to `DiretMessageCallback`. One wildcard filter instead of one
+    per hub keeps subscribing cheap (a dict insert) on startup, messages
+    of unregistered hubs are ignored as before.
+    """
+    @classmethod
+    def callback(cls, client, obj, msg):
+        hub_id = msg.topic.rsplit('/', 1)[-1]
+        if hub_id not in client._hub_pks:
+            return
+        DiretMessageCallback.callback(client, obj, msg)
+
+
+class TelemetryCallback(ProfiledCallback):
+    @db_resilient(defer=True)
+    def process(self):
+        """
+        Telemetry channel, /<root>/<hub_id>/telemetry, carries batches
+        of node readings which are queued for bulk writing.
+        """
+        hub_pk = self.client.hub_pk(self.packet.sender_id)
+        if hub_pk is None:
+            logging.error(
+                "Can't handle telemetry from hub that isn't in database")
+            return
+
+        readings = readings_from_payload(hub_pk, self.packet.payload)
+        self.client.telemetry.put(readings)
+
+
+class BatchCallback(ProfiledCallback):
+    """
+    Envelope of several packets of one hub, /<root>/<hub_id>/batch
+    (see examples/batching.py). The packets are handled in order as if
+    they arrived on their own topic, in one transaction so their
+    database writes are committed together. Malformed packets are
+    skipped, the redis side effects of a packet (see
+    `ChannelManager.after_commit`) only happen once it is committed.
+    """
+    _ROUTES = {
+        '': DiretMessageCallback,
+        'telemetry': TelemetryCallback,
+    }
+
+    @db_resilient(defer=True)
+    def process(self):
+        sender = str(self.packet.sender_id)
+        if sender not in self.client._hub_pks:
+            logging.error("Can't handle batch from hub that isn't in database")
+            return
+
+        hub_topic = f"{_ROOT_CHANNEL}/{sender}"
+        with transaction.atomic():
+            for item in self.packet.payload or ():
+                try:
+                    topic, encoded = item
+                    packet = pickle.loads(encoded)
+                except Exception as e:
+                    logging.error(f"malformed packet in batch of {sender}: {e}")
+                    continue
+
+                route = topic[len(hub_topic):].strip('/')
+                callback = self._ROUTES.get(route)
+                if str(getattr(packet, 'sender_id', None)) != sender or \
+                        not topic.startswith(hub_topic) or callback is None:
+                    logging.error(f"invalid packet in batch of {sender}: {topic}")
+                    continue
+
+                # a failing packet must not undo the rest of the batch
+                try:
+                    with transaction.atomic():
+                        callback(self.client, topic, packet).process()
+                except (OperationalError, InterfaceError):
+                    raise
+                except Exception as e:
+                    logging.error(f"failed to handle {topic} in batch: {e}")
 
 
 class ChannelManager(EDClient):
+    proxy: redis.Redis = None
+    publishers: PublisherPool = None
+    limiter = RateLimiter('manager')
+
     def init(self):
+        # an exception escaping a callback would end paho's network
+        # loop, and with it every inbound message (see `_guarded`)
+        self.suppress_exceptions = True
         super().init()
         self.loop_start()
 
+        # outbound messages get their own connections, this
+        # one is left to receive hub traffic
+        if int(CONFIG.mqtt.publishers):
+            self.publishers = PublisherPool(self.client_id,
+                                            self.host,
+                                            self.port,
+                                            size=int(CONFIG.mqtt.publishers))
+            self.publishers.start()
+
+        self.telemetry = TelemetryWriter.from_config(CONFIG.telemetry)
+        self.telemetry.start()
+
+        self.lanes = CommandLanes.from_config(CONFIG.lanes)
+        self.lanes.start()
+
         announce_channel = EDChannel("announce/")
 
         # this automatically make main subscription: /<root>/#
         self.add_subscription(announce_channel, callback=AnnounceCallback)
+
+        # single wildcard subscriptions for direct messages
+        # and telemetry of every registered hub
+        hubs_channel = EDChannel("+/", root=CONFIG.mqtt.root_channel)
+        self.add_subscription(hubs_channel, callback=HubDispatchCallback)
+        telemetry_channel = EDChannel("+/telemetry/")
+        self.add_subscription(telemetry_channel, callback=TelemetryCallback)
+        batch_channel = EDChannel("+/batch/")
+        self.add_subscription(batch_channel, callback=BatchCallback)
         self.load_subscriptions()
+        report_startup()
+
+        self.scheduler = CommandScheduler.from_config(
+            self.send_scheduled_command, CONFIG.scheduler)
+        self.scheduler.start()
+
+        threading.Thread(target=self._reconcile_loop,
+                         daemon=True,
+                         name="fleet-reconcile").start()
 
     def run(self):
         self.init()
 
+    def message_callback_add(self, sub, callback):
+        super().message_callback_add(sub, self._guarded(callback))
+
+    @staticmethod
+    def _guarded(callback):
+        """logs what a message callback raises, the loop keeps going"""
+        def guarded(client, userdata, msg):
+            try:
+                callback(client, userdata, msg)
+            except Exception:
+                logging.exception(f"failed to handle message on {msg.topic}")
+
+        return guarded
+
     @lazy_property
     def objects(self):
         return ClientHubDevice.objects
 
+    def after_commit(self, error: str, fn, *args):
+        """
+        Runs the redis side effect `fn(proxy, *args)` once the current
+        transaction commits, right away outside of one. Work rolled back
+        (a failed packet of a batch) or retried by `db_resilient` leaves
+        nothing behind in redis.
+        """
+        if self.proxy is None:
+            return
+
+        def run():
+            try:
+                fn(self.proxy, *args)
+            except redis.RedisError as e:
+                logging.error(f"{error}: {e}")
+
+        transaction.on_commit(run)
+
+    def clear_inflight(self, hub_id, cmd: EDCommand):
+        self.after_commit("unable to clear in flight marker", clear_inflight,
+                          hub_id, cmd)
+
+    def update_topology(self, hub_pk, nodes):
+        self.after_commit("unable to update mesh topology", update_topology,
+                          hub_pk, nodes)
+
+    def record_checkin(self, hub: ClientHubDevice):
+        self.after_commit("unable to update fleet aggregates",
+                          fleet.record_checkin, hub.account_id, hub.hub_id,
+                          hub.last_checkin)
+
+    def add_nodes(self, hub: ClientHubDevice, count):
+        self.after_commit("unable to update fleet aggregates", fleet.add_nodes,
+                          hub.account_id, hub.hub_id, count)
+
+    @db_resilient
+    def reconcile_fleet(self):
+        return fleet.reconcile(self.proxy)
+
+    def _reconcile_loop(self):
+        while True:
+            time.sleep(float(CONFIG.fleet.reconcile_interval))
+            if self.proxy is None:
+                continue
+            try:
+                self.reconcile_fleet()
+            except Exception as e:
+                logging.error(f"failed to reconcile fleet aggregates: {e}")
+
+    @lazy_property
+    def _hub_pks(self):
+        """registry of subscribed hubs, hub_id -> pk"""
+        return dict()
+
+    def hub_pk(self, hub_id):
+        """
+        Cached lookup of the database key of a hub by its hub_id,
+        used on hot paths that only need to reference the hub.
+        """
+        hub_id = str(hub_id)
+        if hub_id not in self._hub_pks:
+            pk = self.objects.filter(hub_id=hub_id).values_list(
+                'pk', flat=True).first()
+            if pk is None:
+                return None
+            self.subscribe_hub(hub_id, pk)
+        return self._hub_pks[hub_id]
+
     def clear(self):
-        return [x.delete() for x in self.objects.all()]
+        """deletes every hub, in chunks (see broker.retention)"""
+        from broker.retention import purge_hubs
+        return purge_hubs(self.objects.all(), proxy=self.proxy)
+
+    def subscribe_hub(self, hub_id, pk):
+        """
+        Registers a hub, its messages are routed by `HubDispatchCallback`
+        """
+        self._hub_pks[str(hub_id)] = pk
+
+    def unsubscribe_hub(self, hub_id):
+        self._hub_pks.pop(str(hub_id), None)
 
     def load_subscriptions(self):
+        """
+        Subscribes to every known hub. Uses the registry snapshot when
+        a recent one exists and reconciles with the database in the
+        background, otherwise loads from the database.
+        """
         logging.info("loading subscriptions")
-        for hub in self.objects.all():
-            self.add_subscription(hub.listening_channel,
-                                  callback=DiretMessageCallback)
+        started = time.perf_counter()
+        snapshot_path = Path(CONFIG.manager.snapshot_path)
+
+        hubs = None
+        try:
+            written_at, hubs = read_snapshot(snapshot_path)
+            if time.time() - written_at > float(CONFIG.manager.snapshot_max_age):
+                logging.info("hub registry snapshot too old, ignoring it")
+                hubs = None
+        except FileNotFoundError:
+            pass
+        except SnapshotError as e:
+            logging.error(f"unable to use hub registry snapshot: {e}")
+
+        if hubs is None:
+            self.reconcile_subscriptions()
+            warm = False
+        else:
+            self._hub_pks.update(hubs)
+            warm = True
+
+        logging.info(
+            f"subscribed to {len(self._hub_pks)} hubs in "
+            f"{(time.perf_counter() - started) * 1000:.1f}ms "
+            f"({'snapshot' if warm else 'database'})")
+
+        threading.Thread(target=self._snapshot_loop,
+                         args=(warm, ),
+                         daemon=True,
+                         name="registry-snapshot").start()
+
+    @db_resilient
+    def reconcile_subscriptions(self):
+        """
+        Brings the registry in line with the hubs table,
+        subscribing to new hubs and dropping deleted ones.
+        """
+        hub_id = 'hub_id'
+        if connection.vendor == 'postgresql':
+            # uuid columns as text, parsing every id into an UUID
+            # only to format it again dominates a cold start
+            hub_id = Cast('hub_id', output_field=CharField())
+        hubs = {
+            str(hub_id): pk
+            for hub_id, pk in self.objects.values_list(hub_id, 'pk').iterator(
+                chunk_size=10000)
+        }
+        stale = set(self._hub_pks) - set(hubs)
+        for hub_id in stale:
+            self.unsubscribe_hub(hub_id)
+        for hub_id, pk in hubs.items():
+            self.subscribe_hub(hub_id, pk)
+
+        logging.info(
+            f"reconciled hub registry: {len(hubs)} hubs, {len(stale)} removed")
+
+    def write_snapshot(self):
+        try:
+            write_snapshot(Path(CONFIG.manager.snapshot_path),
+                           dict(self._hub_pks))
+        except OSError as e:
+            logging.error(f"unable to write hub registry snapshot: {e}")
+
+    def _snapshot_loop(self, reconcile):
+        """
+        Rewrites the registry snapshot every `snapshot_interval`. The
+        registry is reconciled with the database first, right away when
+        it was loaded from a snapshot and then every `reconcile_interval`,
+        so hubs deleted or claimed elsewhere don't linger in it.
+        """
+        reconciled_at = None if reconcile else time.monotonic()
+        while True:
+            if reconciled_at is None or time.monotonic() - reconciled_at \
+                    >= float(CONFIG.manager.reconcile_interval):
+                try:
+                    self.reconcile_subscriptions()
+                    reconciled_at = time.monotonic()
+                except Exception as e:
+                    logging.error(f"failed to reconcile hub registry: {e}")
+            self.write_snapshot()
+            time.sleep(float(CONFIG.manager.snapshot_interval))
 
     def send_packet(self, hubs, packet: EDPacket):
         if not is_iter(hubs):
@@ -171,10 +532,16 @@ class ChannelManager(EDClient):
         msg_infos = dict()
         for hub in hubs:
             logging.info(f"sending {packet.command.name} to {hub.hub_id}")
-            msg_info = self.publish(hub.dedicated_channel, packet)
+            msg_info = self.publish_to_hub(hub, packet)
             msg_infos[hub.hub_name] = msg_info
         return msg_infos
 
+    def publish_to_hub(self, hub: ClientHubDevice, packet: EDPacket):
+        if self.publishers is None:
+            return self.publish(hub.dedicated_channel, packet)
+        return self.publishers.publish(hub.hub_id, hub.dedicated_channel,
+                                       packet)
+
     def send_hub_command(self, hubs, cmd: EDCommand):
         if not is_iter(hubs):
             hubs = make_iter(hubs)
@@ -190,6 +557,89 @@ class ChannelManager(EDClient):
         packet = self.create_packet(cmd, payload=None)
         return self.send_packet(hubs, packet)
 
+    @db_resilient
+    def get_hubs(self, **filters):
+        """
+        Fetches hubs, retried on connection errors. Callers that
+        publish should fetch through here rather than retrying
+        themselves, so a reconnect never re-sends a command.
+        """
+        return list(self.objects.filter(**filters))
+
+    def send_scheduled_command(self, hub_pks, cmd: int, chunk_size=None):
+        """
+        Called by the scheduler with the primary keys of every hub
+        due for `cmd`, queued on the scheduled lane in chunks.
+        """
+        cmd = EDCommand(cmd)
+        if chunk_size is None:
+            chunk_size = int(CONFIG.lanes.scheduled_chunk)
+        for i in range(0, len(hub_pks), chunk_size):
+            chunk = hub_pks[i:i + chunk_size]
+            if not self.lanes.put(SCHEDULED, self._send_chunk, chunk, cmd):
+                logging.error(f"scheduled {cmd.name} to {len(chunk)} hubs "
+                              f"dropped, lane full")
+
+    def _send_chunk(self, hub_pks, cmd: EDCommand):
+        hubs = self.get_hubs(pk__in=hub_pks)
+        self.send_hub_command(hubs, cmd)
+
+    @db_resilient
+    def log_stats(self):
+        logging.info(f"db connections: {DB_STATS.describe()}")
+        logging.info(f"telemetry: {self.telemetry.describe()}")
+        logging.info(f"scheduler: {self.scheduler.describe()}")
+        logging.info(f"lanes: {self.lanes.describe()}")
+        if self.publishers is not None:
+            logging.info(f"publishers: {self.publishers.describe()}")
+        if self.proxy is not None:
+            try:
+                logging.info(f"throttled: {throttled_counts(self.proxy)}")
+            except redis.RedisError as e:
+                logging.error(f"unable to read throttled counts: {e}")
+
+    def handle_control(self, data: dict):
+        """
+        Commands addressed to the manager itself, see `send_proxy_control`
+        """
+        control = data['control']
+        if control == 'profile':
+            try:
+                seconds = float(data.get('seconds', 30))
+            except (TypeError, ValueError):
+                logging.error(f"invalid profiling duration: {data}")
+                return
+            if not PROFILER.start(seconds):
+                logging.warning("profiling already running, ignoring request")
+        elif control == 'unsubscribe':
+            # hubs purged by retention, see `broker.retention`
+            hubs = data.get('hubs') or ()
+            for hub_id in hubs:
+                self.unsubscribe_hub(hub_id)
+            logging.info(f"unsubscribed {len(hubs)} purged hubs")
+        else:
+            logging.error(f"unknown control command: {control}")
+
+    def admit(self, hub: ClientHubDevice, cmd: EDCommand) -> bool:
+        """
+        Second check of the rate limits of proxy commands, after the
+        web app's. Commands are let through when redis is unavailable.
+        """
+        if self.proxy is None:
+            return True
+        try:
+            self.limiter.check(self.proxy,
+                               cmd,
+                               account_id=hub.account_id,
+                               hub_id=hub.hub_id)
+        except RateLimited as e:
+            logging.warning(f"not sending to {hub.hub_id}: {e}")
+            self.clear_inflight(hub.hub_id, cmd)
+            return False
+        except redis.RedisError as e:
+            logging.error(f"rate limit check failed: {e}")
+        return True
+
     def handle_proxy_message(self, msg: dict):
         if 'data' not in msg.keys():
             logging.error("Message from proxy server not in correct format")
@@ -200,25 +650,42 @@ class ChannelManager(EDClient):
             logging.error(f"Unable to correctly parse proxy message, {msg}")
             return
 
+        if 'control' in data:
+            self.handle_control(data)
+            return
+
+        lane = data.pop('priority', None) or CONFIG.lanes.default
+        if lane not in LANES:
+            logging.error(f"unknown priority {lane}, using {CONFIG.lanes.default}")
+            lane = CONFIG.lanes.default
+
         # here we assume (not the time to check) each key is a hub_id
         # that has been already registered with databas
-        # the entire payload is the value of each key, simply search for this hub
-        # from database and send it
+        # the entire payload is the value of each key, queued on
+        # its lane and sent from there, see `send_proxy_command`
         for hub_id, payload in data.items():
             try:
                 hub_id = uuid.UUID(hub_id)
+                cmd = EDCommand(int(payload))
             except ValueError as e:
                 logging.error(e)
                 continue
 
-            hub = ClientHubDevice.objects.filter(hub_id=hub_id).first()
-            if not hub:
-                logging.error(
-                    f"No such hub exists in database to send data to, error hub id: {hub_id}"
-                )
-                continue
-            cmd = EDCommand(int(payload))
-            self.send_hub_command(hub, cmd)
+            if not self.lanes.put(lane, self.send_proxy_command, hub_id, cmd):
+                # let the web app retry rather than wait out the window
+                self.clear_inflight(hub_id, cmd)
+
+    def send_proxy_command(self, hub_id: uuid.UUID, cmd: EDCommand):
+        hubs = self.get_hubs(hub_id=hub_id)
+        hub = hubs[0] if hubs else None
+        if not hub:
+            logging.error(
+                f"No such hub exists in database to send data to, error hub id: {hub_id}"
+            )
+            return
+        if not self.admit(hub, cmd):
+            return
+        self.send_hub_command(hub, cmd)
 
 
 if __name__ == "__main__":
@@ -230,9 +697,15 @@ if __name__ == "__main__":
     host = CONFIG.mqtt.host
     port = int(CONFIG.mqtt.port)
     manager = ChannelManager(_MANAGER_ID, host=host, port=port)
+    manager.proxy = rclient
     manager.run()
 
+    next_stats = time.monotonic() + _STATS_INTERVAL
     while True:
+        if time.monotonic() >= next_stats:
+            manager.log_stats()
+            next_stats = time.monotonic() + _STATS_INTERVAL
+
         msg = sub.get_message(timeout=_REDIS_TIMEOUT)
         if not msg:
             continue
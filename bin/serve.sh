@@ -0,0 +1,21 @@
+#!/bin/bash
+# Production launcher: applies the committed migrations, collects (hashed,
+# pre-compressed) static files and serves the ASGI app with a multi-worker
+# gunicorn. Unlike the development entrypoint it does not run the test suite.
+#
+# With several app containers, migrate once per deploy instead: start them
+# with DJANGO_MIGRATE=0 and run `python manage.py migrate --noinput` as a
+# one-off job before they start. A database created by the old
+# `makemigrations` at startup already holds the schema under other
+# migration names, adopt the committed ones once with
+# `python manage.py migrate --fake` after checking the tables match them.
+set -e
+
+cd "$(dirname "$0")/.."
+export DJANGO_SETTINGS_MODULE=${DJANGO_SETTINGS_MODULE:-EagleDaddyCloud.settings_production}
+
+if [ "${DJANGO_MIGRATE:-1}" = "1" ]; then
+    python manage.py migrate --noinput
+fi
+python manage.py collectstatic --noinput -v 0
+exec gunicorn EagleDaddyCloud.asgi:application -c bin/gunicorn.conf.py
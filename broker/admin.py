@@ -1,3 +1,232 @@
+"""
+Admin for the fleet tables, which hold millions of rows.
+
+The stock changelist does not scale to those sizes:
+
+    * it counts the table twice per page with `COUNT(*)`
+    * its pages are `OFFSET`s, deep pages read every row before them
+    * related filters render one choice per account or hub
+    * foreign keys are edited with a select of every hub
+
+Changelists here are ordered by descending primary key and paged by
+keyset: the next page link carries the last primary key shown
+(`?after=<pk>`) and the page is read with `WHERE pk < after LIMIT n`,
+walking the primary key index from where the previous page stopped.
+Row counts are estimates, see `estimated_count`. Filters are date
+ranges over indexed columns and exact match inputs (account username,
+hub id, node address) that resolve to index lookups.
+"""
+
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from broker.models import (ClientHubDevice, CommandDiagnosticsResponse,
+                           NodeModule, address_to_int)
+
+CURSOR_VAR = 'after'
+# results up to this size are counted exactly
+EXACT_COUNT_LIMIT = 10000
+
+
+def _planner_rows(queryset) -> int:
+    """row estimate of the PostgreSQL planner for `queryset`"""
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def estimated_count(queryset, exact_below=EXACT_COUNT_LIMIT) -> int:
+    """
+    Number of rows of `queryset`, exact up to `exact_below` rows
+    (counted with a LIMIT so the count stops there), above that
+    the planner's estimate on PostgreSQL.
+    """
+    queryset = queryset.order_by()
+    count = queryset[:exact_below + 1].count()
+    if count <= exact_below:
+        return count
+
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.count()
+    return max(_planner_rows(queryset), count)
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Changelist paged by primary key, see module docstring.
+    """
+    keyset = True
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR)
+        if self.cursor is not None and not self.cursor.isdigit():
+            raise IncorrectLookupParameters(f"invalid {CURSOR_VAR}")
+        self.next_cursor = None
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # changing filters starts over at the first page
+        remove = list(remove or ()) + [CURSOR_VAR]
+        return super().get_query_string(new_params, remove)
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if self.model_admin.list_defer:
+            queryset = queryset.defer(*self.model_admin.list_defer)
+        return queryset
+
+    def get_results(self, request):
+        page = self.queryset
+        if self.cursor is not None:
+            page = page.filter(pk__lt=int(self.cursor))
+        rows = list(page[:self.list_per_page + 1])
+
+        self.result_list = rows[:self.list_per_page]
+        if len(rows) > self.list_per_page:
+            self.next_cursor = self.result_list[-1].pk
+
+        self.paginator = self.model_admin.get_paginator(
+            request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.count_estimated = self.result_count > EXACT_COUNT_LIMIT
+        self.full_result_count = None
+        self.show_all = False
+        self.can_show_all = False
+        self.multi_page = self.cursor is not None \
+            or self.next_cursor is not None
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string()
+
+    @property
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    Filter taking a typed value, for columns with too many distinct
+    values to list. `queryset` filters on `lookup` = `clean(value)`.
+    """
+    template = 'admin/broker/input_filter.html'
+    lookup = None
+
+    def lookups(self, request, model_admin):
+        # a single placeholder choice, filters without choices are hidden
+        return (('', ''), )
+
+    def clean(self, value):
+        return value
+
+    def choices(self, changelist):
+        all_choice = next(super().choices(changelist))
+        all_choice['query_parts'] = [
+            (k, v) for k, v in changelist.get_filters_params().items()
+            if k != self.parameter_name
+        ]
+        yield all_choice
+
+    def queryset(self, request, queryset):
+        value = (self.value() or '').strip()
+        if not value:
+            return queryset
+        try:
+            return queryset.filter(**{self.lookup: self.clean(value)})
+        except (ValueError, ValidationError) as e:
+            raise IncorrectLookupParameters(e)
+
+
+class AccountFilter(InputFilter):
+    title = 'account username'
+    parameter_name = 'account'
+    lookup = 'account__user__username'
+
+
+class HubFilter(InputFilter):
+    title = 'hub id'
+    parameter_name = 'hub'
+    lookup = 'hub__hub_id'
+
+
+class HubIdFilter(HubFilter):
+    lookup = 'hub_id'
+
+
+class HubAccountFilter(AccountFilter):
+    lookup = 'hub__account__user__username'
+
+
+class AddressFilter(InputFilter):
+    title = 'address (hex)'
+    parameter_name = 'address'
+    lookup = 'address'
+
+    def clean(self, value):
+        return address_to_int(value.lower().zfill(16))
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # ordering is fixed by the keyset
+    sortable_by = ()
+    list_per_page = 50
+    # columns not loaded for the changelist
+    list_defer = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+@admin.register(ClientHubDevice)
+class ClientHubDeviceAdmin(ScalableModelAdmin):
+    list_display = ('hub_name', 'hub_id', 'account_username',
+                    'current_state', 'last_checkin')
+    list_select_related = ('account__user', )
+    list_filter = ('last_checkin', HubIdFilter, AccountFilter)
+    raw_id_fields = ('account', )
+    list_defer = ('connect_passphrase', 'last_message')
+
+    def account_username(self, hub):
+        return hub.account.user.username if hub.account else None
+
+    account_username.short_description = 'account'
+
+
+@admin.register(NodeModule)
+class NodeModuleAdmin(ScalableModelAdmin):
+    list_display = ('node_id', 'address_hex', 'hub', 'last_seen')
+    list_select_related = ('hub', )
+    list_filter = ('last_seen', HubFilter, AddressFilter, HubAccountFilter)
+    raw_id_fields = ('hub', )
+
 
-# Register your models here.
+@admin.register(CommandDiagnosticsResponse)
+class CommandDiagnosticsResponseAdmin(ScalableModelAdmin):
+    list_display = ('id', 'hub', 'updated_at')
+    list_select_related = ('hub', )
+    list_filter = ('updated_at', HubFilter, HubAccountFilter)
+    raw_id_fields = ('hub', )
+    list_defer = ('report', )
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class BrokerConfig(AppConfig):
     name = 'broker'
+
+    def ready(self):
+        from broker.search import create_search_indexes
+        from broker.telemetry import create_telemetry_table
+        post_migrate.connect(create_telemetry_table, sender=self)
+        post_migrate.connect(create_search_indexes, sender=self)
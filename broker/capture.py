@@ -0,0 +1,79 @@
+"""
+Append-only capture files of MQTT traffic, written by
+`bin/mqtt-capture.py record` and played back by its `replay` command.
+
+File layout (little endian):
+
+    header:  magic b"EDCAP" | version u8 | started_at f64
+    records: offset f64 | qos u8 | topic length u16 | payload length u32
+             | topic (utf-8) | payload
+
+`offset` is seconds since `started_at`. Records are appended as they
+arrive, a capture cut short (killed recorder) stays readable up to its
+last complete record.
+"""
+
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+_MAGIC = b"EDCAP"
+_VERSION = 1
+_HEADER = struct.Struct("<5sBd")
+_RECORD = struct.Struct("<dBHI")
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CapturedMessage(NamedTuple):
+    offset: float
+    qos: int
+    topic: str
+    payload: bytes
+
+
+class CaptureWriter:
+    def __init__(self, path: Path, flush_every=100):
+        self.path = Path(path)
+        self.started_at = time.time()
+        self.count = 0
+        self.flush_every = flush_every
+        self._file = open(self.path, 'wb')
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, self.started_at))
+
+    def write(self, topic: str, payload: bytes, qos: int, timestamp=None):
+        topic = topic.encode('utf-8')
+        offset = (timestamp or time.time()) - self.started_at
+        self._file.write(
+            _RECORD.pack(offset, qos, len(topic), len(payload)) + topic +
+            payload)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path: Path) -> Iterator[CapturedMessage]:
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise CaptureError(f"{path} is not a capture file")
+        magic, version, _ = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION:
+            raise CaptureError(f"{path} is not a v{_VERSION} capture file")
+
+        while True:
+            raw = f.read(_RECORD.size)
+            if len(raw) < _RECORD.size:
+                return
+            offset, qos, topic_len, payload_len = _RECORD.unpack(raw)
+            body = f.read(topic_len + payload_len)
+            if len(body) < topic_len + payload_len:
+                return  # truncated last record
+            yield CapturedMessage(offset, qos, body[:topic_len].decode('utf-8'),
+                                  body[topic_len:])
@@ -0,0 +1,207 @@
+"""
+Database connection management for long running workers.
+
+Django opens one connection per thread and, outside the request cycle,
+never checks or recycles it. The MQTT manager makes ORM calls from
+paho's network thread, the redis loop, the scheduler and the telemetry
+writer for days at a time, so a restarted postgres (or a connection
+dropped by pgbouncer/a firewall) would otherwise leave a dead
+connection behind that fails every callback after it.
+
+`db_resilient` wraps a unit of database work:
+    * before running, connections past CONN_MAX_AGE or flagged with
+      errors are closed (`close_old_connections`), and a connection idle
+      for longer than `health_check_interval` is pinged and replaced if
+      it is no longer usable.
+    * if the work fails with a connection level error, the connection is
+      dropped and the work retried with exponential backoff, up to
+      `retries` times.
+
+Work on paho's network thread (the MQTT callbacks) must not sleep, a
+backoff there stalls every inbound message. With `defer=True` the
+caller returns right away after a failure and the retries are run by a
+background thread (`RETRIES`) once their backoff is over, at most
+`max_deferred` of them are held at a time.
+
+Set DJANGO_CONN_MAX_AGE to keep connections open across calls, and
+DATABASE_PGBOUNCER=1 when connecting through pgbouncer in transaction
+pooling mode.
+"""
+
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS, InterfaceError, OperationalError, close_old_connections, connections
+from django.db.backends.signals import connection_created
+
+from EagleDaddyCloud.settings import CONFIG
+
+
+class ConnectionStats:
+    """counters describing connection churn, shared by every thread"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.health_closed = 0
+        self.retries = 0
+        self.failures = 0
+
+    def incr(self, counter, n=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def describe(self):
+        return {
+            'opened': self.opened,
+            'health_closed': self.health_closed,
+            'retries': self.retries,
+            'failures': self.failures,
+        }
+
+
+STATS = ConnectionStats()
+
+_local = threading.local()
+
+
+def _count_opened(sender, connection, **kwargs):
+    STATS.incr('opened')
+
+
+connection_created.connect(_count_opened,
+                           dispatch_uid="broker.db.count_opened")
+
+
+def ensure_healthy_connection(using=DEFAULT_DB_ALIAS,
+                              check_interval=None):
+    """
+    Drops this thread's connection if it is expired, errored,
+    or (checked at most every `check_interval` seconds) unusable.
+    """
+    if check_interval is None:
+        check_interval = float(CONFIG.database.health_check_interval)
+
+    conn = connections[using]
+    if conn.in_atomic_block:
+        # nested in a transaction, which owns the connection. Django
+        # would take its disabled autocommit as a reason to close it
+        return
+
+    close_old_connections()
+    if conn.connection is None:
+        return
+
+    now = time.monotonic()
+    last_checked = getattr(_local, 'last_checked', 0)
+    if now - last_checked < check_interval:
+        return
+
+    _local.last_checked = now
+    if not conn.is_usable():
+        logging.warning("database connection is no longer usable, dropping it")
+        conn.close()
+        STATS.incr('health_closed')
+
+
+class DeferredRetries(threading.Thread):
+    """runs the retries of `db_resilient(defer=True)` work once due"""
+    def __init__(self):
+        super().__init__(daemon=True, name="db-retries")
+        self._due = list()  # heap of (due at, sequence, fn)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, wait, fn) -> bool:
+        """runs `fn` in `wait` seconds, False when too many are held"""
+        with self._cond:
+            if len(self._due) >= int(CONFIG.database.max_deferred):
+                return False
+            if not self.is_alive():
+                self.start()
+            heapq.heappush(self._due,
+                           (time.monotonic() + wait, next(self._sequence), fn))
+            self._cond.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._cond.wait(self._due[0][0] - time.monotonic()
+                                    if self._due else None)
+                _, _, fn = heapq.heappop(self._due)
+            try:
+                fn()
+            except (OperationalError, InterfaceError):
+                pass  # out of retries, logged by `db_resilient`
+            except Exception as e:
+                logging.error(f"deferred database work failed: {e}")
+
+
+RETRIES = DeferredRetries()
+
+
+def db_resilient(func=None, retries=None, backoff=None,
+                 using=DEFAULT_DB_ALIAS, defer=False):
+    """
+    Decorator running `func` on a healthy connection and retrying it
+    on connection errors, see module docstring. With `defer` the
+    retries run in the background and the call returns None.
+    """
+    if func is None:
+        return functools.partial(db_resilient,
+                                 retries=retries,
+                                 backoff=backoff,
+                                 using=using,
+                                 defer=defer)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return _attempt(0, args, kwargs)
+
+    def _attempt(first, args, kwargs):
+        attempts = int(CONFIG.database.retries if retries is None else retries)
+        delay = float(CONFIG.database.retry_backoff if backoff is None else backoff)
+
+        for attempt in range(first, attempts + 1):
+            ensure_healthy_connection(using)
+            try:
+                return func(*args, **kwargs)
+            except (OperationalError, InterfaceError) as e:
+                conn = connections[using]
+                if conn.in_atomic_block:
+                    # the enclosing transaction owns the connection
+                    raise
+
+                conn.close()
+                if attempt == attempts:
+                    STATS.incr('failures')
+                    logging.error(
+                        f"{func.__qualname__} failed after {attempts} reconnects: {e}"
+                    )
+                    raise
+
+                STATS.incr('retries')
+                wait = delay * 2**attempt
+                logging.warning(
+                    f"database error in {func.__qualname__}, reconnecting in {wait}s: {e}"
+                )
+                if not defer:
+                    time.sleep(wait)
+                    continue
+
+                retry = functools.partial(_attempt, attempt + 1, args, kwargs)
+                if not RETRIES.schedule(wait, retry):
+                    STATS.incr('failures')
+                    logging.error(f"{func.__qualname__} dropped, "
+                                  f"{len(RETRIES)} retries already waiting")
+                return None
+
+    return wrapper
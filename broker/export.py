@@ -0,0 +1,125 @@
+"""
+Streaming export of fleet data.
+
+Rows are read with server side cursors (`QuerySet.iterator`) and
+encoded one at a time, so exports run in constant memory no matter
+how large the tables are. Used by the dashboard export endpoint and
+the `export_fleet` management command.
+"""
+
+import csv
+import json
+import zlib
+from typing import Iterable, Iterator
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router
+
+from broker.models import ClientHubDevice, CommandDiagnosticsResponse, NodeModule, address_to_hex
+
+CHUNK_SIZE = 2000
+
+CSV = "csv"
+NDJSON = "ndjson"
+FORMATS = (CSV, NDJSON)
+
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    NDJSON: "application/x-ndjson",
+}
+
+# dataset name -> (model, exported fields), `hub__hub_id` keeps rows
+# joinable across datasets without exposing internal primary keys
+DATASETS = {
+    'hubs': (ClientHubDevice, ('hub_id', 'hub_name', 'last_checkin',
+                               'current_state', 'last_message')),
+    'nodes': (NodeModule, ('hub__hub_id', 'address', 'hub_node_id',
+                           'node_id', 'operating_mode', 'network_id')),
+    'diagnostics': (CommandDiagnosticsResponse, ('hub__hub_id', 'report')),
+}
+
+
+# per dataset field converters from storage to export representation
+TRANSFORMS = {
+    'nodes': {
+        'address': address_to_hex,
+        'hub_node_id': address_to_hex,
+    },
+}
+
+
+class _Echo:
+    """file-like object whose write just returns the value"""
+    def write(self, value):
+        return value
+
+
+def dataset_rows(dataset: str, account, chunk_size=CHUNK_SIZE) -> Iterator[tuple]:
+    """
+    Iterates over the rows of `dataset` belonging to `account`.
+
+    The database is picked by the router when called, the rows are only
+    read as the iterator is consumed: by a streaming response, after
+    the request's routing (see `broker.routers`) has ended.
+    """
+    model, fields = DATASETS[dataset]
+    account_field = 'account' if model is ClientHubDevice else 'hub__account'
+    queryset = model.objects.using(router.db_for_read(model)).filter(**{
+        account_field: account
+    }).order_by('pk').values_list(*fields)
+    rows = queryset.iterator(chunk_size=chunk_size)
+
+    transforms = TRANSFORMS.get(dataset)
+    if not transforms:
+        return rows
+
+    converters = [transforms.get(field) for field in fields]
+    return (tuple(v if fn is None or v is None else fn(v)
+                  for fn, v in zip(converters, row)) for row in rows)
+
+
+def encode_csv(fields: Iterable[str], rows: Iterable[tuple]) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([
+            json.dumps(v, cls=DjangoJSONEncoder) if isinstance(v, (dict, list))
+            else v for v in row
+        ])
+
+
+def encode_ndjson(fields: Iterable[str], rows: Iterable[tuple]) -> Iterator[str]:
+    fields = tuple(fields)
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + "\n"
+
+
+def gzip_stream(chunks: Iterable[str], level=6) -> Iterator[bytes]:
+    """gzip encodes a stream of text chunks incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(dataset: str, account, fmt=CSV, compress=False,
+           chunk_size=CHUNK_SIZE):
+    """
+    Returns an iterator of encoded chunks for `dataset`, bytes
+    if `compress` otherwise str.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"unknown dataset: {dataset}")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format: {fmt}")
+
+    fields = DATASETS[dataset][1]
+    encoder = encode_csv if fmt == CSV else encode_ndjson
+    chunks = encoder(fields, dataset_rows(dataset, account, chunk_size))
+    return gzip_stream(chunks) if compress else chunks
+
+
+def export_filename(dataset: str, fmt=CSV, compress=False):
+    return f"{dataset}.{fmt}" + (".gz" if compress else "")
@@ -0,0 +1,240 @@
+"""
+Per-account fleet aggregates for the dashboard: number of hubs, hubs
+online, newest check-in and nodes per hub, kept in redis:
+
+    <proxy channel>/fleet/<account>/checkins  sorted set, hub_id -> last
+                                              check-in (unix time)
+    <proxy channel>/fleet/<account>/nodes     hash, hub_id -> node count,
+                                              plus `total`
+
+A hub is online when it checked in within `online_window` seconds,
+counted with a range query on the sorted set, so hubs go offline
+without anything being written. A summary is read with one round trip
+whatever the size of the fleet.
+
+The manager keeps the aggregates up to date as it handles check-ins
+and discoveries, the dashboard as it removes nodes. Updates apply only
+to accounts whose aggregates exist (the `nodes` hash always does once
+they are built). A hub changing account drops the keys of both
+accounts instead. Missing aggregates are built from the database on
+the next read.
+
+`reconcile` rebuilds the aggregates of every account from the database
+to correct drift, ie: counts of a batch that was rolled back after the
+update. It runs periodically in the manager, after retention purges
+and from the `reconcile_fleet` management command.
+"""
+
+import logging
+import time
+from datetime import datetime, timezone
+from itertools import islice
+
+import redis
+from django.db.models import Count
+from redis.commands.core import Script
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.models import ClientHubDevice, NodeModule
+
+_TOTAL = 'total'
+_WATCH_RETRIES = 5
+
+# KEYS: checkins, nodes  ARGV: hub_id, check-in time
+_CHECKIN = Script(
+    None, b"""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+end
+""")
+
+# KEYS: nodes  ARGV: hub_id, change of the node count
+_ADD_NODES = Script(
+    None, b"""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('HINCRBY', KEYS[1], 'total', ARGV[2])
+end
+""")
+
+
+def checkins_key(account_id) -> str:
+    return f"{CONFIG.proxy.channel}/fleet/{account_id}/checkins"
+
+
+def nodes_key(account_id) -> str:
+    return f"{CONFIG.proxy.channel}/fleet/{account_id}/nodes"
+
+
+def record_checkin(proxy: redis.Redis, account_id, hub_id, when: datetime):
+    if account_id is None:
+        return
+    _CHECKIN([checkins_key(account_id), nodes_key(account_id)],
+             [str(hub_id), when.timestamp()],
+             client=proxy)
+
+
+def add_nodes(proxy: redis.Redis, account_id, hub_id, count: int):
+    """`count` nodes were added to (or removed from, if negative) a hub"""
+    if account_id is None or not count:
+        return
+    _ADD_NODES([nodes_key(account_id)], [str(hub_id), count], client=proxy)
+
+
+def invalidate(proxy: redis.Redis, *account_ids):
+    """drops the aggregates of accounts, rebuilt on the next read"""
+    keys = [
+        key for account_id in account_ids if account_id is not None
+        for key in (checkins_key(account_id), nodes_key(account_id))
+    ]
+    if keys:
+        proxy.delete(*keys)
+
+
+def _write(pipe, account_id, hubs, node_counts):
+    """
+    queues the replacement of an account's aggregates, `hubs` are
+    (hub pk, hub_id, last_checkin) rows, `node_counts` hub pk -> count
+    """
+    checkins = {str(hub_id): checkin.timestamp() for _, hub_id, checkin in hubs}
+    nodes = {str(hub_id): node_counts.get(pk, 0) for pk, hub_id, _ in hubs}
+    nodes[_TOTAL] = sum(nodes.values())
+
+    pipe.delete(checkins_key(account_id), nodes_key(account_id))
+    if checkins:
+        pipe.zadd(checkins_key(account_id), checkins)
+    pipe.hset(nodes_key(account_id), mapping=nodes)
+
+
+def rebuild_account(proxy: redis.Redis, account_id):
+    hubs = list(
+        ClientHubDevice.objects.filter(account_id=account_id).values_list(
+            'pk', 'hub_id', 'last_checkin'))
+    node_counts = dict(
+        NodeModule.objects.filter(hub__account_id=account_id).values_list(
+            'hub_id').annotate(Count('pk')).order_by())
+    with proxy.pipeline() as pipe:
+        _write(pipe, account_id, hubs, node_counts)
+        pipe.execute()
+
+
+def fleet_summary(proxy: redis.Redis, account_id, online_window=None) -> dict:
+    if online_window is None:
+        online_window = float(CONFIG.fleet.online_window)
+
+    def read():
+        with proxy.pipeline(transaction=False) as pipe:
+            pipe.hgetall(nodes_key(account_id))
+            pipe.zcard(checkins_key(account_id))
+            pipe.zcount(checkins_key(account_id), time.time() - online_window,
+                        '+inf')
+            pipe.zrevrange(checkins_key(account_id), 0, 0, withscores=True)
+            return pipe.execute()
+
+    nodes, hubs, online, newest = read()
+    if not nodes:
+        rebuild_account(proxy, account_id)
+        nodes, hubs, online, newest = read()
+
+    nodes = {k.decode(): int(v) for k, v in nodes.items()}
+    total = nodes.pop(_TOTAL, 0)
+    return {
+        'hubs': hubs,
+        'online': online,
+        'last_checkin': datetime.fromtimestamp(newest[0][1], timezone.utc)
+        if newest else None,
+        'nodes': total,
+        'nodes_per_hub': nodes,
+    }
+
+
+def _reconcile_chunk(proxy: redis.Redis, account_ids) -> int:
+    """
+    Rebuilds the aggregates of `account_ids` from rows read right
+    before writing. Their node counts are read with the `nodes` hashes
+    watched: an update applied meanwhile (for a commit the read may not
+    have seen) fails the write and the chunk is read again, rather than
+    being overwritten by counts read before it. Check-ins aren't
+    watched, one landing in between is off by a check-in interval.
+
+    Returns the number of accounts whose hub or node count had drifted.
+    """
+    keys = [nodes_key(account_id) for account_id in account_ids]
+    with proxy.pipeline() as pipe:
+        for _ in range(_WATCH_RETRIES):
+            try:
+                pipe.watch(*keys)
+                with proxy.pipeline(transaction=False) as read:
+                    for account_id in account_ids:
+                        read.zcard(checkins_key(account_id))
+                        read.hget(nodes_key(account_id), _TOTAL)
+                    before = read.execute()
+                hubs = {account_id: list() for account_id in account_ids}
+                for account_id, *row in ClientHubDevice.objects.filter(
+                        account_id__in=account_ids).values_list(
+                            'account_id', 'pk', 'hub_id', 'last_checkin'):
+                    hubs[account_id].append(row)
+                node_counts = dict(
+                    NodeModule.objects.filter(
+                        hub__account_id__in=account_ids).values_list(
+                            'hub_id').annotate(Count('pk')).order_by())
+
+                pipe.multi()
+                for account_id, rows in hubs.items():
+                    _write(pipe, account_id, rows, node_counts)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+        else:
+            # busy accounts, built on their next read instead
+            logging.warning(f"{len(account_ids)} accounts changed while "
+                            f"reconciling, dropping their aggregates")
+            invalidate(proxy, *account_ids)
+            return 0
+
+    drifted = 0
+    for i, rows in enumerate(hubs.values()):
+        hub_count, node_total = before[2 * i:2 * i + 2]
+        expected = sum(node_counts.get(pk, 0) for pk, _, _ in rows)
+        if node_total is not None and \
+                (hub_count != len(rows) or int(node_total) != expected):
+            drifted += 1
+    return drifted
+
+
+def reconcile(proxy: redis.Redis, chunk_size=500) -> dict:
+    """
+    Rebuilds the aggregates of every account from the database, in
+    chunks of `chunk_size` accounts, and drops those of accounts
+    without hubs.
+
+    Returns the number of accounts rebuilt, of accounts whose hub or
+    node count had drifted, and of dropped accounts.
+    """
+    started = time.perf_counter()
+    accounts = ClientHubDevice.objects.filter(
+        account__isnull=False).order_by('account_id').values_list(
+            'account_id', flat=True).distinct().iterator()
+
+    rebuilt = set()
+    drifted = 0
+    chunk = list(islice(accounts, chunk_size))
+    while chunk:
+        drifted += _reconcile_chunk(proxy, chunk)
+        rebuilt.update(chunk)
+        chunk = list(islice(accounts, chunk_size))
+
+    dropped = 0
+    pattern = nodes_key('*')
+    prefix, suffix = pattern.split('*')
+    for key in proxy.scan_iter(match=pattern, count=1000):
+        account_id = key.decode()[len(prefix):-len(suffix)]
+        if not account_id.isdigit() or int(account_id) not in rebuilt:
+            invalidate(proxy, account_id)
+            dropped += 1
+
+    result = {'accounts': len(rebuilt), 'drifted': drifted, 'dropped': dropped}
+    logging.info(f"reconciled fleet aggregates: {result} in "
+                 f"{time.perf_counter() - started:.1f}s")
+    return result
@@ -0,0 +1,149 @@
+"""
+Priority lanes for the hub commands sent by the MQTT manager.
+
+Commands used to be sent in the order they arrived, a fleet wide sweep
+queued ahead of a user's click made the click wait for thousands of
+bulk commands. Commands are now queued by class:
+
+    interactive  a user waiting on the dashboard
+    scheduled    due command schedules (see `broker.scheduler`)
+    bulk         sweeps and scripted commands, ie: a discovery of
+                 every hub of an account
+
+Each lane is a bounded FIFO, work that does not fit is dropped and
+counted. A single worker thread takes the lanes' work by smooth
+weighted round robin: with weights 8/2/1 a busy interactive lane gets
+8 of every 11 sends, but it never starves the others, and a lane
+without work gives its share to the ones that have some. Work items
+are kept small (one hub, or a chunk of scheduled hubs) so an
+interactive command waits for at most one item already being sent.
+
+Per lane depth, counts and wait times (enqueue to start) are reported
+by `describe`.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from broker.profiling import Histogram
+
+INTERACTIVE = 'interactive'
+SCHEDULED = 'scheduled'
+BULK = 'bulk'
+LANES = (INTERACTIVE, SCHEDULED, BULK)
+
+
+class _Lane:
+    __slots__ = ('name', 'weight', 'max_depth', 'queue', 'current',
+                 'enqueued', 'processed', 'dropped', 'failed', 'max_wait',
+                 'wait')
+
+    def __init__(self, name, weight, max_depth):
+        self.name = name
+        self.weight = weight
+        self.max_depth = max_depth
+        self.queue = deque()  # (enqueued at, fn, args)
+        self.current = 0  # round robin credit
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_wait = 0.0
+        self.wait = Histogram()
+
+    def describe(self):
+        return {
+            'depth': len(self.queue),
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+            'wait': self.wait.describe(),
+        }
+
+
+class CommandLanes(threading.Thread):
+    """
+    Bounded per class queues of work, run by weighted round robin.
+
+    Args:
+        weights (dict): lane -> share of the sends when lanes compete
+        max_depth (dict): lane -> number of queued items it holds
+    """
+    def __init__(self, weights, max_depth):
+        super().__init__(daemon=True, name="command-lanes")
+        self._lanes = {
+            name: _Lane(name, int(weights[name]), int(max_depth[name]))
+            for name in LANES
+        }
+        self._ready = threading.Condition()
+        self._stopped = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.weights, config.max_depth)
+
+    def __len__(self):
+        return sum(len(lane.queue) for lane in self._lanes.values())
+
+    def put(self, lane: str, fn, *args) -> bool:
+        """
+        Queues `fn(*args)` on `lane`, returns False when the lane
+        is full and the work was dropped.
+        """
+        lane = self._lanes[lane]
+        with self._ready:
+            if len(lane.queue) >= lane.max_depth:
+                lane.dropped += 1
+                if lane.dropped & (lane.dropped - 1) == 0:
+                    # powers of two, a flood doesn't flood the log
+                    logging.warning(f"{lane.name} lane full, "
+                                    f"dropped {lane.dropped} items so far")
+                return False
+            lane.queue.append((time.monotonic(), fn, args))
+            lane.enqueued += 1
+            self._ready.notify()
+        return True
+
+    def stop(self):
+        with self._ready:
+            self._stopped = True
+            self._ready.notify()
+
+    def _next(self):
+        """
+        Smooth weighted round robin over the lanes with work: every
+        lane gains its weight, the richest is picked and pays the
+        total. Called with the lock held and at least one item queued.
+        """
+        busy = [lane for lane in self._lanes.values() if lane.queue]
+        for lane in busy:
+            lane.current += lane.weight
+        picked = max(busy, key=lambda lane: lane.current)
+        picked.current -= sum(lane.weight for lane in busy)
+        return picked, picked.queue.popleft()
+
+    def run(self):
+        while True:
+            with self._ready:
+                while not len(self) and not self._stopped:
+                    self._ready.wait()
+                if self._stopped:
+                    return
+                lane, (enqueued_at, fn, args) = self._next()
+
+            waited = time.monotonic() - enqueued_at
+            lane.wait.add(waited)
+            lane.max_wait = max(lane.max_wait, waited)
+            try:
+                fn(*args)
+            except Exception as e:
+                lane.failed += 1
+                logging.error(f"{lane.name} command failed: {e}")
+            lane.processed += 1
+
+    def describe(self):
+        return {name: lane.describe() for name, lane in self._lanes.items()}
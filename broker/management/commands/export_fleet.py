@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ClientAccount.models import ClientAccount
+from broker import export
+
+
+class Command(BaseCommand):
+    help = "Stream hub, node or diagnostics data of an account as csv or ndjson"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(export.DATASETS))
+        parser.add_argument('--account',
+                            required=True,
+                            help="username of the account owner")
+        parser.add_argument('--format',
+                            choices=export.FORMATS,
+                            default=export.CSV)
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=export.CHUNK_SIZE)
+        parser.add_argument('--output',
+                            '-o',
+                            help="file to write to, defaults to stdout")
+
+    def handle(self, *args, **options):
+        account = ClientAccount.objects.filter(
+            user__username=options['account']).first()
+        if not account:
+            raise CommandError(f"no such account: {options['account']}")
+
+        chunks = export.export(options['dataset'],
+                               account,
+                               fmt=options['format'],
+                               compress=options['gzip'],
+                               chunk_size=options['chunk_size'])
+
+        if options['output']:
+            mode, newline = ('wb', None) if options['gzip'] else ('w', '')
+            with open(options['output'], mode, newline=newline) as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            return
+
+        out = sys.stdout.buffer if options['gzip'] else sys.stdout
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
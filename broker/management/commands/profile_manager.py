@@ -0,0 +1,24 @@
+import redis
+from django.core.management.base import BaseCommand, CommandError
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.utils import send_proxy_control
+
+
+class Command(BaseCommand):
+    help = "Profile the running MQTT manager for a number of seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=30)
+
+    def handle(self, *args, **options):
+        pool = redis.ConnectionPool(host=CONFIG.proxy.host,
+                                    port=int(CONFIG.proxy.port))
+        receivers = send_proxy_control(pool,
+                                       'profile',
+                                       seconds=options['seconds'])
+        if not receivers:
+            raise CommandError("no manager is listening on the proxy channel")
+        self.stdout.write(
+            f"profiling for {options['seconds']}s, the manager writes the "
+            f"results to {CONFIG.profiling.output_dir}/")
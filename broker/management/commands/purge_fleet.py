@@ -0,0 +1,59 @@
+import redis
+from django.core.management.base import BaseCommand
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.fleet import reconcile
+from broker.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = "Delete stale hubs, nodes and diagnostics (retention in config.yml)"
+
+    def add_arguments(self, parser):
+        config = CONFIG.retention
+        parser.add_argument('--hub-days', type=int, default=int(config.hub_days))
+        parser.add_argument('--node-days', type=int, default=int(config.node_days))
+        parser.add_argument('--diagnostics-days',
+                            type=int,
+                            default=int(config.diagnostics_days))
+        parser.add_argument('--only',
+                            choices=('hubs', 'nodes', 'diagnostics'),
+                            help="run a single job")
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=int(config.chunk_size))
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help="count what would be deleted")
+
+    def handle(self, *args, **options):
+        days = {
+            'hubs': options['hub_days'],
+            'nodes': options['node_days'],
+            'diagnostics': options['diagnostics_days'],
+        }
+        if options['only']:
+            days = {k: v if k == options['only'] else None for k, v in days.items()}
+
+        def progress(counts):
+            self.stdout.write(f"\r{dict(counts)}", ending='')
+            self.stdout.flush()
+
+        # connects lazily, purges go on if redis is down
+        with redis.Redis(host=CONFIG.proxy.host,
+                         port=int(CONFIG.proxy.port)) as proxy:
+            deleted = apply_retention(hub_days=days['hubs'],
+                                      node_days=days['nodes'],
+                                      diagnostics_days=days['diagnostics'],
+                                      chunk_size=options['chunk_size'],
+                                      progress=progress,
+                                      dry_run=options['dry_run'],
+                                      proxy=proxy)
+            verb = "would delete" if options['dry_run'] else "deleted"
+            self.stdout.write(f"\n{verb} {dict(deleted) or 'nothing'}")
+
+            if deleted and not options['dry_run']:
+                try:
+                    reconcile(proxy)
+                except redis.RedisError as e:
+                    self.stderr.write(f"unable to update fleet aggregates: {e}")
@@ -0,0 +1,17 @@
+import redis
+from django.core.management.base import BaseCommand
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.fleet import reconcile
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-account fleet aggregates from the database"
+
+    def handle(self, *args, **options):
+        with redis.Redis(host=CONFIG.proxy.host,
+                         port=int(CONFIG.proxy.port)) as proxy:
+            result = reconcile(proxy)
+        self.stdout.write(f"rebuilt {result['accounts']} accounts, "
+                          f"{result['drifted']} had drifted, "
+                          f"{result['dropped']} dropped")
@@ -0,0 +1,59 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('ClientAccount', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientHubDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('connect_passphrase', models.CharField(max_length=1028)),
+                ('last_checkin', models.DateTimeField(default=django.utils.timezone.now)),
+                ('hub_name', models.CharField(max_length=128, null=True)),
+                ('hub_id', models.UUIDField()),
+                ('current_state', models.CharField(default='', max_length=32)),
+                ('last_message', models.CharField(max_length=2048, null=True)),
+                ('account', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='account', to='ClientAccount.clientaccount')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NodeModule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=16)),
+                ('hub_node_id', models.CharField(max_length=16)),
+                ('node_id', models.CharField(max_length=512)),
+                ('operating_mode', models.CharField(max_length=512)),
+                ('network_id', models.CharField(max_length=512)),
+                ('hub', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='node', to='broker.clienthubdevice')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommandResponseFlag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('discover_ready', models.BooleanField(default=False)),
+                ('diagnostic_ready', models.BooleanField(default=False)),
+                ('hub', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='broker.clienthubdevice')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommandDiagnosticsResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report', models.JSONField()),
+                ('hub', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='broker.clienthubdevice')),
+            ],
+        ),
+    ]
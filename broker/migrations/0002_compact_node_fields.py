@@ -0,0 +1,101 @@
+"""
+Node addresses as bigints and the mode/network id as smallints (see
+`broker.models.address_to_int`). Existing rows hold hex strings, which
+the database can't cast, so the values are converted in python into
+new columns that then replace the text ones. Nodes whose values don't
+convert are deleted, they come back with the hub's next discovery.
+"""
+
+from django.db import migrations, models
+
+from broker.models import address_to_hex, address_to_int, hex_to_int
+
+_CHUNK_SIZE = 2000
+_FIELDS = ('address', 'hub_node_id', 'operating_mode', 'network_id')
+
+
+def _convert(apps, convert, read, write):
+    """`convert` every node, from fields `read` into fields `write`"""
+    NodeModule = apps.get_model('broker', 'NodeModule')
+    nodes = NodeModule.objects.only('pk', *read).order_by('pk')
+
+    converted, invalid = list(), list()
+    for node in nodes.iterator(chunk_size=_CHUNK_SIZE):
+        try:
+            convert(node)
+        except (TypeError, ValueError, OverflowError):
+            invalid.append(node.pk)
+            continue
+        converted.append(node)
+        if len(converted) == _CHUNK_SIZE:
+            NodeModule.objects.bulk_update(converted, write)
+            converted = list()
+    if converted:
+        NodeModule.objects.bulk_update(converted, write)
+
+    for i in range(0, len(invalid), _CHUNK_SIZE):
+        NodeModule.objects.filter(pk__in=invalid[i:i + _CHUNK_SIZE]).delete()
+    if invalid:
+        print(f"\n  deleted {len(invalid)} nodes with invalid addresses")
+
+
+def to_int(apps, schema_editor):
+    def convert(node):
+        node.address_new = address_to_int(node.address)
+        node.hub_node_id_new = address_to_int(node.hub_node_id)
+        node.operating_mode_new = hex_to_int(node.operating_mode)
+        node.network_id_new = hex_to_int(node.network_id)
+
+    _convert(apps, convert, _FIELDS, [f"{f}_new" for f in _FIELDS])
+
+
+def to_hex(apps, schema_editor):
+    def convert(node):
+        node.address = address_to_hex(node.address_new)
+        node.hub_node_id = address_to_hex(node.hub_node_id_new)
+        node.operating_mode = f"{node.operating_mode_new:02x}"
+        node.network_id = f"{node.network_id_new:04x}"
+
+    _convert(apps, convert, [f"{f}_new" for f in _FIELDS], _FIELDS)
+
+
+def _swap(fields):
+    """replaces each field with its converted `<name>_new` column"""
+    operations = list()
+    for name, field in fields:
+        operations += [
+            migrations.RemoveField('nodemodule', name),
+            migrations.RenameField('nodemodule', f"{name}_new", name),
+            migrations.AlterField('nodemodule', name, field),
+        ]
+    return operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broker', '0001_initial'),
+    ]
+
+    operations = [
+        # only so the text columns can be added back on a reverse
+        *(migrations.AlterField('nodemodule', name,
+                                models.CharField(max_length=length, default=''))
+          for name, length in (('address', 16), ('hub_node_id', 16),
+                               ('operating_mode', 512), ('network_id', 512))),
+        migrations.AddField('nodemodule', 'address_new',
+                            models.BigIntegerField(null=True)),
+        migrations.AddField('nodemodule', 'hub_node_id_new',
+                            models.BigIntegerField(null=True)),
+        migrations.AddField('nodemodule', 'operating_mode_new',
+                            models.PositiveSmallIntegerField(null=True)),
+        migrations.AddField('nodemodule', 'network_id_new',
+                            models.PositiveSmallIntegerField(null=True)),
+        migrations.RunPython(to_int, to_hex),
+        *_swap((
+            ('address', models.BigIntegerField()),
+            ('hub_node_id', models.BigIntegerField()),
+            ('operating_mode', models.PositiveSmallIntegerField()),
+            ('network_id', models.PositiveSmallIntegerField()),
+        )),
+    ]
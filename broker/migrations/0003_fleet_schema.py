@@ -0,0 +1,76 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broker', '0002_compact_node_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeTelemetry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('address', models.CharField(max_length=16)),
+                ('kind', models.CharField(max_length=32)),
+                ('value', models.FloatField(null=True)),
+                ('recorded_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'broker_nodetelemetry',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ScheduledCommand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.SmallIntegerField()),
+                ('interval', models.PositiveIntegerField()),
+                ('jitter', models.PositiveIntegerField(default=0)),
+                ('on_missed', models.CharField(choices=[('run_once', 'Run once'), ('skip', 'Skip')], default='run_once', max_length=16)),
+                ('enabled', models.BooleanField(default=True)),
+                ('last_run', models.DateTimeField(null=True)),
+                ('next_run', models.DateTimeField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='commanddiagnosticsresponse',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='nodemodule',
+            name='last_seen',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='clienthubdevice',
+            name='hub_id',
+            field=models.UUIDField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='clienthubdevice',
+            name='last_checkin',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='nodemodule',
+            index=models.Index(fields=['hub', 'address'], name='broker_node_hub_id_fdb359_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='nodemodule',
+            index=models.Index(fields=['address'], name='broker_node_address_c02e45_idx'),
+        ),
+        migrations.AddField(
+            model_name='scheduledcommand',
+            name='hub',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='broker.clienthubdevice'),
+        ),
+    ]
@@ -7,6 +7,38 @@ from EagleDaddyCloud.settings import CONFIG
 from ClientAccount.models import ClientAccount
 
 
+def address_to_int(value) -> int:
+    """
+    64 bit DigiMesh address, as hex string or raw bytes, to the
+    signed integer stored in the database (two's complement so
+    the full unsigned range fits a bigint).
+
+    Raises ValueError unless the address is exactly 8 bytes.
+    """
+    if isinstance(value, str):
+        value = bytes.fromhex(value)
+    if len(value) != 8:
+        raise ValueError(f"64 bit address expected, got {len(value)} bytes")
+    return int.from_bytes(value, 'big', signed=True)
+
+
+def address_to_hex(value: int) -> str:
+    return value.to_bytes(8, 'big', signed=True).hex()
+
+
+def hex_to_int(value) -> int:
+    """
+    small hex encoded field (operating mode, network id) to int.
+
+    Raises ValueError unless the value fits a positive smallint.
+    """
+    if not isinstance(value, int):
+        value = int(value, 16)
+    if not 0 <= value <= 0x7FFF:
+        raise ValueError(f"{value:#x} out of range 0-0x7fff")
+    return value
+
+
 class ClientHubDevice(models.Model):
     """
     Represents a virtual copy
@@ -17,9 +49,9 @@ class ClientHubDevice(models.Model):
                                 null=True,
                                 related_name='account')
     connect_passphrase = models.CharField(max_length=1028)
-    last_checkin = models.DateTimeField(default=timezone.now)
+    last_checkin = models.DateTimeField(default=timezone.now, db_index=True)
     hub_name = models.CharField(max_length=128, null=True)
-    hub_id = models.UUIDField(null=False)
+    hub_id = models.UUIDField(null=False, db_index=True)
     current_state = models.CharField(max_length=32, default="")
     last_message = models.CharField(max_length=2048, null=True)
 
@@ -33,6 +65,8 @@ class ClientHubDevice(models.Model):
         root = CONFIG.mqtt.root_channel
         return EDChannel(f"{self.hub_id}/", root=root)
 
+    def __str__(self) -> str:
+        return self.hub_name or str(self.hub_id)
 
     def _get_associated_flags_record(self):
         flags: CommandResponseFlag = CommandResponseFlag.objects.filter(hub=self).first()
@@ -78,6 +112,7 @@ class CommandDiagnosticsResponse(models.Model):
     """
     hub = models.ForeignKey(ClientHubDevice, null=False, on_delete=models.CASCADE)
     report = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
 class NodeModule(models.Model):
     """
@@ -90,13 +125,29 @@ class NodeModule(models.Model):
                             on_delete=models.CASCADE,
                             related_name='node')
 
-    address = models.CharField(max_length=16)
-    hub_node_id = models.CharField(max_length=16)
+    # 64 bit DigiMesh addresses stored as signed bigints, see `address_to_int`
+    address = models.BigIntegerField()
+    hub_node_id = models.BigIntegerField()
     node_id = models.CharField(max_length=512)
-    operating_mode = models.CharField(max_length=512)
-    network_id = models.CharField(max_length=512)
+    operating_mode = models.PositiveSmallIntegerField()
+    network_id = models.PositiveSmallIntegerField()  # DigiMesh ID, 0-0x7FFF
+    # last discovery that reported the node
+    last_seen = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['hub', 'address']),
+            # lookups and search by address across hubs
+            models.Index(fields=['address']),
+        ]
 
+    @property
+    def address_hex(self) -> str:
+        return address_to_hex(self.address)
 
+    @property
+    def hub_node_id_hex(self) -> str:
+        return address_to_hex(self.hub_node_id)
 
     def __str__(self) -> str:
         return repr(self)
@@ -104,3 +155,66 @@ class NodeModule(models.Model):
     def __repr__(self) -> str:
         return f"<Node {self.node_id}>"
 
+
+
+class NodeTelemetry(models.Model):
+    """
+    Time series of readings (sensor values, feeder events)
+    reported by the remote nodes of a hub.
+
+    The table is not managed by migrations, on PostgreSQL it is
+    created as a parent table range partitioned by day on
+    `recorded_at` (see `broker.telemetry`), rows are written in bulk
+    by the MQTT manager and never through the ORM.
+    """
+    hub = models.ForeignKey(ClientHubDevice,
+                            on_delete=models.DO_NOTHING,
+                            db_constraint=False,
+                            related_name='telemetry')
+    id = models.BigAutoField(primary_key=True)
+    address = models.CharField(max_length=16)
+    kind = models.CharField(max_length=32)
+    value = models.FloatField(null=True)
+    recorded_at = models.DateTimeField()
+
+    class Meta:
+        managed = False
+        db_table = 'broker_nodetelemetry'
+
+    def __repr__(self) -> str:
+        return f"<Telemetry {self.address} {self.kind}={self.value}>"
+
+
+class ScheduledCommand(models.Model):
+    """
+    A recurring command sent to a hub by the MQTT manager's
+    scheduler, ie: diagnostics every hour or a nightly discovery.
+
+    `next_run` is persisted by the scheduler so runs missed
+    while the manager was down can be handled on restart
+    according to `on_missed`.
+    """
+    MISSED_RUN_ONCE = 'run_once'
+    MISSED_SKIP = 'skip'
+    MISSED_CHOICES = (
+        (MISSED_RUN_ONCE, 'Run once'),
+        (MISSED_SKIP, 'Skip'),
+    )
+
+    hub = models.ForeignKey(ClientHubDevice,
+                            null=False,
+                            on_delete=models.CASCADE,
+                            related_name='schedules')
+    command = models.SmallIntegerField()  # EDCommand value
+    interval = models.PositiveIntegerField()  # seconds
+    jitter = models.PositiveIntegerField(default=0)  # +/- seconds per run
+    on_missed = models.CharField(max_length=16,
+                                 choices=MISSED_CHOICES,
+                                 default=MISSED_RUN_ONCE)
+    enabled = models.BooleanField(default=True)
+    last_run = models.DateTimeField(null=True)
+    next_run = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __repr__(self) -> str:
+        return f"<Schedule {self.command} every {self.interval}s>"
@@ -0,0 +1,209 @@
+"""
+On-demand profiling of the running MQTT manager.
+
+A `profile` control message on the proxy channel (see the
+`profile_manager` management command) turns profiling on for a number
+of seconds, after which two files are written to `output_dir`:
+
+    manager-<time>.collapsed - sampled stacks of every thread in
+        collapsed format (`frame;frame;frame count`), the input of
+        flamegraph.pl / speedscope
+    manager-<time>.json      - per callback and EDCommand histograms of
+        the total callback time and its pickle decode and database parts
+
+While off, the only cost on the message path is reading `PROFILER.active`.
+"""
+
+import json
+import logging
+import pickle
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from django.db import connection
+from edcomms import MessageCallback
+
+from EagleDaddyCloud.settings import CONFIG
+
+# histogram bucket upper bounds, ms
+_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+            float('inf'))
+_PHASES = ('total', 'decode', 'db')
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * len(_BUCKETS)
+        self.sum = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(_BUCKETS, ms)] += 1
+        self.sum += ms
+
+    def describe(self):
+        n = sum(self.counts)
+        return {
+            'count': n,
+            'mean_ms': round(self.sum / n, 3) if n else 0,
+            'buckets': {
+                f"le_{b}": c
+                for b, c in zip(_BUCKETS, self.counts) if c
+            },
+        }
+
+
+class _QueryTimer:
+    """execute wrapper summing time spent in the database"""
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+
+class Profiler:
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        self._histograms = None
+
+    def start(self, seconds, sample_interval=None, output_dir=None):
+        """
+        Profiles for `seconds` in a background thread.
+        Returns False if a profile is already running.
+
+        Each profile records into its own histograms, the next one can
+        start while the previous is still being written.
+        """
+        with self._lock:
+            if self.active:
+                return False
+            histograms = self._histograms = defaultdict(lambda: {
+                phase: Histogram()
+                for phase in _PHASES
+            })
+            self.active = True
+
+        config = CONFIG.profiling
+        seconds = min(float(seconds), float(config.max_seconds))
+        threading.Thread(
+            target=self._run,
+            args=(seconds,
+                  float(sample_interval or config.sample_interval),
+                  Path(output_dir or config.output_dir), histograms),
+            daemon=True,
+            name="profiler").start()
+        logging.info(f"profiling manager for {seconds}s")
+        return True
+
+    def record(self, callback, command, total, decode, db):
+        key = f"{callback}/{command}"
+        with self._lock:
+            if not self.active:
+                return
+            histograms = self._histograms[key]
+            histograms['total'].add(total)
+            histograms['decode'].add(decode)
+            histograms['db'].add(db)
+
+    def _run(self, seconds, interval, output_dir, histograms):
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stacks[self._collapse(names.get(ident, ident), frame)] += 1
+            samples += 1
+            time.sleep(interval)
+
+        with self._lock:
+            self.active = False
+        try:
+            self._dump(output_dir, seconds, histograms, stacks, samples)
+        except OSError as e:
+            logging.error(f"unable to write profile: {e}")
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({Path(code.co_filename).name}:"
+                         f"{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(str(thread_name))
+        return ";".join(reversed(stack))
+
+    def _dump(self, output_dir, seconds, histograms, stacks, samples):
+        output_dir.mkdir(parents=True, exist_ok=True)
+        prefix = output_dir / f"manager-{time.strftime('%Y%m%d-%H%M%S')}"
+
+        with open(f"{prefix}.collapsed", 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        report = {
+            'seconds': seconds,
+            'samples': samples,
+            'callbacks': {
+                key: {
+                    phase: h.describe()
+                    for phase, h in phases.items()
+                }
+                for key, phases in sorted(histograms.items())
+            },
+        }
+        with open(f"{prefix}.json", 'w') as f:
+            json.dump(report, f, indent=2)
+
+        for key, phases in sorted(histograms.items()):
+            total, db = phases['total'], phases['db']
+            logging.info(f"profile {key}: {total.describe()['count']} calls, "
+                         f"mean {total.describe()['mean_ms']}ms, "
+                         f"db {db.describe()['mean_ms']}ms")
+        logging.info(f"profile written to {prefix}.collapsed/.json")
+
+
+PROFILER = Profiler()
+
+
+class ProfiledCallback(MessageCallback):
+    """
+    `MessageCallback` timed by the profiler while it is active,
+    splitting pickle decoding and database time from the rest.
+    """
+    @classmethod
+    def callback(cls, client, obj, msg):
+        if not PROFILER.active:
+            return super().callback(client, obj, msg)
+
+        started = time.perf_counter()
+        packet = pickle.loads(msg.payload)
+        decoded = time.perf_counter()
+
+        db = _QueryTimer()
+        try:
+            with connection.execute_wrapper(db):
+                cls(client, msg.topic, packet).process()
+        finally:
+            command = getattr(packet.command, 'name', packet.command)
+            PROFILER.record(cls.__name__, command,
+                            time.perf_counter() - started, decoded - started,
+                            db.elapsed)
@@ -0,0 +1,55 @@
+"""
+Pool of outbound MQTT connections for the manager.
+
+The manager's own connection receives all hub traffic. Publishing
+command bursts on the same socket puts them in the queue of the one
+network thread that also reads inbound messages. The pool moves
+outbound messages to `size` separate connections, each with its own
+network thread.
+
+A hub is always published to through the same connection (crc32 of
+its hub_id), so messages to one hub keep their order.
+"""
+
+import logging
+import uuid
+import zlib
+
+from edcomms import EDChannel, EDClient, EDPacket
+
+
+class PublisherPool:
+    def __init__(self, manager_id: uuid.UUID, host, port=1883, size=4):
+        self.size = size
+        self._clients = [
+            EDClient(uuid.uuid5(manager_id, f"publisher-{i}"), host, port)
+            for i in range(size)
+        ]
+        self.published = [0] * size
+
+    def start(self):
+        for client in self._clients:
+            client.init()
+            client.loop_start()
+        logging.info(f"started {self.size} publisher connections")
+
+    def stop(self):
+        for client in self._clients:
+            client.loop_stop()
+            client.disconnect()
+
+    def slot(self, hub_id) -> int:
+        return zlib.crc32(str(hub_id).encode()) % self.size
+
+    def publish(self, hub_id, channel: EDChannel, packet: EDPacket):
+        slot = self.slot(hub_id)
+        self.published[slot] += 1
+        return self._clients[slot].publish(channel, packet)
+
+    def describe(self):
+        return {
+            'connections': self.size,
+            'connected': sum(c.is_connected() for c in self._clients),
+            'published': list(self.published),
+            'queued': [len(c._out_messages) for c in self._clients],
+        }
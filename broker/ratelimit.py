@@ -0,0 +1,156 @@
+"""
+Token bucket rate limits on hub commands, per account and per hub.
+
+Each command type has its own limits in config.yml:
+
+    ratelimit:
+      discovery:
+        account: {burst: 20, per_minute: 10}
+        hub: {burst: 3, per_minute: 2}
+
+A bucket holds up to `burst` tokens and is refilled with `per_minute`
+tokens a minute. A command takes a token from each bucket it falls
+under (its hub's account and the hub) and is refused when any of them
+is empty, without taking from the others. Commands without limits are
+never refused.
+
+Buckets are redis hashes read and updated by a single Lua script,
+so the check is atomic across web workers and runs on the clock of
+the redis server.
+
+Commands are checked twice: by the web app before they are published
+to the proxy channel and by the manager before they are sent to the
+hub, which also covers anything publishing to the channel directly.
+Both keep their own buckets (`layer`), a command passing the web
+check is not counted twice against the manager's.
+
+Refused commands are counted in the `<proxy channel>/ratelimit/throttled`
+hash, one field per layer, scope and command: "web/account/discovery".
+"""
+
+import math
+
+import redis
+from edcomms import EDCommand
+from redis.commands.core import AsyncScript, Script
+
+from EagleDaddyCloud.settings import CONFIG
+
+# KEYS: bucket keys, then the throttled counters hash
+# ARGV: burst and refill rate (tokens/s) of every bucket,
+#       then the counter field of every bucket
+# returns {allowed, seconds until allowed, index of the empty bucket}
+_TAKE_TOKEN = b"""
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local n = #KEYS - 1
+local tokens = {}
+local wait, empty = 0, 0
+
+for i = 1, n do
+    local burst, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local level = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    tokens[i] = math.min(burst, level + elapsed * rate)
+    if tokens[i] < 1 and (1 - tokens[i]) / rate > wait then
+        wait, empty = (1 - tokens[i]) / rate, i
+    end
+end
+
+if empty > 0 then
+    redis.call('HINCRBY', KEYS[n + 1], ARGV[2 * n + empty], 1)
+    return {0, tostring(wait), empty}
+end
+
+for i = 1, n do
+    local burst, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens[i] - 1),
+               'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 1)
+end
+return {1, '0', 0}
+"""
+
+_SCRIPT = Script(None, _TAKE_TOKEN)
+_ASYNC_SCRIPT = AsyncScript(None, _TAKE_TOKEN)
+_SCOPES = ('account', 'hub')
+
+
+class RateLimited(Exception):
+    def __init__(self, scope: str, cmd: EDCommand, retry_after: float):
+        super().__init__(f"{cmd.name} limit per {scope} reached, "
+                         f"retry in {retry_after:.1f}s")
+        self.scope = scope
+        self.cmd = cmd
+        self.retry_after = retry_after
+
+
+def throttled_key() -> str:
+    return f"{CONFIG.proxy.channel}/ratelimit/throttled"
+
+
+def throttled_counts(proxy: redis.Redis) -> dict:
+    return {
+        field.decode(): int(count)
+        for field, count in proxy.hgetall(throttled_key()).items()
+    }
+
+
+class RateLimiter:
+    """
+    Checks commands against the configured limits, `layer` names
+    the buckets of the check (see module docstring).
+    """
+    def __init__(self, layer: str, limits=None):
+        self.layer = layer
+        self.limits = limits if limits is not None \
+            else CONFIG.get('ratelimit') or dict()
+
+    def _buckets(self, cmd: EDCommand, account_id, hub_id):
+        limits = self.limits.get(cmd.name) or dict()
+        keys, rates, fields = list(), list(), list()
+        for scope, ident in zip(_SCOPES, (account_id, hub_id)):
+            limit = limits.get(scope)
+            if not limit or ident is None:
+                continue
+            keys.append(f"{CONFIG.proxy.channel}/ratelimit/{self.layer}/"
+                        f"{scope}/{ident}/{int(cmd)}")
+            rates += [limit['burst'], limit['per_minute'] / 60]
+            fields.append(f"{self.layer}/{scope}/{cmd.name}")
+        return keys, rates, fields
+
+    @staticmethod
+    def _result(result, cmd, fields):
+        allowed, wait, empty = result
+        if not allowed:
+            scope = fields[int(empty) - 1].split('/')[1]
+            raise RateLimited(scope, cmd, math.ceil(float(wait) * 10) / 10)
+
+    def check(self, proxy: redis.Redis, cmd: EDCommand, account_id=None,
+              hub_id=None):
+        """
+        Takes a token for `cmd` from the buckets of the account and
+        the hub, raises `RateLimited` when one of them is empty.
+        """
+        keys, rates, fields = self._buckets(cmd, account_id, hub_id)
+        if not keys:
+            return
+        result = _SCRIPT(keys + [throttled_key()], rates + fields,
+                         client=proxy)
+        self._result(result, cmd, fields)
+
+    async def check_async(self,
+                          proxy: 'redis.asyncio.Redis',
+                          cmd: EDCommand,
+                          account_id=None,
+                          hub_id=None):
+        """asyncio version of `check`"""
+        keys, rates, fields = self._buckets(cmd, account_id, hub_id)
+        if not keys:
+            return
+        result = await _ASYNC_SCRIPT(keys + [throttled_key()],
+                                     rates + fields,
+                                     client=proxy)
+        self._result(result, cmd, fields)
@@ -0,0 +1,214 @@
+"""
+Retention of fleet data, run by the `purge_fleet` management command.
+
+    hubs         not checked in for `hub_days`, with everything hanging
+                 off them (nodes, flags, diagnostics, schedules)
+    nodes        not reported by a discovery for `node_days`
+    diagnostics  reports not refreshed for `diagnostics_days`
+
+Rows are deleted in chunks of `chunk_size` primary keys, each chunk in
+its own short transaction. Within a chunk deletes are set based:
+`DELETE ... WHERE pk IN (...)`, related rows of hubs with one
+`DELETE ... WHERE hub_id IN (...)` per table. Only the keys of one
+chunk are ever held in memory, and the chunks walk the matching keys
+in order so each one starts where the previous ended.
+
+A chunk of hubs can own any number of nodes, the nodes of a chunk are
+purged in chunks of their own before the hubs so the cascade of the
+hub delete stays small. Once a chunk is deleted the cached topology of
+its hubs is invalidated, and purged hubs are dropped from the MQTT
+manager's registry with an `unsubscribe` control message. Both need
+`proxy`, without it (or with redis down) caches expire on their own
+and the manager drops the hubs on its next reconcile.
+"""
+
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+import redis
+from django.db import transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from broker.db import db_resilient
+from broker.models import ClientHubDevice, CommandDiagnosticsResponse, NodeModule
+from broker.topology import invalidate_topology
+from broker.utils import send_proxy_control
+
+CHUNK_SIZE = 1000
+
+
+@db_resilient
+def _delete_chunk(queryset: QuerySet, pks):
+    with transaction.atomic():
+        _, deleted = queryset.filter(pk__in=pks).delete()
+    return deleted
+
+
+@db_resilient
+def _delete_nodes(queryset: QuerySet, pks):
+    """deletes a chunk of nodes, returns the counts and the hubs they were on"""
+    with transaction.atomic():
+        nodes = queryset.filter(pk__in=pks)
+        hub_pks = set(nodes.values_list('hub_id', flat=True))
+        _, deleted = nodes.delete()
+    return deleted, hub_pks
+
+
+@db_resilient
+def _delete_hubs(queryset: QuerySet, pks):
+    """deletes a chunk of hubs, returns the counts and the purged hubs"""
+    with transaction.atomic():
+        hubs = queryset.filter(pk__in=pks)
+        purged = list(hubs.values_list('pk', 'hub_id'))
+        _, deleted = hubs.delete()
+    return deleted, purged
+
+
+def _chunks(queryset: QuerySet, chunk_size):
+    """primary keys of `queryset` in ascending chunks of `chunk_size`"""
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return
+        last_pk = pks[-1]
+        yield pks
+
+
+def _forget(proxy: redis.Redis, hub_pks, hub_ids=()):
+    """invalidates the topology of `hub_pks`, unsubscribes `hub_ids`"""
+    if proxy is None or not hub_pks:
+        return
+    try:
+        with proxy.pipeline(transaction=False) as pipe:
+            for pk in hub_pks:
+                invalidate_topology(pipe, pk)
+            pipe.execute()
+        if hub_ids:
+            send_proxy_control(proxy.connection_pool,
+                               'unsubscribe',
+                               hubs=[str(hub_id) for hub_id in hub_ids])
+    except redis.RedisError as e:
+        logging.error(f"unable to invalidate {len(hub_pks)} purged hubs: {e}")
+
+
+def purge(queryset: QuerySet, chunk_size=CHUNK_SIZE, progress=None,
+          dry_run=False, proxy=None) -> Counter:
+    """
+    Deletes every row of `queryset` chunk by chunk.
+    `progress(counts)` is called after every chunk with the
+    running number of deleted rows per model. Hubs and nodes
+    go through `purge_hubs` and `purge_nodes`.
+
+    Returns the number of deleted rows per model.
+    """
+    model = queryset.model
+    if model is ClientHubDevice:
+        return purge_hubs(queryset, chunk_size, progress, dry_run, proxy)
+    if model is NodeModule:
+        return purge_nodes(queryset, chunk_size, progress, dry_run, proxy)
+
+    label = model._meta.label
+    deleted = Counter()
+    for pks in _chunks(queryset, chunk_size):
+        if dry_run:
+            deleted[label] += len(pks)
+        else:
+            deleted.update(_delete_chunk(queryset, pks))
+        if progress:
+            progress(deleted)
+    return deleted
+
+
+def purge_nodes(queryset: QuerySet, chunk_size=CHUNK_SIZE, progress=None,
+                dry_run=False, proxy=None, deleted=None) -> Counter:
+    """`purge` of nodes, invalidating the topology of their hubs"""
+    label = NodeModule._meta.label
+    deleted = Counter() if deleted is None else deleted
+    for pks in _chunks(queryset, chunk_size):
+        if dry_run:
+            deleted[label] += len(pks)
+        else:
+            counts, hub_pks = _delete_nodes(queryset, pks)
+            deleted.update(counts)
+            _forget(proxy, hub_pks)
+        if progress:
+            progress(deleted)
+    return deleted
+
+
+def purge_hubs(queryset: QuerySet, chunk_size=CHUNK_SIZE, progress=None,
+               dry_run=False, proxy=None) -> Counter:
+    """
+    `purge` of hubs, their nodes first in chunks of their own.
+    Purged hubs are invalidated and unsubscribed from the manager.
+    """
+    label = ClientHubDevice._meta.label
+    deleted = Counter()
+    for pks in _chunks(queryset, chunk_size):
+        purge_nodes(NodeModule.objects.filter(hub__in=pks),
+                    chunk_size=chunk_size,
+                    progress=progress,
+                    dry_run=dry_run,
+                    deleted=deleted)
+        if dry_run:
+            deleted[label] += len(pks)
+        else:
+            counts, purged = _delete_hubs(queryset, pks)
+            deleted.update(counts)
+            _forget(proxy, [pk for pk, _ in purged],
+                    [hub_id for _, hub_id in purged])
+        if progress:
+            progress(deleted)
+    return deleted
+
+
+def stale_hubs(days) -> QuerySet:
+    cutoff = timezone.now() - timedelta(days=days)
+    return ClientHubDevice.objects.filter(last_checkin__lt=cutoff)
+
+
+def stale_nodes(days) -> QuerySet:
+    cutoff = timezone.now() - timedelta(days=days)
+    return NodeModule.objects.filter(last_seen__lt=cutoff)
+
+
+def expired_diagnostics(days) -> QuerySet:
+    cutoff = timezone.now() - timedelta(days=days)
+    return CommandDiagnosticsResponse.objects.filter(updated_at__lt=cutoff)
+
+
+def apply_retention(hub_days=None,
+                    node_days=None,
+                    diagnostics_days=None,
+                    chunk_size=CHUNK_SIZE,
+                    progress=None,
+                    dry_run=False,
+                    proxy=None) -> Counter:
+    """runs the jobs whose retention period is given, see module docstring"""
+    jobs = (
+        (hub_days, stale_hubs),
+        (node_days, stale_nodes),
+        (diagnostics_days, expired_diagnostics),
+    )
+
+    deleted = Counter()
+    for days, queryset in jobs:
+        if days is None:
+            continue
+        started = time.perf_counter()
+        counts = purge(queryset(days),
+                       chunk_size=chunk_size,
+                       progress=progress,
+                       dry_run=dry_run,
+                       proxy=proxy)
+        logging.info(f"retention {queryset.__name__} ({days} days): "
+                     f"{dict(counts)} in {time.perf_counter() - started:.1f}s")
+        deleted.update(counts)
+    return deleted
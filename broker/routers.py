@@ -0,0 +1,154 @@
+"""
+Read replica routing for the dashboard.
+
+Reads are only sent to a replica while `ReplicaRoutingMiddleware`
+allows it for the current request: safe (GET/HEAD) requests, to a view
+marked with `replica_reads`, of clients that did not write recently.
+Only the dashboard's read heavy pages are marked, everything else (the
+admin, authentication, signup checks, the ajax polls of a command just
+sent, the MQTT manager and management commands) stays on the primary.
+
+Read-your-writes: a request that writes through the router pins its
+client to the primary for `sticky_seconds` with a cookie, so the page
+shown after an action never comes from a replica that is behind.
+
+Locally, `EagleDaddyCloud.settings_test` has a second alias
+(`replica_0`) on the same SQLite database, for `runserver` as well as
+the tests.
+
+Replica lag is checked at most every `replica_lag_check_interval`
+seconds per replica and process. A replica more than `replica_max_lag`
+seconds behind, or unreachable, is skipped; with no usable replica
+reads go to the primary.
+
+Replicas are configured with DATABASE_REPLICAS, see settings.py.
+"""
+
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from EagleDaddyCloud.settings import CONFIG
+
+REPLICA_PREFIX = 'replica'
+PIN_COOKIE = 'db_primary_pin'
+_PRIMARY_APPS = ('sessions', )
+
+_replica_reads = ContextVar('replica_reads', default=False)
+_wrote = ContextVar('wrote', default=False)
+
+
+def replica_reads(view):
+    """marks a view whose reads may be served by a replica"""
+    view.replica_reads = True
+    return view
+
+
+def replica_aliases():
+    return [
+        alias for alias in settings.DATABASES
+        if alias.startswith(REPLICA_PREFIX)
+    ]
+
+
+class ReplicaLag:
+    """cached replication lag, in seconds, of every replica"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = dict()  # alias -> (checked at, lag)
+
+    def lag(self, alias):
+        interval = float(CONFIG.database.replica_lag_check_interval)
+        checked_at, lag = self._checked.get(alias, (0, None))
+        if time.monotonic() - checked_at < interval:
+            return lag
+
+        with self._lock:
+            lag = self._measure(alias)
+            self._checked[alias] = (time.monotonic(), lag)
+        return lag
+
+    @staticmethod
+    def _measure(alias):
+        conn = connections[alias]
+        try:
+            with conn.cursor() as cursor:
+                if conn.vendor != 'postgresql':
+                    return 0.0
+                # NULL on a server that is not replaying, ie: the primary
+                cursor.execute(
+                    "SELECT CASE WHEN pg_is_in_recovery() THEN "
+                    "COALESCE(EXTRACT(EPOCH FROM now() - "
+                    "pg_last_xact_replay_timestamp()), 0) ELSE 0 END")
+                return float(cursor.fetchone()[0])
+        except DatabaseError as e:
+            logging.warning(f"replica {alias} unavailable: {e}")
+            conn.close()
+            return None
+
+
+LAG = ReplicaLag()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # sessions are cheap key lookups that must see logins/logouts
+        if not _replica_reads.get() or model._meta.app_label in _PRIMARY_APPS:
+            return DEFAULT_DB_ALIAS
+
+        max_lag = float(CONFIG.database.replica_max_lag)
+        replicas = replica_aliases()
+        random.shuffle(replicas)
+        for alias in replicas:
+            lag = LAG.lag(alias)
+            if lag is not None and lag <= max_lag:
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # the rest of the request reads what it wrote
+        _wrote.set(True)
+        _replica_reads.set(False)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return not db.startswith(REPLICA_PREFIX)
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # both are only ever set for this request, by `process_view`
+        # and by the router's `db_for_write`
+        reads = _replica_reads.set(False)
+        wrote = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get():
+                response.set_cookie(PIN_COOKIE,
+                                    '1',
+                                    max_age=int(
+                                        CONFIG.database.sticky_seconds),
+                                    httponly=True,
+                                    samesite='Lax')
+            return response
+        finally:
+            _replica_reads.reset(reads)
+            _wrote.reset(wrote)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'replica_reads', False) \
+                and request.method in ('GET', 'HEAD') \
+                and request.COOKIES.get(PIN_COOKIE) is None:
+            _replica_reads.set(True)
@@ -0,0 +1,264 @@
+"""
+Recurring hub commands for the MQTT manager.
+
+`ScheduledCommand` rows are loaded into an in-memory min-heap keyed
+by due time, a single thread sleeps until the earliest job is due,
+fires every due job (grouped per command so hubs are fetched in bulk)
+and pushes it back with its next due time. Pushing and popping is
+O(log n), which keeps 100k+ jobs cheap.
+
+To avoid thundering herds:
+    * a job without a `next_run` gets a stable offset within its
+      interval derived from its primary key, so jobs created together
+      are spread evenly instead of all firing at once.
+    * every run is moved by a random +/- `jitter` seconds.
+    * runs missed while the manager was down are spread over
+      `missed_spread` seconds on restart.
+
+Run times are written back in batches every `flush_interval` seconds,
+schedules created or changed in the database are picked up every
+`reload_interval` seconds.
+"""
+
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.utils import timezone
+
+from broker.db import db_resilient
+from broker.models import ScheduledCommand
+
+# Knuth's multiplicative hash, spreads sequential keys over [0, 1)
+_SPREAD_HASH = 2654435761
+_RELOAD_MARGIN = timedelta(seconds=5)
+
+
+def _to_ts(value: datetime) -> float:
+    return value.timestamp()
+
+
+def _to_dt(ts: float) -> datetime:
+    return datetime.fromtimestamp(ts, tz=dt_timezone.utc)
+
+
+class _Job:
+    __slots__ = ('pk', 'hub_pk', 'command', 'interval', 'jitter', 'version')
+
+    def __init__(self, pk, hub_pk, command, interval, jitter, version):
+        self.pk = pk
+        self.hub_pk = hub_pk
+        self.command = command
+        self.interval = max(1, interval)
+        self.jitter = jitter
+        self.version = version
+
+
+class CommandScheduler(threading.Thread):
+    """
+    Args:
+        dispatch (callable): `dispatch(hub_pks, command)`, sends
+            `command` (EDCommand value) to every hub in `hub_pks`.
+    """
+    _FIELDS = ('pk', 'hub_id', 'command', 'interval', 'jitter', 'on_missed',
+               'next_run')
+
+    def __init__(self,
+                 dispatch,
+                 reload_interval=60,
+                 flush_interval=10,
+                 missed_spread=300):
+        super().__init__(daemon=True, name="command-scheduler")
+        self.dispatch = dispatch
+        self.reload_interval = reload_interval
+        self.flush_interval = flush_interval
+        self.missed_spread = missed_spread
+
+        self._heap = list()  # (due, pk, version)
+        self._jobs = dict()  # pk -> _Job
+        self._dirty = dict()  # pk -> (last_run, next_run)
+        self._last_reload = None
+        self._last_reload_at = 0
+        self._versions = itertools.count()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+        self.fired = 0
+        self.failed = 0
+
+    @classmethod
+    def from_config(cls, dispatch, config):
+        return cls(dispatch,
+                   reload_interval=float(config.reload_interval),
+                   flush_interval=float(config.flush_interval),
+                   missed_spread=float(config.missed_spread))
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self):
+        self._try_reload()
+        self._last_reload_at = next_flush = time.time()
+
+        while not self._stopped.is_set():
+            now = time.time()
+            if now - self._last_reload_at >= self.reload_interval:
+                self._try_reload()
+                self._last_reload_at = now
+
+            if now >= next_flush:
+                self.flush()
+                next_flush = now + self.flush_interval
+
+            due = self._pop_due(now)
+            if due:
+                self._fire(due, now)
+                continue
+
+            wake_at = min(next_flush,
+                          self._last_reload_at + self.reload_interval)
+            if self._heap:
+                wake_at = min(wake_at, self._heap[0][0])
+            self._wakeup.wait(max(0, wake_at - time.time()))
+            self._wakeup.clear()
+
+        self.flush()
+
+    def _try_reload(self):
+        try:
+            self.reload()
+        except Exception as e:
+            logging.error(f"failed to reload schedules: {e}")
+
+    @db_resilient
+    def reload(self):
+        """
+        Loads new or changed schedules and drops deleted/disabled ones.
+        """
+        started = time.perf_counter()
+        reload_at = timezone.now()
+        schedules = ScheduledCommand.objects.filter(enabled=True)
+
+        if self._last_reload is not None:
+            active = set(schedules.values_list('pk', flat=True).iterator())
+            for pk in set(self._jobs) - active:
+                del self._jobs[pk]
+            schedules = schedules.filter(updated_at__gte=self._last_reload -
+                                         _RELOAD_MARGIN)
+
+        now = time.time()
+        loaded = 0
+        for row in schedules.values_list(*self._FIELDS).iterator(
+                chunk_size=5000):
+            self._schedule(*row, now=now)
+            loaded += 1
+
+        self._last_reload = reload_at
+        logging.info(
+            f"scheduler loaded {loaded} schedules ({len(self._jobs)} active) "
+            f"in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def flush(self):
+        """persists last/next run times of jobs that fired"""
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, dict()
+        updates = [
+            ScheduledCommand(pk=pk, last_run=_to_dt(last), next_run=_to_dt(nxt))
+            for pk, (last, nxt) in dirty.items()
+        ]
+        try:
+            db_resilient(ScheduledCommand.objects.bulk_update)(
+                updates, ['last_run', 'next_run'], batch_size=1000)
+        except Exception as e:
+            logging.error(f"failed to persist schedule run times: {e}")
+            for pk, times in dirty.items():
+                self._dirty.setdefault(pk, times)
+
+    def _schedule(self, pk, hub_pk, command, interval, jitter, on_missed,
+                  next_run, now):
+        job = self._jobs.get(pk)
+        if job and job.interval == max(1, interval):
+            # keep the in-memory due time, it is newer than the database
+            job.hub_pk, job.command, job.jitter = hub_pk, command, jitter
+            return
+
+        # versions are unique across jobs so heap entries left over from
+        # a deleted and re-enabled schedule are never mistaken as current
+        job = _Job(pk, hub_pk, command, interval, jitter,
+                   next(self._versions))
+        self._jobs[pk] = job
+
+        if next_run is None:
+            spread = (pk * _SPREAD_HASH % 2**32) / 2**32
+            due = now + spread * job.interval
+        elif _to_ts(next_run) > now:
+            due = _to_ts(next_run)
+        elif on_missed == ScheduledCommand.MISSED_SKIP:
+            behind = now - _to_ts(next_run)
+            due = _to_ts(next_run) + math.ceil(
+                behind / job.interval) * job.interval
+        else:
+            due = now + random.uniform(0, min(self.missed_spread,
+                                              job.interval))
+
+        heapq.heappush(self._heap, (due, pk, job.version))
+
+    def _pop_due(self, now):
+        due = list()
+        while self._heap and self._heap[0][0] <= now:
+            ts, pk, version = heapq.heappop(self._heap)
+            job = self._jobs.get(pk)
+            if job is None or job.version != version:
+                continue  # deleted or rescheduled since it was pushed
+            due.append((ts, job))
+        return due
+
+    def _fire(self, due, now):
+        by_command = defaultdict(list)
+        for _, job in due:
+            by_command[job.command].append(job.hub_pk)
+
+        for command, hub_pks in by_command.items():
+            try:
+                self.dispatch(hub_pks, command)
+                self.fired += len(hub_pks)
+            except Exception as e:
+                self.failed += len(hub_pks)
+                logging.error(
+                    f"scheduled command {command} to {len(hub_pks)} hubs failed: {e}"
+                )
+
+        for ts, job in due:
+            # stay on the original cadence unless we fell a whole
+            # interval behind, then continue from now
+            nxt = ts + job.interval
+            if nxt <= now:
+                nxt = now + job.interval
+            if job.jitter:
+                nxt += random.uniform(-job.jitter, job.jitter)
+            nxt = max(nxt, now + 1)
+
+            heapq.heappush(self._heap, (nxt, job.pk, job.version))
+            self._dirty[job.pk] = (now, nxt)
+
+    def describe(self):
+        return {
+            'jobs': len(self._jobs),
+            'heap': len(self._heap),
+            'next_due_in': round(self._heap[0][0] - time.time(), 1)
+            if self._heap else None,
+            'fired': self.fired,
+            'failed': self.failed,
+        }
@@ -0,0 +1,134 @@
+"""
+Type-ahead search over the hubs and nodes of an account.
+
+Names are matched case-insensitively anywhere in `hub_name` and
+`node_id`, by comparing `lower(column) LIKE '%term%'`. On PostgreSQL
+that predicate is served by trigram (pg_trgm) GIN indexes over
+`lower(column)`, created by a post_migrate hook. Where the extension
+cannot be installed a `text_pattern_ops` index is created instead,
+which serves prefix matches only, and searches do prefix matching
+to follow it. Other databases scan the rows of the account, which
+is fine for tests and small installs.
+
+A term that is a valid hex string also matches node addresses starting
+with it. The prefix maps to a single range over the stored integers
+(see `address_prefix_range`), served by the address index.
+
+Pages are fetched one row past `page_size` to know whether a next
+page exists, so no page ever counts the account's rows.
+"""
+
+import functools
+import logging
+import re
+
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from broker.models import ClientHubDevice, NodeModule
+
+MIN_TERM_LENGTH = 2
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+_ADDRESS_DIGITS = 16
+_HEX = re.compile(r"[0-9a-f]+")
+_INDEXES = (
+    ('broker_hub_name_search', ClientHubDevice, 'hub_name'),
+    ('broker_node_id_search', NodeModule, 'node_id'),
+)
+
+
+def create_search_indexes(sender=None, using='default', **kwargs):
+    """
+    post_migrate hook creating the name search indexes (PostgreSQL only)
+    """
+    conn = connections[using]
+    if conn.vendor != 'postgresql':
+        return
+
+    trigram = True
+    try:
+        with transaction.atomic(using=using), conn.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError as e:
+        logging.warning(
+            f"pg_trgm unavailable, search falls back to prefix matching: {e}")
+        trigram = False
+
+    with conn.cursor() as cursor:
+        for name, model, column in _INDEXES:
+            table = model._meta.db_table
+            if trigram:
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON {table} "
+                    f"USING gin (lower({column}) gin_trgm_ops)")
+            else:
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name}_prefix ON {table} "
+                    f"(lower({column}) text_pattern_ops)")
+
+
+@functools.lru_cache(maxsize=None)
+def prefix_only(using='default'):
+    """True when names can only be searched by prefix, see module docstring"""
+    conn = connections[using]
+    if conn.vendor != 'postgresql':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is None
+
+
+def address_prefix_range(term: str):
+    """
+    Range of stored (signed) addresses whose 16 digit hex form starts
+    with `term`, or None if `term` is not a hex prefix. The first digit
+    fixes the sign, so the range never wraps.
+    """
+    if len(term) > _ADDRESS_DIGITS or not _HEX.fullmatch(term):
+        return None
+
+    prefix = int(term, 16)
+    shift = 4 * (_ADDRESS_DIGITS - len(term))
+    low, high = prefix << shift, ((prefix + 1) << shift) - 1
+    if low >= 2**63:
+        low, high = low - 2**64, high - 2**64
+    return low, high
+
+
+def _name_filter(field, term):
+    if prefix_only():
+        return {f"{field}__startswith": term}
+    return {f"{field}__contains": term}
+
+
+def _page(queryset, page, page_size):
+    offset = (page - 1) * page_size
+    rows = list(queryset[offset:offset + page_size + 1])
+    return rows[:page_size], len(rows) > page_size
+
+
+def search_hubs(account, term, page=1, page_size=PAGE_SIZE):
+    hubs = ClientHubDevice.objects.filter(account=account) \
+        .annotate(search_name=Lower('hub_name')) \
+        .filter(**_name_filter('search_name', term.lower())) \
+        .order_by('search_name', 'pk') \
+        .values('hub_id', 'hub_name', 'last_checkin')
+    return _page(hubs, page, page_size)
+
+
+def search_nodes(account, term, page=1, page_size=PAGE_SIZE):
+    term = term.lower()
+    match = Q(**_name_filter('search_name', term))
+    address_range = address_prefix_range(term)
+    if address_range:
+        match |= Q(address__range=address_range)
+
+    nodes = NodeModule.objects.filter(hub__account=account) \
+        .annotate(search_name=Lower('node_id')) \
+        .filter(match) \
+        .order_by('search_name', 'pk') \
+        .values('node_id', 'address', 'hub__hub_name', 'hub__hub_id')
+    return _page(nodes, page, page_size)
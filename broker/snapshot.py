@@ -0,0 +1,76 @@
+"""
+Compact on-disk snapshot of the MQTT manager's hub registry.
+
+Lets a restarting manager subscribe to every known hub straight away
+instead of waiting on a full scan of the hubs table, the database is
+reconciled afterwards in the background.
+
+File layout (little endian):
+
+    header:  magic b"EDCS" | version u16 | written_at f64 | count u32
+    records: hub_id (36 ascii chars, canonical uuid) | hub pk i64, `count` times
+
+hub ids are kept in their text form, decoding ascii is an order of
+magnitude faster than rebuilding `uuid.UUID` objects. 100k hubs take
+~4.4MB and load in milliseconds through mmap.
+"""
+
+import mmap
+import os
+import struct
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Tuple
+
+_MAGIC = b"EDCS"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHdI")
+_RECORD = struct.Struct("<36sq")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_snapshot(path: Path, hubs: Dict[str, int]):
+    """
+    Atomically writes the `hub_id -> pk` registry to `path`.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    buffer = bytearray(_HEADER.size + _RECORD.size * len(hubs))
+    _HEADER.pack_into(buffer, 0, _MAGIC, _VERSION, time.time(), len(hubs))
+
+    offset = _HEADER.size
+    for hub_id, pk in hubs.items():
+        _RECORD.pack_into(buffer, offset,
+                          str(uuid.UUID(hub_id)).encode('ascii'), pk)
+        offset += _RECORD.size
+
+    with open(tmp, 'wb') as f:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: Path) -> Tuple[float, Dict[str, int]]:
+    """
+    Returns (written_at, hub_id -> pk) from a snapshot file.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < _HEADER.size:
+            raise SnapshotError(f"snapshot {path} is truncated")
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, written_at, count = _HEADER.unpack_from(mm, 0)
+            if magic != _MAGIC or version != _VERSION:
+                raise SnapshotError(f"{path} is not a v{_VERSION} snapshot")
+            if size != _HEADER.size + count * _RECORD.size:
+                raise SnapshotError(f"snapshot {path} is truncated")
+
+            records = _RECORD.iter_unpack(mm[_HEADER.size:])
+            hubs = {raw.decode('ascii'): pk for raw, pk in records}
+    return written_at, hubs
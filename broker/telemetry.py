@@ -0,0 +1,268 @@
+"""
+Ingestion path for node telemetry.
+
+Hubs publish batches of readings on `/<root>/<hub_id>/telemetry`,
+the MQTT manager decodes them and hands them to a `TelemetryWriter`,
+which buffers readings in memory and writes them in bulk from a
+background thread, using COPY on PostgreSQL and `bulk_create` on
+anything else.
+
+When the buffer is full `TelemetryWriter.put` blocks the calling
+(paho network) thread for up to `put_timeout` seconds, which stops
+reading from the broker socket and pushes back on the hubs, rather
+than letting memory grow without bound. Readings that still do not
+fit are dropped and counted.
+
+Expected telemetry payload, a list of readings:
+
+    [{'address64': '0013a20041bd2a7a', 'kind': 'feed', 'value': 1.0,
+      'ts': 1610000000.0}, ...]
+"""
+
+import csv
+import io
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Any, Dict, Iterable, List, Tuple
+
+from django.db import connection, transaction
+
+from broker.db import db_resilient
+from broker.models import NodeTelemetry
+
+# (hub pk, address, kind, value, recorded_at)
+Reading = Tuple[int, str, str, float, datetime]
+
+_TABLE = NodeTelemetry._meta.db_table
+_COLUMNS = ('hub_id', 'address', 'kind', 'value', 'recorded_at')
+
+_PG_PARENT = f"""
+CREATE TABLE IF NOT EXISTS {_TABLE} (
+    id BIGSERIAL NOT NULL,
+    hub_id INTEGER NOT NULL,
+    address VARCHAR(16) NOT NULL,
+    kind VARCHAR(32) NOT NULL,
+    value DOUBLE PRECISION NULL,
+    recorded_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY (id, recorded_at)
+) PARTITION BY RANGE (recorded_at)
+"""
+
+_PG_INDEX = f"""
+CREATE INDEX IF NOT EXISTS {_TABLE}_hub_address_recorded
+ON {_TABLE} (hub_id, address, recorded_at)
+"""
+
+_PG_DEFAULT_PARTITION = f"""
+CREATE TABLE IF NOT EXISTS {_TABLE}_default PARTITION OF {_TABLE} DEFAULT
+"""
+
+_FALLBACK_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {_TABLE} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hub_id INTEGER NOT NULL,
+    address VARCHAR(16) NOT NULL,
+    kind VARCHAR(32) NOT NULL,
+    value REAL NULL,
+    recorded_at DATETIME NOT NULL
+)
+"""
+
+
+def create_telemetry_table(sender=None, using='default', **kwargs):
+    """
+    post_migrate hook that creates the (unmanaged) telemetry table.
+    """
+    from django.db import connections
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute(_PG_PARENT)
+            cursor.execute(_PG_INDEX)
+            cursor.execute(_PG_DEFAULT_PARTITION)
+        else:
+            cursor.execute(_FALLBACK_TABLE)
+
+
+def partition_name(day: datetime) -> str:
+    return f"{_TABLE}_{day:%Y%m%d}"
+
+
+def ensure_partition(day: datetime):
+    """
+    Creates the daily partition holding `day` (PostgreSQL only).
+    """
+    if connection.vendor != 'postgresql':
+        return
+
+    start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = start + timedelta(days=1)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF {_TABLE} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+
+
+def readings_from_payload(hub_pk: int,
+                          payload: Iterable[Dict[str, Any]]) -> List[Reading]:
+    """
+    Decodes a telemetry payload into rows, malformed readings are skipped.
+    """
+    now = time.time()
+    readings = list()
+    for reading in payload or ():
+        try:
+            address = str(reading['address64'])
+            kind = str(reading['kind'])[:32]
+            value = reading.get('value')
+            value = None if value is None else float(value)
+            ts = float(reading.get('ts') or now)
+            # inf, nan and out of range timestamps
+            recorded_at = datetime.fromtimestamp(ts, tz=dt_timezone.utc)
+        except (KeyError, TypeError, ValueError, AttributeError,
+                OverflowError, OSError):
+            logging.warning(f"skipping malformed telemetry reading: {reading}")
+            continue
+
+        readings.append((hub_pk, address, kind, value, recorded_at))
+    return readings
+
+
+class TelemetryWriter(threading.Thread):
+    """
+    Bounded in-memory buffer of readings flushed to the database
+    in batches of `batch_size`, or every `flush_interval` seconds.
+    """
+    def __init__(self,
+                 buffer_size=200000,
+                 batch_size=5000,
+                 flush_interval=1.0,
+                 put_timeout=5.0):
+        super().__init__(daemon=True, name="telemetry-writer")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._buffer = queue.Queue(maxsize=buffer_size)
+        self._stopped = threading.Event()
+        self._partitions = set()
+
+        self.accepted = 0
+        self.dropped = 0
+        self.written = 0
+        self.flush_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(buffer_size=int(config.buffer_size),
+                   batch_size=int(config.batch_size),
+                   flush_interval=float(config.flush_interval),
+                   put_timeout=float(config.put_timeout))
+
+    @property
+    def pending(self):
+        return self._buffer.qsize()
+
+    def put(self, readings: Iterable[Reading]):
+        """
+        Buffers `readings`, waiting at most `put_timeout` seconds in
+        total for room, whatever does not fit by then is dropped.
+        """
+        dropped = 0
+        deadline = time.monotonic() + self.put_timeout
+        for reading in readings:
+            try:
+                self._buffer.put(reading,
+                                 timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                dropped += 1
+                continue
+            self.accepted += 1
+
+        if dropped:
+            self.dropped += dropped
+            logging.warning(
+                f"telemetry buffer full, dropped {dropped} readings ({self.dropped} total)"
+            )
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set() or not self._buffer.empty():
+            batch = self._take_batch()
+            if batch:
+                self.flush(batch)
+
+    def _take_batch(self) -> List[Reading]:
+        batch = list()
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._buffer.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch: List[Reading]):
+        started = time.perf_counter()
+        try:
+            self._write(batch)
+        except Exception as e:
+            logging.error(f"failed to write {len(batch)} telemetry readings: {e}")
+            return
+
+        elapsed = time.perf_counter() - started
+        self.written += len(batch)
+        self.flush_seconds += elapsed
+        logging.debug(
+            f"wrote {len(batch)} telemetry readings in {elapsed * 1000:.1f}ms"
+        )
+
+    @db_resilient
+    def _write(self, batch: List[Reading]):
+        self._ensure_partitions(batch)
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                self._copy(batch)
+            else:
+                NodeTelemetry.objects.bulk_create(
+                    [NodeTelemetry(**dict(zip(_COLUMNS, r))) for r in batch],
+                    batch_size=1000)
+
+    def _ensure_partitions(self, batch: List[Reading]):
+        days = {r[4].date() for r in batch} - self._partitions
+        for day in days:
+            ensure_partition(
+                datetime(day.year, day.month, day.day, tzinfo=dt_timezone.utc))
+            self._partitions.add(day)
+
+    def _copy(self, batch: List[Reading]):
+        data = io.StringIO()
+        writer = csv.writer(data)
+        for hub_pk, address, kind, value, recorded_at in batch:
+            writer.writerow((hub_pk, address, kind,
+                             '' if value is None else repr(value),
+                             recorded_at.isoformat()))
+        data.seek(0)
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {_TABLE} ({', '.join(_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                data)
+
+    def describe(self):
+        rate = self.written / self.flush_seconds if self.flush_seconds else 0
+        return {
+            'accepted': self.accepted,
+            'dropped': self.dropped,
+            'written': self.written,
+            'pending': self.pending,
+            'write_rate': round(rate, 1),
+        }
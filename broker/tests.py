@@ -1,3 +1,918 @@
-from django.test import TestCase
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import SkipTest, mock
 
-# Create your tests here.
+import paho.mqtt.client as mqtt
+import redis
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from edcomms import EDCommand, EDPacket
+
+from ClientAccount.models import ClientAccount
+from EagleDaddyCloud.settings import BASE_DIR, CONFIG
+from broker import export, fleet, retention
+from broker.admin import CURSOR_VAR, ClientHubDeviceAdmin
+from broker.db import STATS as DB_STATS, db_resilient
+from broker.lanes import BULK, INTERACTIVE, LANES, SCHEDULED, CommandLanes
+from broker.models import (ClientHubDevice, CommandDiagnosticsResponse, CommandResponseFlag,
+                           NodeModule, NodeTelemetry, ScheduledCommand, address_to_int,
+                           hex_to_int)
+from broker.profiling import Profiler
+from broker.ratelimit import RateLimited, RateLimiter, throttled_counts, throttled_key
+from broker.routers import PIN_COOKIE, ReplicaRouter, ReplicaRoutingMiddleware, replica_reads
+from broker.telemetry import TelemetryWriter
+from broker.topology import cached_topology, topology_key, version_key
+from broker.utils import inflight_key
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def connect_redis() -> redis.Redis:
+    """the proxy's redis, skips the calling test class when unreachable"""
+    proxy = redis.Redis(host=CONFIG.proxy.host, port=int(CONFIG.proxy.port))
+    try:
+        proxy.ping()
+    except redis.RedisError as e:
+        raise SkipTest(f"redis unavailable: {e}")
+    return proxy
+
+
+class ReplicaRoutingTests(TestCase):
+    """run with settings_test, which has a `replica_0` alias"""
+    databases = {'default', 'replica_0'}
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.router = ReplicaRouter()
+
+    def request(self, view, method='get', cookies=None, write=False):
+        """runs `view` through the middleware, returns (read alias, response)"""
+        routed = dict()
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            routed['read'] = self.router.db_for_read(ClientHubDevice)
+            if write:
+                self.router.db_for_write(ClientHubDevice)
+            return view(request)
+
+        middleware = ReplicaRoutingMiddleware(get_response)
+        request = getattr(self.factory, method)('/')
+        request.COOKIES.update(cookies or {})
+        response = middleware(request)
+        return routed['read'], response
+
+    def test_marked_views_read_from_replica(self):
+        read, _ = self.request(replica_reads(lambda r: HttpResponse()))
+        self.assertEqual(read, 'replica_0')
+
+    def test_other_views_read_from_primary(self):
+        read, _ = self.request(lambda r: HttpResponse())
+        self.assertEqual(read, 'default')
+
+    def test_pinned_client_reads_from_primary(self):
+        read, _ = self.request(replica_reads(lambda r: HttpResponse()),
+                               cookies={PIN_COOKIE: '1'})
+        self.assertEqual(read, 'default')
+
+    def test_post_without_write_is_not_pinned(self):
+        read, response = self.request(replica_reads(lambda r: HttpResponse()),
+                                      method='post')
+        self.assertEqual(read, 'default')
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_write_pins_client(self):
+        _, response = self.request(lambda r: HttpResponse(), write=True)
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+    def test_routing_ends_with_request(self):
+        self.request(replica_reads(lambda r: HttpResponse()))
+        self.assertEqual(self.router.db_for_read(ClientHubDevice), 'default')
+
+    def test_streamed_export_reads_from_replica(self):
+        rows = dict()
+
+        def view(request):
+            rows['hubs'] = export.dataset_rows('hubs', None)
+            return HttpResponse()
+
+        self.request(replica_reads(view))
+        # consumed after the request, as a streaming response is
+        with CaptureQueriesContext(connections['replica_0']) as replica:
+            list(rows['hubs'])
+        self.assertEqual(len(replica), 1)
+
+    def test_topology_is_built_from_primary(self):
+        proxy = connect_redis()
+        hub_pk = 2**31 - 1  # no rows, on SQLite writes lock the replica alias out
+        self.addCleanup(proxy.delete, topology_key(hub_pk),
+                        version_key(hub_pk))
+
+        def view(request):
+            with CaptureQueriesContext(connections['replica_0']) as replica:
+                cached_topology(proxy, hub_pk)
+            self.assertEqual(len(replica), 0)
+            return HttpResponse()
+
+        self.request(replica_reads(view))
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.proxy = connect_redis()
+        self.layer = f"test-{uuid.uuid4()}"
+        self.hub_id = uuid.uuid4()
+
+    def tearDown(self):
+        keys = self.proxy.keys(f"{CONFIG.proxy.channel}/ratelimit/{self.layer}/*")
+        if keys:
+            self.proxy.delete(*keys)
+        fields = [f for f in throttled_counts(self.proxy) if f.startswith(self.layer)]
+        if fields:
+            self.proxy.hdel(throttled_key(), *fields)
+        self.proxy.close()
+
+    def limiter(self, **limits):
+        return RateLimiter(self.layer, {'discovery': limits})
+
+    def take(self, limiter, account_id=1):
+        limiter.check(self.proxy,
+                      EDCommand.discovery,
+                      account_id=account_id,
+                      hub_id=self.hub_id)
+
+    def test_burst_then_refused_with_retry_after(self):
+        limiter = self.limiter(hub={'burst': 2, 'per_minute': 60})
+        self.take(limiter)
+        self.take(limiter)
+        with self.assertRaises(RateLimited) as refused:
+            self.take(limiter)
+        self.assertEqual(refused.exception.scope, 'hub')
+        # one token a second, rounded up to a tenth
+        self.assertGreater(refused.exception.retry_after, 0.8)
+        self.assertLessEqual(refused.exception.retry_after, 1.0)
+        self.assertEqual(
+            throttled_counts(self.proxy)[f"{self.layer}/hub/discovery"], 1)
+
+    def test_bucket_refills(self):
+        limiter = self.limiter(hub={'burst': 1, 'per_minute': 600})
+        self.take(limiter)
+        with self.assertRaises(RateLimited) as refused:
+            self.take(limiter)
+        time.sleep(refused.exception.retry_after + 0.05)
+        self.take(limiter)
+
+    def test_refused_command_takes_no_token(self):
+        limiter = self.limiter(account={'burst': 1, 'per_minute': 1},
+                               hub={'burst': 2, 'per_minute': 1})
+        self.take(limiter, account_id=1)
+        with self.assertRaises(RateLimited) as refused:
+            self.take(limiter, account_id=1)
+        self.assertEqual(refused.exception.scope, 'account')
+        # the hub still has the token the refused command didn't take
+        self.take(limiter, account_id=2)
+
+    def test_unlimited_command_is_not_checked(self):
+        limiter = self.limiter(hub={'burst': 1, 'per_minute': 1})
+        for _ in range(3):
+            limiter.check(self.proxy, EDCommand.diagnostics, hub_id=self.hub_id)
+
+
+class AdmitTests(SimpleTestCase):
+    """the manager's second check of the rate limits"""
+    def setUp(self):
+        mm = load_module('mqtt_manager', BASE_DIR / 'bin' / 'mqtt-manager.py')
+        self.manager = mm.ChannelManager(uuid.uuid4(), host='localhost')
+        self.layer = f"test-{uuid.uuid4()}"
+        self.manager.limiter = RateLimiter(
+            self.layer, {'discovery': {
+                'hub': {
+                    'burst': 1,
+                    'per_minute': 1
+                }
+            }})
+        self.hub = SimpleNamespace(hub_id=uuid.uuid4(), account_id=None)
+
+    def clear_limits(self, proxy):
+        keys = proxy.keys(f"{CONFIG.proxy.channel}/ratelimit/{self.layer}/*")
+        if keys:
+            proxy.delete(*keys)
+        proxy.hdel(throttled_key(), f"{self.layer}/hub/discovery")
+        proxy.close()
+
+    def test_refusal_clears_inflight_marker(self):
+        proxy = self.manager.proxy = connect_redis()
+        self.addCleanup(self.clear_limits, proxy)
+
+        self.assertTrue(self.manager.admit(self.hub, EDCommand.discovery))
+        marker = inflight_key(self.hub.hub_id, EDCommand.discovery)
+        proxy.set(marker, 1)
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(self.manager.admit(self.hub, EDCommand.discovery))
+        self.assertFalse(proxy.exists(marker))
+
+    def test_redis_errors_fail_open(self):
+        self.manager.proxy = redis.Redis(port=1, socket_connect_timeout=0.5)
+        with self.assertLogs(level='ERROR'):
+            self.assertTrue(self.manager.admit(self.hub, EDCommand.discovery))
+
+
+class BatchCallbackTests(TransactionTestCase):
+    """
+    A transaction test case, redis side effects of the batch
+    run on commit (see `ChannelManager.after_commit`).
+    """
+    def setUp(self):
+        mm = load_module('mqtt_manager', BASE_DIR / 'bin' / 'mqtt-manager.py')
+
+        # bulk_create skips the signup signals, which write to redis
+        User = get_user_model()
+        User.objects.bulk_create([User(username='batch')])
+        account = ClientAccount.objects.create(
+            user=User.objects.get(username='batch'))
+        self.hub = ClientHubDevice.objects.create(account=account,
+                                                  hub_id=uuid.uuid4(),
+                                                  hub_name='hub',
+                                                  connect_passphrase='x')
+
+        self.manager = mm.ChannelManager(uuid.uuid4(), host='localhost')
+        self.manager.proxy = object()  # only handed to the recorded effects
+        self.manager.subscribe_hub(self.hub.hub_id, self.hub.pk)
+        self.committed = list()
+
+        committed, hub = self.committed, self.hub
+
+        class NodeCallback:
+            """creates the node in the payload, nack packets then fail"""
+            def __init__(self, client, topic, packet):
+                self.client, self.packet = client, packet
+
+            def process(self):
+                NodeModule.objects.create(hub=hub,
+                                          address=self.packet.payload,
+                                          node_id=str(self.packet.payload),
+                                          operating_mode=1,
+                                          network_id=1,
+                                          hub_node_id=0,
+                                          last_seen=timezone.now())
+                self.client.after_commit("recording", lambda proxy, n: committed.append(n),
+                                         self.packet.payload)
+                if self.packet.command == EDCommand.nack:
+                    raise RuntimeError("handler failed")
+
+        class Batch(mm.BatchCallback):
+            _ROUTES = {'node': NodeCallback}
+
+        self.topic = f"{CONFIG.mqtt.root_channel}/{self.hub.hub_id}"
+        self.batch = Batch
+
+    def item(self, payload, cmd=EDCommand.ack, sender=None):
+        packet = EDPacket().set_command(cmd).set_payload(payload) \
+            .set_sender(sender or self.hub.hub_id)
+        return f"{self.topic}/node", pickle.dumps(packet)
+
+    def process(self, items):
+        envelope = EDPacket().set_command(EDCommand.ack).set_payload(items) \
+            .set_sender(self.hub.hub_id)
+        self.batch(self.manager, f"{self.topic}/batch", envelope).process()
+
+    def test_failing_packet_is_isolated(self):
+        self.process([
+            self.item(1),
+            self.item(2, cmd=EDCommand.nack),
+            (f"{self.topic}/node", b'garbage'),
+            'not an item',
+            self.item(3, sender=uuid.uuid4()),
+            self.item(4),
+        ])
+        self.assertEqual(
+            sorted(NodeModule.objects.values_list('address', flat=True)),
+            [1, 4])
+        self.assertEqual(self.committed, [1, 4])
+
+    def test_effects_wait_for_the_batch_commit(self):
+        self.process([self.item(1), self.item(2)])
+        self.assertEqual(self.committed, [1, 2])
+        self.assertEqual(NodeModule.objects.count(), 2)
+
+
+class CommandLanesTests(SimpleTestCase):
+    def lanes(self, max_depth=100):
+        return CommandLanes({INTERACTIVE: 8, SCHEDULED: 2, BULK: 1},
+                            {lane: max_depth for lane in LANES})
+
+    def run_all(self, lanes, queued):
+        """starts the worker on `queued` (lane, item) pairs, returns the order run"""
+        done, order = threading.Event(), list()
+
+        def run(lane, item):
+            order.append((lane, item))
+            if len(order) == len(queued):
+                done.set()
+
+        for lane, item in queued:
+            self.assertTrue(lanes.put(lane, run, lane, item))
+        lanes.start()
+        self.addCleanup(lanes.stop)
+        self.assertTrue(done.wait(5))
+        return order
+
+    def test_weighted_share_of_busy_lanes(self):
+        queued = [(lane, i) for lane in LANES for i in range(22)]
+        order = self.run_all(self.lanes(), queued)
+        first = [lane for lane, _ in order[:22]]
+        self.assertEqual([first.count(lane) for lane in LANES], [16, 4, 2])
+        # smooth: bulk isn't held back until the end of a round
+        self.assertIn(BULK, first[:11])
+
+    def test_lanes_are_fifo(self):
+        queued = [(lane, i) for lane in LANES for i in range(5)]
+        order = self.run_all(self.lanes(), queued)
+        for lane in LANES:
+            self.assertEqual([i for l, i in order if l == lane], list(range(5)))
+
+    def test_idle_lanes_give_their_share(self):
+        order = self.run_all(self.lanes(), [(BULK, i) for i in range(5)])
+        self.assertEqual(order, [(BULK, i) for i in range(5)])
+
+    def test_full_lane_drops(self):
+        lanes = self.lanes(max_depth=2)
+        with self.assertLogs(level='WARNING'):
+            results = [lanes.put(BULK, lambda: None) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(lanes.describe()[BULK]['dropped'], 1)
+        self.assertEqual(len(lanes), 2)
+
+    def test_failing_work_is_counted(self):
+        lanes = self.lanes()
+        lanes.put(INTERACTIVE, lambda: 1 / 0)
+        with self.assertLogs(level='ERROR'):
+            self.run_all(lanes, [(INTERACTIVE, 'after')])
+        self.assertEqual(lanes.describe()[INTERACTIVE]['failed'], 1)
+
+
+class DbResilientTests(SimpleTestCase):
+    def failing(self, failures, done=None, backoff=0.01, **kwargs):
+        """work failing `failures` times with a connection error"""
+        calls = list()
+
+        @db_resilient(backoff=backoff, **kwargs)
+        def work():
+            calls.append(threading.current_thread().name)
+            if len(calls) <= failures:
+                raise OperationalError("server closed the connection")
+            if done:
+                done.set()
+            return 'ok'
+
+        return work, calls
+
+    def test_retries_inline(self):
+        work, calls = self.failing(2, retries=3)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(work(), 'ok')
+        self.assertEqual(len(calls), 3)
+
+    def test_out_of_retries_raises(self):
+        work, _ = self.failing(5, retries=1)
+        with self.assertLogs(level='WARNING'), \
+                self.assertRaises(OperationalError):
+            work()
+
+    def test_deferred_retries_run_in_background(self):
+        done = threading.Event()
+        work, calls = self.failing(2,
+                                   done=done,
+                                   backoff=0.2,
+                                   retries=3,
+                                   defer=True)
+        with self.assertLogs(level='WARNING'):
+            started = time.monotonic()
+            self.assertIsNone(work())
+            # the caller (paho's network thread) never waits for a backoff
+            self.assertLess(time.monotonic() - started, 0.2)
+            self.assertTrue(done.wait(5))
+        self.assertEqual(calls[0], threading.current_thread().name)
+        self.assertEqual(calls[1:], ['db-retries', 'db-retries'])
+
+    def test_deferred_work_out_of_retries_is_dropped(self):
+        failures = DB_STATS.failures
+        work, calls = self.failing(5, retries=1, defer=True)
+        with self.assertLogs(level='WARNING'):
+            work()
+            for _ in range(500):
+                if DB_STATS.failures > failures:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(DB_STATS.failures, failures + 1)
+
+
+class GuardedCallbackTests(SimpleTestCase):
+    def test_exception_does_not_reach_paho(self):
+        mm = load_module('mqtt_manager', BASE_DIR / 'bin' / 'mqtt-manager.py')
+
+        def callback(client, userdata, msg):
+            raise OperationalError("server closed the connection")
+
+        msg = mqtt.MQTTMessage(topic=b'/eagledaddy/announce')
+        with self.assertLogs(level='ERROR'):
+            mm.ChannelManager._guarded(callback)(None, None, msg)
+
+
+class ProxyMessageLaneTests(SimpleTestCase):
+    def setUp(self):
+        mm = load_module('mqtt_manager', BASE_DIR / 'bin' / 'mqtt-manager.py')
+        self.handle = mm.ChannelManager.handle_proxy_message
+        self.lanes = CommandLanes({lane: 1 for lane in LANES},
+                                  {lane: 10 for lane in LANES})
+        self.hub_id = uuid.uuid4()
+
+    def queued(self, data):
+        manager = SimpleNamespace(lanes=self.lanes, send_proxy_command=None)
+        self.handle(manager, dict(data=json.dumps(data)))
+        return {
+            lane: stats['depth']
+            for lane, stats in self.lanes.describe().items()
+        }
+
+    def test_untagged_commands_are_bulk(self):
+        depth = self.queued({str(self.hub_id): int(EDCommand.discovery)})
+        self.assertEqual(depth, {INTERACTIVE: 0, SCHEDULED: 0, BULK: 1})
+
+    def test_tagged_commands_keep_their_lane(self):
+        depth = self.queued({
+            str(self.hub_id): int(EDCommand.discovery),
+            'priority': INTERACTIVE
+        })
+        self.assertEqual(depth, {INTERACTIVE: 1, SCHEDULED: 0, BULK: 0})
+
+
+class TelemetryWriterTests(TestCase):
+    def readings(self, count):
+        now = timezone.now()
+        return [(1, f"{i:016x}", 'feed', float(i), now) for i in range(count)]
+
+    def test_full_buffer_blocks_then_drops(self):
+        writer = TelemetryWriter(buffer_size=2, put_timeout=0.2)
+        started = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            writer.put(self.readings(3))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual((writer.accepted, writer.dropped), (2, 1))
+
+    def test_put_timeout_bounds_the_whole_call(self):
+        writer = TelemetryWriter(buffer_size=1, put_timeout=0.2)
+        started = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            writer.put(self.readings(5))
+        # not a timeout per reading
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual((writer.accepted, writer.dropped), (1, 4))
+
+    def test_put_waits_for_room(self):
+        writer = TelemetryWriter(buffer_size=1, put_timeout=5)
+        writer.put(self.readings(1))
+        threading.Timer(0.1, writer._buffer.get).start()
+        writer.put(self.readings(1))
+        self.assertEqual((writer.accepted, writer.dropped), (2, 0))
+
+    def test_batches_of_batch_size(self):
+        writer = TelemetryWriter(batch_size=2, flush_interval=5)
+        writer.put(self.readings(3))
+        self.assertEqual(len(writer._take_batch()), 2)
+
+    def test_partial_batch_after_flush_interval(self):
+        writer = TelemetryWriter(batch_size=100, flush_interval=0.1)
+        writer.put(self.readings(3))
+        started = time.monotonic()
+        self.assertEqual(len(writer._take_batch()), 3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    def test_flush_writes_readings(self):
+        writer = TelemetryWriter()
+        writer.flush(self.readings(3))
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(
+            sorted(NodeTelemetry.objects.values_list('value', flat=True)),
+            [0.0, 1.0, 2.0])
+
+    def test_failed_flush_is_not_counted(self):
+        writer = TelemetryWriter()
+        writer._write = lambda batch: 1 / 0
+        with self.assertLogs(level='ERROR'):
+            writer.flush(self.readings(3))
+        self.assertEqual(writer.written, 0)
+
+    def test_stop_drains_the_buffer(self):
+        writer = TelemetryWriter(batch_size=2, flush_interval=0.05)
+        batches = list()
+        writer.flush = batches.append
+        writer.put(self.readings(5))
+        writer.stop()
+        writer.start()
+        writer.join(timeout=5)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+
+class FleetAggregateTests(TestCase):
+    def setUp(self):
+        self.proxy = connect_redis()
+        self.addCleanup(self.clear_aggregates)
+        self.clear_aggregates()
+
+        User = get_user_model()
+        # bulk_create skips the signup signals, which write to redis
+        User.objects.bulk_create([User(username='fleet')])
+        self.account = ClientAccount.objects.create(
+            user=User.objects.get(username='fleet'))
+        now = timezone.now()
+        self.online = self.hub(last_checkin=now)
+        self.offline = self.hub(last_checkin=now - timedelta(days=1))
+        self.nodes(self.online, 2)
+        self.nodes(self.offline, 1)
+
+    def clear_aggregates(self):
+        keys = list(self.proxy.scan_iter(match=fleet.nodes_key('*')))
+        keys += list(self.proxy.scan_iter(match=fleet.checkins_key('*')))
+        if keys:
+            self.proxy.delete(*keys)
+
+    def hub(self, **fields):
+        return ClientHubDevice.objects.create(account=self.account,
+                                              hub_id=uuid.uuid4(),
+                                              connect_passphrase='x',
+                                              **fields)
+
+    def nodes(self, hub, count):
+        NodeModule.objects.bulk_create([
+            NodeModule(hub=hub,
+                       address=i,
+                       hub_node_id=0,
+                       node_id=f"node {i}",
+                       operating_mode=1,
+                       network_id=1) for i in range(count)
+        ])
+
+    def summary(self):
+        return fleet.fleet_summary(self.proxy, self.account.pk,
+                                   online_window=3600)
+
+    def test_summary_is_built_on_a_miss(self):
+        summary = self.summary()
+        self.assertEqual((summary['hubs'], summary['online'], summary['nodes']),
+                         (2, 1, 3))
+        self.assertEqual(summary['nodes_per_hub'], {
+            str(self.online.hub_id): 2,
+            str(self.offline.hub_id): 1
+        })
+        self.assertEqual(summary['last_checkin'].timestamp(),
+                         self.online.last_checkin.timestamp())
+
+    def test_updates_apply_to_built_aggregates(self):
+        self.summary()
+        fleet.record_checkin(self.proxy, self.account.pk, self.offline.hub_id,
+                             timezone.now())
+        fleet.add_nodes(self.proxy, self.account.pk, self.offline.hub_id, 4)
+        summary = self.summary()
+        self.assertEqual((summary['online'], summary['nodes']), (2, 7))
+
+    def test_updates_skip_missing_aggregates(self):
+        fleet.add_nodes(self.proxy, self.account.pk, self.online.hub_id, 4)
+        fleet.record_checkin(self.proxy, self.account.pk, self.online.hub_id,
+                             timezone.now())
+        self.assertFalse(self.proxy.exists(fleet.nodes_key(self.account.pk),
+                                           fleet.checkins_key(self.account.pk)))
+
+    def test_reconcile_corrects_drift_and_drops_stale_accounts(self):
+        self.summary()
+        fleet.add_nodes(self.proxy, self.account.pk, self.online.hub_id, 5)
+        self.proxy.hset(fleet.nodes_key(0), 'total', 1)
+
+        self.assertEqual(fleet.reconcile(self.proxy), {
+            'accounts': 1,
+            'drifted': 1,
+            'dropped': 1
+        })
+        self.assertEqual(self.summary()['nodes'], 3)
+        self.assertFalse(self.proxy.exists(fleet.nodes_key(0)))
+
+    def test_reconcile_keeps_updates_made_while_it_runs(self):
+        self.summary()
+        write, discovered = fleet._write, threading.Event()
+
+        def discovery_during_reconcile(pipe, *args):
+            # after the counts were read, before they are written
+            if not discovered.is_set():
+                discovered.set()
+                self.nodes(self.online, 1)
+                fleet.add_nodes(self.proxy, self.account.pk,
+                                self.online.hub_id, 1)
+            write(pipe, *args)
+
+        with mock.patch.object(fleet, '_write', discovery_during_reconcile):
+            self.assertEqual(fleet.reconcile(self.proxy)['drifted'], 0)
+        self.assertEqual(self.summary()['nodes'], 4)
+
+
+class ManagerSettingsTests(SimpleTestCase):
+    """the manager's settings profile, in a fresh interpreter each"""
+    def start_manager(self, secret_key):
+        env = dict(os.environ,
+                   DJANGO_SETTINGS_MODULE='EagleDaddyCloud.settings_manager',
+                   DJANGO_SECRET_KEY=secret_key,
+                   PYTHONPATH=str(BASE_DIR))
+        script = ("import importlib.util as u, sys; "
+                  "s = u.spec_from_file_location('mm', sys.argv[1]); "
+                  "s.loader.exec_module(u.module_from_spec(s)); "
+                  "from django.conf import settings; print(settings.DEBUG)")
+        with tempfile.TemporaryDirectory() as cwd:  # for its log file
+            return subprocess.run(
+                [sys.executable, '-c', script,
+                 str(BASE_DIR / 'bin' / 'mqtt-manager.py')],
+                cwd=cwd, env=env, capture_output=True, text=True, timeout=60)
+
+    def test_manager_starts_with_its_profile(self):
+        result = self.start_manager('manager')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), 'False')
+
+    def test_secret_key_is_required(self):
+        result = self.start_manager('')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("DJANGO_SECRET_KEY must be set", result.stderr)
+
+
+class ProfilerTests(SimpleTestCase):
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_next_profile_is_not_written_into_the_previous(self):
+        profiler = Profiler()
+        dump = profiler._dump
+        dumping, release = threading.Event(), threading.Event()
+
+        def held_dump(*args):
+            dumping.set()
+            release.wait(5)
+            dump(*args)
+
+        profiler._dump = held_dump
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        first, second = Path(tmp.name) / 'first', Path(tmp.name) / 'second'
+        with self.assertLogs(level='INFO'):
+            profiler.start(0.1, sample_interval=0.01, output_dir=first)
+            profiler.record('first', 'ping', 0.001, 0, 0)
+            self.assertTrue(dumping.wait(5))
+            # the first profile is being written while the next one runs
+            profiler.start(0.1, sample_interval=0.01, output_dir=second)
+            profiler.record('second', 'ping', 0.001, 0, 0)
+            release.set()
+            self.wait_for(lambda: list(first.glob('*.json')) and list(
+                second.glob('*.json')))
+
+        for directory, key in ((first, 'first/ping'), (second, 'second/ping')):
+            report = json.loads(next(directory.glob('*.json')).read_text())
+            self.assertEqual(list(report['callbacks']), [key])
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        old = timezone.now() - timedelta(days=30)
+        self.stale = [self.hub(old, nodes=2) for _ in range(3)]
+        self.fresh = self.hub(timezone.now(), nodes=1)
+
+    def hub(self, last_checkin, nodes):
+        hub = ClientHubDevice.objects.create(hub_id=uuid.uuid4(),
+                                             connect_passphrase='x',
+                                             last_checkin=last_checkin)
+        CommandResponseFlag.objects.create(hub=hub)
+        CommandDiagnosticsResponse.objects.create(hub=hub, report={})
+        ScheduledCommand.objects.create(hub=hub, command=1, interval=60)
+        NodeModule.objects.bulk_create([
+            NodeModule(hub=hub,
+                       address=i,
+                       hub_node_id=0,
+                       node_id=f"node {i}",
+                       operating_mode=1,
+                       network_id=1) for i in range(nodes)
+        ])
+        return hub
+
+    def purge_hubs(self, **kwargs):
+        """the purge's counts and the (nodes, hubs) after every chunk"""
+        steps = list()
+
+        def progress(counts):
+            steps.append((counts['broker.NodeModule'],
+                          counts['broker.ClientHubDevice']))
+
+        counts = retention.purge(retention.stale_hubs(7),
+                                 chunk_size=2,
+                                 progress=progress,
+                                 **kwargs)
+        return counts, steps
+
+    def test_nodes_are_purged_in_chunks_before_their_hubs(self):
+        _, steps = self.purge_hubs()
+        self.assertEqual(steps, [(2, 0), (4, 0), (4, 2), (6, 2), (6, 3)])
+        self.assertEqual(
+            list(ClientHubDevice.objects.values_list('pk', flat=True)),
+            [self.fresh.pk])
+        self.assertEqual(NodeModule.objects.count(), 1)
+
+    def test_cascade_counts(self):
+        counts, _ = self.purge_hubs()
+        self.assertEqual(
+            counts, {
+                'broker.ClientHubDevice': 3,
+                'broker.NodeModule': 6,
+                'broker.CommandResponseFlag': 3,
+                'broker.CommandDiagnosticsResponse': 3,
+                'broker.ScheduledCommand': 3,
+            })
+        for model in (CommandResponseFlag, CommandDiagnosticsResponse,
+                      ScheduledCommand):
+            self.assertEqual(model.objects.get().hub_id, self.fresh.pk)
+
+    def test_dry_run_counts_without_deleting(self):
+        counts, steps = self.purge_hubs(dry_run=True)
+        self.assertEqual(steps, [(2, 0), (4, 0), (4, 2), (6, 2), (6, 3)])
+        self.assertEqual(counts, {
+            'broker.ClientHubDevice': 3,
+            'broker.NodeModule': 6
+        })
+        self.assertEqual(ClientHubDevice.objects.count(), 4)
+        self.assertEqual(NodeModule.objects.count(), 7)
+
+    def test_purge_fleet_dry_run(self):
+        out = io.StringIO()
+        call_command('purge_fleet', '--dry-run', '--hub-days=7',
+                     '--node-days=7', '--diagnostics-days=7', stdout=out)
+        self.assertEqual(
+            out.getvalue().splitlines()[-1],
+            "would delete {'broker.NodeModule': 6, 'broker.ClientHubDevice': 3}")
+        self.assertEqual(ClientHubDevice.objects.count(), 4)
+
+    def test_stale_nodes(self):
+        NodeModule.objects.filter(hub=self.fresh).update(
+            last_seen=timezone.now() - timedelta(days=30))
+        counts = retention.apply_retention(node_days=7, chunk_size=2)
+        self.assertEqual(counts, {'broker.NodeModule': 1})
+        self.assertEqual(ClientHubDevice.objects.count(), 4)
+
+    def test_expired_diagnostics(self):
+        CommandDiagnosticsResponse.objects.filter(hub__in=self.stale).update(
+            updated_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(
+            retention.apply_retention(diagnostics_days=7, chunk_size=2),
+            {'broker.CommandDiagnosticsResponse': 3})
+        self.assertEqual(CommandDiagnosticsResponse.objects.get().hub_id,
+                         self.fresh.pk)
+
+
+class AdminChangeListTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        # bulk_create skips the signup signals, which write to redis
+        User.objects.bulk_create(
+            [User(username='admin', is_staff=True, is_superuser=True)])
+        self.client.force_login(User.objects.get(username='admin'))
+        self.hubs = [
+            ClientHubDevice.objects.create(hub_id=uuid.uuid4(),
+                                           connect_passphrase='x')
+            for _ in range(3)
+        ]
+        NodeModule.objects.create(hub=self.hubs[0],
+                                  address=address_to_int('0013a20041bd3346'),
+                                  hub_node_id=0,
+                                  node_id='node',
+                                  operating_mode=1,
+                                  network_id=1)
+
+    def changelist(self, model, **params):
+        url = reverse(f"admin:broker_{model}_changelist")
+        return self.client.get(url, params)
+
+    def assertRejected(self, response, model):
+        """the admin's redirect for incorrect lookup parameters"""
+        url = reverse(f"admin:broker_{model}_changelist")
+        self.assertRedirects(response,
+                             f"{url}?e=1",
+                             fetch_redirect_response=False)
+
+    def test_pages_by_keyset(self):
+        newest, middle, oldest = reversed(self.hubs)
+        with mock.patch.object(ClientHubDeviceAdmin, 'list_per_page', 2):
+            first = self.changelist('clienthubdevice')
+            self.assertEqual(list(first.context['cl'].result_list),
+                             [newest, middle])
+            self.assertContains(first, f"?{CURSOR_VAR}={middle.pk}")
+
+            last = self.changelist('clienthubdevice',
+                                   **{CURSOR_VAR: middle.pk})
+        self.assertEqual(list(last.context['cl'].result_list), [oldest])
+        self.assertIsNone(last.context['cl'].next_cursor)
+        self.assertEqual(last.context['cl'].result_count, 3)
+
+    def test_bad_cursor_redirects(self):
+        response = self.changelist('clienthubdevice', **{CURSOR_VAR: 'x'})
+        self.assertRejected(response, 'clienthubdevice')
+
+    def test_address_filter(self):
+        response = self.changelist('nodemodule', address='13A20041BD3346')
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+
+        response = self.changelist('nodemodule', address='zz')
+        self.assertRejected(response, 'nodemodule')
+
+
+class HexToIntTests(SimpleTestCase):
+    def test_converts_hex_and_passes_ints(self):
+        self.assertEqual(hex_to_int('7fff'), 0x7FFF)
+        self.assertEqual(hex_to_int(1), 1)
+
+    def test_rejects_values_out_of_smallint_range(self):
+        for value in ('8000', 'ffffffff', -1):
+            with self.assertRaises(ValueError):
+                hex_to_int(value)
+
+
+class CompactNodeFieldsMigrationTests(TransactionTestCase):
+    """broker 0002, hex strings of existing nodes to integers"""
+    before = [('broker', '0001_initial')]
+    after = [('broker', '0002_compact_node_fields')]
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        with contextlib.redirect_stdout(io.StringIO()):
+            executor.migrate(target)
+        return executor.loader.project_state(target).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def nodes(self, apps):
+        NodeModule = apps.get_model('broker', 'NodeModule')
+        return list(
+            NodeModule.objects.order_by('pk').values_list(
+                'address', 'hub_node_id', 'operating_mode', 'network_id'))
+
+    def test_converts_hex_and_deletes_invalid_nodes(self):
+        apps = self.migrate(self.before)
+        hub = apps.get_model('broker', 'ClientHubDevice').objects.create(
+            hub_id=uuid.uuid4(), connect_passphrase='x')
+        NodeModule = apps.get_model('broker', 'NodeModule')
+        for address, mode, network in (
+            ('0013a20041bd3346', '01', '7fff'),
+            ('ffffffffffffffff', '02', '0001'),
+            ('zz', '01', '7fff'),  # not hex
+            ('0013a200', '01', '7fff'),  # not 64 bits
+            ('0013a20041bd3347', '01', '8000'),  # beyond a smallint
+        ):
+            NodeModule.objects.create(hub=hub,
+                                      address=address,
+                                      hub_node_id='0013a20041bd3300',
+                                      node_id='node',
+                                      operating_mode=mode,
+                                      network_id=network)
+
+        parent = 0x0013a20041bd3300
+        self.assertEqual(self.nodes(self.migrate(self.after)), [
+            (0x0013a20041bd3346, parent, 1, 0x7FFF),
+            (-1, parent, 2, 1),
+        ])
+        self.assertEqual(self.nodes(self.migrate(self.before)), [
+            ('0013a20041bd3346', '0013a20041bd3300', '01', '7fff'),
+            ('ffffffffffffffff', '0013a20041bd3300', '02', '0001'),
+        ])
@@ -0,0 +1,189 @@
+"""
+Mesh topology of a hub's DigiMesh network.
+
+Every node reports its parent (`hub_node_id`). Nodes whose parent is
+another node of the hub hang below it. The most common parent outside
+the node set is the hub's own radio, the root of the mesh at depth 0.
+Nodes that cannot be reached from the root, because their parent is
+unknown or part of a loop, are reported as orphans.
+
+Graphs are cached in redis, serialized, with the version of the hub's
+node set they were built from:
+
+    <proxy channel>/topology/<hub pk>          hash, version + graph json
+    <proxy channel>/topology/<hub pk>/version  node set version counter
+
+The manager merges each discovery result into the cached graph and
+bumps the version. Removing a node only bumps the version, and the next
+read rebuilds the graph from the database. Readers get the cached json
+as is, so a page view costs two redis lookups, not a graph build.
+"""
+
+import json
+from collections import Counter, deque
+from typing import Dict, Iterable, Tuple
+
+import redis
+from django.db import DEFAULT_DB_ALIAS
+
+from EagleDaddyCloud.settings import CONFIG
+from broker.models import NodeModule, address_to_hex, address_to_int
+
+# address -> (parent address, node_id)
+Parents = Dict[int, Tuple[int, str]]
+
+
+def topology_key(hub_pk) -> str:
+    return f"{CONFIG.proxy.channel}/topology/{hub_pk}"
+
+
+def version_key(hub_pk) -> str:
+    return f"{topology_key(hub_pk)}/version"
+
+
+class MeshTopology:
+    def __init__(self, parents: Parents):
+        self.parents = dict(parents)
+
+    @classmethod
+    def from_database(cls, hub_pk, using=DEFAULT_DB_ALIAS):
+        """
+        from the primary by default, cached graphs are served to every
+        reader as the current version, a replica's may be behind it.
+        """
+        rows = NodeModule.objects.using(using).filter(
+            hub_id=hub_pk).values_list('address', 'hub_node_id', 'node_id')
+        return cls({address: (parent, node_id)
+                    for address, parent, node_id in rows})
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls({
+            address_to_int(address):
+            (address_to_int(node['parent']), node['node_id'])
+            for address, node in data['nodes'].items()
+        })
+
+    def merge(self, parents: Parents):
+        """nodes of a discovery result, new or with changed parents"""
+        self.parents.update(parents)
+
+    def root(self):
+        outside = Counter(parent for parent, _ in self.parents.values()
+                          if parent not in self.parents)
+        return outside.most_common(1)[0][0] if outside else None
+
+    def to_dict(self, version=None):
+        # int to hex conversion dominates for large meshes, do it once
+        hexed = {address: address_to_hex(address) for address in self.parents}
+        root = self.root()
+        children = {address: list() for address in self.parents}
+        children[root] = list()
+        for address, (parent, _) in self.parents.items():
+            if parent in children:
+                children[parent].append(address)
+
+        depth = {root: 0}
+        queue = deque([root])
+        while queue:
+            address = queue.popleft()
+            for child in children[address]:
+                if child not in depth:
+                    depth[child] = depth[address] + 1
+                    queue.append(child)
+
+        nodes = dict()
+        for address, (parent, node_id) in self.parents.items():
+            nodes[hexed[address]] = {
+                'node_id': node_id,
+                'parent': hexed.get(parent) or address_to_hex(parent),
+                'depth': depth.get(address),
+                'children': [hexed[c] for c in children[address]],
+            }
+
+        return {
+            'version': version,
+            'root': address_to_hex(root) if root is not None else None,
+            'root_children': [hexed[c] for c in children[root]],
+            'node_count': len(nodes),
+            'max_depth': max(depth.values()),
+            'orphans': sorted(hexed[a] for a in self.parents
+                              if a not in depth),
+            'nodes': nodes,
+        }
+
+
+def _store(pipe, hub_pk, version, graph: str):
+    pipe.hset(topology_key(hub_pk),
+              mapping={
+                  'version': version,
+                  'graph': graph,
+              })
+
+
+def _read(proxy, hub_pk):
+    """(node set version, cached graph json or None if outdated)"""
+    version = int(proxy.get(version_key(hub_pk)) or 0)
+    cached_version, graph = proxy.hmget(topology_key(hub_pk), 'version',
+                                        'graph')
+    if graph is None or int(cached_version) != version:
+        return version, None
+    return version, graph.decode()
+
+
+def update_topology(proxy: redis.Redis, hub_pk,
+                    nodes: Iterable[Tuple[int, int, str]]):
+    """
+    Merges discovered (address, parent, node_id) triples into the cached
+    graph of a hub. Falls back to a rebuild from the database, which
+    must already hold the nodes, when there is no current graph or the
+    node set changed concurrently.
+    """
+    parents = {address: (parent, node_id) for address, parent, node_id in nodes}
+    with proxy.pipeline() as pipe:
+        try:
+            pipe.watch(version_key(hub_pk))
+            version, graph = _read(pipe, hub_pk)
+            if graph is not None:
+                topology = MeshTopology.from_dict(json.loads(graph))
+                topology.merge(parents)
+            else:
+                topology = MeshTopology.from_database(hub_pk)
+
+            version += 1
+            graph = json.dumps(topology.to_dict(version))
+            pipe.multi()
+            pipe.set(version_key(hub_pk), version)
+            _store(pipe, hub_pk, version, graph)
+            pipe.execute()
+        except redis.WatchError:
+            invalidate_topology(proxy, hub_pk)
+
+
+def invalidate_topology(proxy: redis.Redis, hub_pk):
+    """the node set of the hub changed, next read rebuilds the graph"""
+    proxy.incr(version_key(hub_pk))
+
+
+def cached_topology(proxy: redis.Redis, hub_pk) -> Tuple[int, str]:
+    """
+    (version, graph json) of a hub, rebuilt from the
+    database if the cached graph is missing or outdated.
+    """
+    version, graph = _read(proxy, hub_pk)
+    if graph is not None:
+        return version, graph
+
+    with proxy.pipeline() as pipe:
+        try:
+            pipe.watch(version_key(hub_pk))
+            version = int(pipe.get(version_key(hub_pk)) or 0)
+            graph = json.dumps(
+                MeshTopology.from_database(hub_pk).to_dict(version))
+            pipe.multi()
+            _store(pipe, hub_pk, version, graph)
+            pipe.execute()
+        except redis.WatchError:
+            # changed while building, still the freshest graph we have
+            pass
+    return version, graph
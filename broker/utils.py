@@ -1,8 +1,135 @@
 import redis
 import json
 from EagleDaddyCloud.settings import CONFIG
+from broker.ratelimit import RateLimited, RateLimiter
+
+_DEFAULT_INFLIGHT_WINDOW = 60
+_LIMITER = RateLimiter('web')
 
 
 def send_proxy_data(connection_pool: redis.ConnectionPool, data: dict):
+    """
+    Publishes `data` to the manager, ie: {"<hub_id>": <EDCommand value>,
+    ..., "priority": "bulk"}. `priority` names the manager's lane for
+    the commands (see `broker.lanes`), the configured default if omitted.
+    """
     with redis.Redis(connection_pool=connection_pool) as proxy:
         return proxy.publish(CONFIG.proxy.channel, json.dumps(data))
+
+
+def inflight_key(hub_id, cmd) -> str:
+    return f"{CONFIG.proxy.channel}/inflight/{hub_id}/{int(cmd)}"
+
+
+def inflight_window(cmd) -> int:
+    return int(CONFIG.proxy.inflight_window.get(cmd.name,
+                                                _DEFAULT_INFLIGHT_WINDOW))
+
+
+def _command_message(hub_id, cmd, priority=None) -> str:
+    data = {str(hub_id): int(cmd)}
+    if priority is not None:
+        data['priority'] = priority
+    return json.dumps(data)
+
+
+def send_proxy_command(connection_pool: redis.ConnectionPool,
+                       hub_id,
+                       cmd,
+                       account_id=None,
+                       priority=None,
+                       before_publish=None):
+    """
+    Single-flight send of `cmd` to a hub through the proxy.
+
+    Only the first request for a (hub, command) pair publishes, identical
+    requests made while it is in flight attach to it instead. The in-flight
+    marker lives in redis so this holds across web workers, it is cleared by
+    the manager once the hub responds or expires after the commands window.
+
+    Requests that would publish are checked against the rate limits of
+    the hub and `account_id` first, see `broker.ratelimit`.
+
+    `priority` is the manager's lane for the command, see `send_proxy_data`.
+
+    `before_publish()` is called once the request is known to publish,
+    before it does, ie: to reset the response flag of the command so
+    the hub's answer can't arrive before it.
+
+    Returns:
+        (sent, receivers): `sent` is False when the request was coalesced
+        into one already in flight.
+
+    Raises:
+        RateLimited: the command is over one of its limits
+    """
+    key = inflight_key(hub_id, cmd)
+    with redis.Redis(connection_pool=connection_pool) as proxy:
+        if not proxy.set(key, 1, nx=True, ex=inflight_window(cmd)):
+            return False, 0
+
+        try:
+            _LIMITER.check(proxy, cmd, account_id=account_id, hub_id=hub_id)
+            if before_publish is not None:
+                before_publish()
+        except Exception:
+            proxy.delete(key)
+            raise
+
+        receivers = proxy.publish(CONFIG.proxy.channel,
+                                  _command_message(hub_id, cmd, priority))
+        if not receivers:
+            # nobody is listening, don't hold back retries
+            proxy.delete(key)
+        return True, receivers
+
+
+async def send_proxy_command_async(
+        connection_pool: 'redis.asyncio.ConnectionPool',
+        hub_id,
+        cmd,
+        account_id=None,
+        priority=None,
+        before_publish=None):
+    """
+    asyncio version of `send_proxy_command`, same single-flight
+    semantics and rate limits, `before_publish` is a coroutine function
+    """
+    # imported here, the manager loads this module but never needs it
+    import redis.asyncio as aioredis
+
+    key = inflight_key(hub_id, cmd)
+    proxy = aioredis.Redis(connection_pool=connection_pool)
+    if not await proxy.set(key, 1, nx=True, ex=inflight_window(cmd)):
+        return False, 0
+
+    try:
+        await _LIMITER.check_async(proxy,
+                                   cmd,
+                                   account_id=account_id,
+                                   hub_id=hub_id)
+        if before_publish is not None:
+            await before_publish()
+    except Exception:
+        await proxy.delete(key)
+        raise
+
+    receivers = await proxy.publish(CONFIG.proxy.channel,
+                                    _command_message(hub_id, cmd, priority))
+    if not receivers:
+        await proxy.delete(key)
+    return True, receivers
+
+
+def clear_inflight(proxy: redis.Redis, hub_id, cmd):
+    """marks the (hub, command) pair as completed"""
+    return proxy.delete(inflight_key(hub_id, cmd))
+
+
+def send_proxy_control(connection_pool: redis.ConnectionPool, control: str,
+                       **params):
+    """
+    Control messages address the manager itself rather than a hub,
+    ie: {"control": "profile", "seconds": 30}
+    """
+    return send_proxy_data(connection_pool, dict(control=control, **params))
@@ -0,0 +1,161 @@
+"""
+asyncio versions of the dashboard's ajax views, used when
+the app is served through ASGI (`settings.ASYNC_VIEWS`).
+
+Redis is talked to through an asyncio connection pool, so a slow
+redis no longer pins a worker thread per request. Django 3.1 has no
+async ORM, the views' reads run on the executor's threads (see
+`_db_read`) rather than the single thread all of a request's sync code
+shares, so concurrent requests don't queue on each other's queries.
+"""
+
+import functools
+import logging
+
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http.response import JsonResponse
+from django.urls import reverse
+
+from broker.models import ClientHubDevice, CommandDiagnosticsResponse, NodeModule, address_to_hex
+
+from edcomms import EDCommand
+from EagleDaddyCloud.settings import CONFIG
+from broker.lanes import INTERACTIVE
+from broker.ratelimit import RateLimited
+from broker.utils import send_proxy_command_async
+from dashboard.views import rate_limited_response
+
+_ASYNC_REDIS_POOL = aioredis.ConnectionPool(host=CONFIG.proxy.host,
+                                            port=int(CONFIG.proxy.port),
+                                            health_check_interval=15)
+
+
+def _db_read(func):
+    """
+    `func` (database reads only) made awaitable, run on a thread of the
+    executor. Those threads never see request_started/finished, so their
+    connections are recycled here the way the signals would, closing
+    ones past CONN_MAX_AGE or left unusable by an error.
+    """
+    @functools.wraps(func)
+    def read(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(read, thread_sensitive=False)
+
+
+@_db_read
+def _get_hub(hub_id):
+    return ClientHubDevice.objects.filter(hub_id=hub_id).first()
+
+
+@_db_read
+def _get_ready_diagnostics(hub_id):
+    hub = ClientHubDevice.objects.filter(hub_id=hub_id).first()
+    if not hub or not hub.diagnostics_ready():
+        return None
+
+    report = CommandDiagnosticsResponse.objects.filter(hub=hub).first()
+    return None if not report else report.report
+
+
+@_db_read
+def _list_nodes():
+    return list(NodeModule.objects.values_list('address', 'node_id'))
+
+
+async def _send_command(hub_id, cmd: EDCommand, before_publish=None):
+    """
+    `before_publish(hub)` is awaited when the command is about to be
+    published, see `send_proxy_command`.
+
+    Returns (hub, receivers, error response)
+    """
+    if not hub_id:
+        return None, 0, JsonResponse(
+            {'response': "hub_id not found in request"})
+
+    hub = await _get_hub(hub_id)
+    prepare = None
+    if before_publish is not None:
+        prepare = lambda: before_publish(hub)
+    try:
+        sent, success = await send_proxy_command_async(
+            _ASYNC_REDIS_POOL,
+            hub.hub_id,
+            cmd,
+            account_id=hub.account_id,
+            priority=INTERACTIVE,
+            before_publish=prepare)
+    except RateLimited as e:
+        return hub, 0, rate_limited_response(e)
+    if not sent:
+        return hub, 0, JsonResponse({
+            'response': "in flight",
+            'coalesced': True
+        })
+
+    if not success:
+        err_msg = "Unable to send data to proxy server"
+        logging.error(err_msg)
+        return hub, 0, JsonResponse({'response': err_msg})
+
+    return hub, success, None
+
+
+async def ajax_diagnostics_rcv(request):
+    hub_id = request.GET.get('hub_id')
+    if not hub_id:
+        return JsonResponse({'response': None})
+
+    return JsonResponse({'response': await _get_ready_diagnostics(hub_id)})
+
+
+async def ajax_diagnostics_report(request):
+    """
+    asks hub for general diagnostics report and connection status
+    """
+    async def reset_flag(hub):
+        # the flag of the previous report is reset before the command
+        # goes out, a fast answer sets it again
+        await sync_to_async(hub.diagnostics_ready)(False)
+
+    hub, success, error = await _send_command(request.GET.get('hub_id'),
+                                              EDCommand.diagnostics,
+                                              before_publish=reset_flag)
+    if error:
+        return error
+
+    return JsonResponse({'response': str(success)})
+
+
+async def ajax_discover_nodes(request):
+    """
+    Do the actual discovering of nodes
+    """
+    _, success, error = await _send_command(request.GET.get('hub_id'),
+                                            EDCommand.discovery)
+    if error:
+        return error
+
+    return JsonResponse({'response': str(success)})
+
+
+async def ajax_check_for_nodes(request):
+    """
+    check for nodes and return
+    """
+    node_j = {'nodes': list()}
+    for address, node_id in await _list_nodes():
+        node_j['nodes'].append({
+            'address64': address_to_hex(address),
+            'node_id': node_id,
+            'remove_url': reverse('node_remove', args=[address_to_hex(address)]),
+        })
+    return JsonResponse(node_j)
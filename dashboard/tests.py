@@ -1,3 +1,64 @@
-from django.test import TestCase
+import threading
+import uuid
 
-# Create your tests here.
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase
+from edcomms import EDCommand
+
+from broker.models import ClientHubDevice, CommandDiagnosticsResponse, CommandResponseFlag
+from broker.ratelimit import RateLimited
+from dashboard import async_views
+from dashboard.views import rate_limited_response
+
+
+class RateLimitedResponseTests(SimpleTestCase):
+    def test_retry_after_is_rounded_up(self):
+        response = rate_limited_response(
+            RateLimited('hub', EDCommand.discovery, 0.3))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class AsyncViewTests(TransactionTestCase):
+    def test_reads_run_off_the_request_thread(self):
+        seen = dict()
+
+        @async_views._db_read
+        def read():
+            seen['read'] = threading.current_thread()
+
+        @sync_to_async
+        def request_thread():
+            seen['request'] = threading.current_thread()
+
+        async def view():
+            await request_thread()
+            await read()
+
+        async_to_sync(view)()
+        self.assertIsNot(seen['read'], seen['request'])
+
+    def test_ready_diagnostics(self):
+        hub = ClientHubDevice.objects.create(hub_id=uuid.uuid4(),
+                                             connect_passphrase='x')
+        CommandResponseFlag.objects.create(hub=hub, diagnostic_ready=True)
+        CommandDiagnosticsResponse.objects.create(hub=hub, report={'ok': 1})
+
+        report = async_to_sync(async_views._get_ready_diagnostics)(hub.hub_id)
+        self.assertEqual(report, {'ok': 1})
+
+    def test_rate_limited_command_answers_429(self):
+        hub = ClientHubDevice.objects.create(hub_id=uuid.uuid4(),
+                                             connect_passphrase='x')
+
+        async def refused(*args, **kwargs):
+            raise RateLimited('account', EDCommand.discovery, 2.5)
+
+        request = RequestFactory().get('/', {'hub_id': str(hub.hub_id)})
+        with mock.patch.object(async_views, 'send_proxy_command_async',
+                               refused):
+            response = async_to_sync(async_views.ajax_discover_nodes)(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '3')
@@ -1,6 +1,12 @@
+from django.conf import settings
 from django.urls import path
 from dashboard import views
 
+# ajax views are served by their asyncio versions under ASGI
+ajax_views = views
+if settings.ASYNC_VIEWS:
+    from dashboard import async_views as ajax_views
+
 urlpatterns = [
     path('', views.HubMainView.as_view(), name='hub_main_view'),
     path('connect/', views.HubMainView.as_view(), name='connect_new_hub'),
@@ -14,10 +20,20 @@ urlpatterns = [
 
 
      #### ajax views
-     path('discover', views.ajax_discover_nodes, name='ajax_discover_nodes'),
-     path('diag_report', views.ajax_diagnostics_report, name='ajax_diagnostics_report'),
-     path('diag_rcv', views.ajax_diagnostics_rcv, name='ajax_diagnostics_rcv'),
+     path('discover', ajax_views.ajax_discover_nodes, name='ajax_discover_nodes'),
+     path('diag_report', ajax_views.ajax_diagnostics_report, name='ajax_diagnostics_report'),
+     path('diag_rcv', ajax_views.ajax_diagnostics_rcv, name='ajax_diagnostics_rcv'),
      path('check_for_nodes/',
-          views.ajax_check_for_nodes,
+          ajax_views.ajax_check_for_nodes,
           name='ajax_check_for_nodes'),
+
+     path('search', views.search_fleet, name='search_fleet'),
+     path('summary', views.fleet_summary, name='fleet_summary'),
+     path('topology/<uuid:hub_id>',
+          views.hub_topology,
+          name='hub_topology'),
+
+     path('export/<str:dataset>',
+          views.export_fleet_data,
+          name='export_fleet_data'),
 ]
\ No newline at end of file
@@ -1,19 +1,27 @@
+import math
 import redis
 import logging
 
-from datetime import datetime
 from django.views.generic.base import RedirectView
 from dashboard.forms import NewHubConnectForm
-from django.http.response import HttpResponseRedirect, JsonResponse
+from django.contrib.auth.decorators import login_required
+from django.http import Http404
+from django.http.response import HttpResponse, HttpResponseForbidden, HttpResponseNotModified, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse_lazy, reverse
+from django.utils.decorators import method_decorator
 from django.views.generic import TemplateView, View
 
-from broker.models import ClientHubDevice, CommandDiagnosticsResponse, NodeModule
+from broker.models import ClientHubDevice, CommandDiagnosticsResponse, NodeModule, address_to_hex, address_to_int
 
 from edcomms import EDCommand
 from EagleDaddyCloud.settings import CONFIG
-from broker.utils import send_proxy_data
+from broker.lanes import INTERACTIVE
+from broker.ratelimit import RateLimited
+from broker.routers import replica_reads
+from broker.utils import send_proxy_command
+from broker.topology import cached_topology, invalidate_topology
+from broker import export, fleet, search
 
 _REDIS_POOL = redis.ConnectionPool(host=CONFIG.proxy.host,
                                    port=int(CONFIG.proxy.port),
@@ -47,6 +55,18 @@ _REDIS_POOL = redis.ConnectionPool(host=CONFIG.proxy.host,
 # Web App -> Redis -> MQTT Client -> DATABASE -> WebApp
 
 
+def rate_limited_response(error: RateLimited):
+    response = JsonResponse(
+        {
+            'response': "rate limited",
+            'scope': error.scope,
+            'retry_after': error.retry_after,
+        },
+        status=429)
+    response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
 def ajax_diagnostics_rcv(request):
     hub_id = request.GET.get('hub_id')
     if not hub_id:
@@ -57,15 +77,10 @@ def ajax_diagnostics_rcv(request):
     if not hub.diagnostics_ready():
         return JsonResponse({'response': None})
     
-    # it is now ready, turn it off
-    with open('test_ajax.output', 'w') as f:
-        print(f"is diagnostics flag set? : {hub.diagnostics_ready()}", file=f)
-        print(f"unsetting diagnostics flag @ {datetime.now()}",file=f)
-        hub.diagnostics_ready(False)
-
-        ## add code here to query
-        report = CommandDiagnosticsResponse.objects.filter(hub=hub).first()
-        print(f"queried report: {datetime.now()},{hub.diagnostics_ready()}", file=f)
+    # the flag stays set so every request coalesced into the same
+    # diagnostics command sees the report, it is reset when the next
+    # command is actually sent
+    report = CommandDiagnosticsResponse.objects.filter(hub=hub).first()
     return JsonResponse({'response': None if not report else report.report})
 
 def ajax_diagnostics_report(request):
@@ -78,13 +93,29 @@ def ajax_diagnostics_report(request):
         return JsonResponse({'response': "hub_id not found in request"})
 
     hub = ClientHubDevice.objects.filter(hub_id=hub_id).first()
-    cmd = {str(hub.hub_id): EDCommand.diagnostics}
-    success = send_proxy_data(_REDIS_POOL, cmd)
+
+    def reset_flag():
+        # the flag of the previous report is reset before the command
+        # goes out, a fast answer sets it again
+        hub.diagnostics_ready(False)
+
+    try:
+        sent, success = send_proxy_command(_REDIS_POOL,
+                                           hub.hub_id,
+                                           EDCommand.diagnostics,
+                                           account_id=hub.account_id,
+                                           priority=INTERACTIVE,
+                                           before_publish=reset_flag)
+    except RateLimited as e:
+        return rate_limited_response(e)
+    if not sent:
+        return JsonResponse({'response': "in flight", 'coalesced': True})
+
     if not success:
         err_msg = "Unable to send data to proxy server"
         logging.error(err_msg)
         return JsonResponse({'response': err_msg})
-    
+
     return JsonResponse({'response': str(success)})
 
 def ajax_discover_nodes(request):
@@ -97,11 +128,19 @@ def ajax_discover_nodes(request):
 
     hub = ClientHubDevice.objects.filter(hub_id=hub_id).first()
 
-    # with redis.Redis(connection_pool=_REDIS_POOL) as proxy:
-    # cmd to redis must be {hub_id: value of EDCommand}
-    cmd = {str(hub.hub_id): EDCommand.discovery.value}
-    #     proxy.publish(CONFIG.proxy.channel, json.dumps(cmd))
-    success = send_proxy_data(_REDIS_POOL, cmd)
+    # cmd to redis is {hub_id: value of EDCommand}, identical discoveries
+    # already in flight for this hub are joined instead of re-sent
+    try:
+        sent, success = send_proxy_command(_REDIS_POOL,
+                                           hub.hub_id,
+                                           EDCommand.discovery,
+                                           account_id=hub.account_id,
+                                           priority=INTERACTIVE)
+    except RateLimited as e:
+        return rate_limited_response(e)
+    if not sent:
+        return JsonResponse({'response': "in flight", 'coalesced': True})
+
     if not success:
         err_msg = "Unable to send data to proxy server."
         logging.error(err_msg)
@@ -118,20 +157,138 @@ def ajax_check_for_nodes(request):
 
     node_j = {'nodes': list()}
     for node in nodes:
-        url_path = reverse('node_remove', args=[str(node.address)])
-        logging.error(url_path)
+        url_path = reverse('node_remove', args=[node.address_hex])
         node_j['nodes'].append({
-            'address64': node.address,
+            'address64': node.address_hex,
             'node_id': node.node_id,
             'remove_url': str(url_path),
         })
     return JsonResponse(node_j)
 
+@replica_reads
+@login_required
+def export_fleet_data(request, dataset):
+    """
+    streams hubs/nodes/diagnostics of the users account,
+    ?format=csv|ndjson&gzip=1
+    """
+    account = getattr(request.user, 'account', None)
+    if not account:
+        return HttpResponseForbidden("No account linked to user")
+
+    fmt = request.GET.get('format', export.CSV)
+    compress = request.GET.get('gzip') in ('1', 'true')
+    if dataset not in export.DATASETS or fmt not in export.FORMATS:
+        return JsonResponse({'response': "unknown dataset or format"},
+                            status=400)
+
+    content_type = "application/gzip" if compress else export.CONTENT_TYPES[fmt]
+    response = StreamingHttpResponse(export.export(dataset,
+                                                   account,
+                                                   fmt=fmt,
+                                                   compress=compress),
+                                     content_type=content_type)
+    filename = export.export_filename(dataset, fmt, compress)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@replica_reads
+@login_required
+def search_fleet(request):
+    """
+    type-ahead search of the users hubs and nodes,
+    ?q=<term>&page=<n>&page_size=<n>
+    """
+    account = getattr(request.user, 'account', None)
+    if not account:
+        return HttpResponseForbidden("No account linked to user")
+
+    term = request.GET.get('q', '').strip()
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(search.MAX_PAGE_SIZE,
+                        max(1, int(request.GET.get('page_size',
+                                                   search.PAGE_SIZE))))
+    except ValueError:
+        return JsonResponse({'response': "invalid page"}, status=400)
+
+    results = {'query': term, 'page': page, 'hubs': [], 'nodes': []}
+    if len(term) < search.MIN_TERM_LENGTH:
+        results['has_next'] = False
+        return JsonResponse(results)
+
+    hubs, more_hubs = search.search_hubs(account, term, page, page_size)
+    nodes, more_nodes = search.search_nodes(account, term, page, page_size)
+    results['has_next'] = more_hubs or more_nodes
+    results['hubs'] = [{
+        'hub_id': str(hub['hub_id']),
+        'hub_name': hub['hub_name'],
+        'last_checkin': hub['last_checkin'],
+    } for hub in hubs]
+    results['nodes'] = [{
+        'node_id': node['node_id'],
+        'address64': address_to_hex(node['address']),
+        'hub_name': node['hub__hub_name'],
+        'hub_id': str(node['hub__hub_id']),
+    } for node in nodes]
+    return JsonResponse(results)
+
+
+@replica_reads
+@login_required
+def hub_topology(request, hub_id):
+    """
+    mesh graph of one of the users hubs, see broker.topology.
+    The ETag is the node set version, unchanged graphs answer 304.
+    """
+    account = getattr(request.user, 'account', None)
+    hub_pk = ClientHubDevice.objects.filter(
+        account=account, hub_id=hub_id).values_list('pk', flat=True).first()
+    if not account or hub_pk is None:
+        return JsonResponse({'response': "no such hub"}, status=404)
+
+    try:
+        with redis.Redis(connection_pool=_REDIS_POOL) as proxy:
+            version, graph = cached_topology(proxy, hub_pk)
+    except redis.RedisError as e:
+        logging.error(f"unable to read mesh topology: {e}")
+        return JsonResponse({'response': "topology unavailable"}, status=503)
+
+    etag = f'"{hub_pk}-{version}"'
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponseNotModified()
+    response = HttpResponse(graph, content_type="application/json")
+    response['ETag'] = etag
+    return response
+
+
+@replica_reads
+@login_required
+def fleet_summary(request):
+    """
+    hubs, hubs online, newest check-in and node counts of the users
+    account, see broker.fleet
+    """
+    account = getattr(request.user, 'account', None)
+    if not account:
+        return HttpResponseForbidden("No account linked to user")
+
+    try:
+        with redis.Redis(connection_pool=_REDIS_POOL) as proxy:
+            summary = fleet.fleet_summary(proxy, account.pk)
+    except redis.RedisError as e:
+        logging.error(f"unable to read fleet aggregates: {e}")
+        return JsonResponse({'response': "summary unavailable"}, status=503)
+    return JsonResponse(summary)
+
+
 class TestView(View):
     def get(self, request):
         return render(request, "hubs.html", {})
 
 
+@method_decorator(replica_reads, name='dispatch')
 class HubMainView(TemplateView):
     template_name = "hubs.html"
 
@@ -157,8 +314,14 @@ class HubMainView(TemplateView):
             print(hub)
             if hub:
                 account = request.user.account
+                previous = hub.account_id
                 hub.account = account
                 hub.save()
+                try:
+                    with redis.Redis(connection_pool=_REDIS_POOL) as proxy:
+                        fleet.invalidate(proxy, previous, account.pk)
+                except redis.RedisError as e:
+                    logging.error(f"unable to invalidate fleet aggregates: {e}")
         return HttpResponseRedirect(reverse_lazy('hub_main_view'))
 
 
@@ -166,12 +329,27 @@ class RemoveNode(RedirectView):
     pattern_name = "hub_main_view"
 
     def get(self, request, node_id, *args, **kwargs):
-        node = NodeModule.objects.filter(address=node_id).first()
+        try:
+            address = address_to_int(node_id)
+        except ValueError:
+            return HttpResponseRedirect(reverse_lazy(self.pattern_name))
+
+        node = NodeModule.objects.filter(address=address).first()
         if not node:
             return
         node.delete()
+        hub = ClientHubDevice.objects.filter(pk=node.hub_id).values_list(
+            'account_id', 'hub_id').first()
+        try:
+            with redis.Redis(connection_pool=_REDIS_POOL) as proxy:
+                invalidate_topology(proxy, node.hub_id)
+                if hub:
+                    fleet.add_nodes(proxy, *hub, -1)
+        except redis.RedisError as e:
+            logging.error(f"unable to invalidate mesh topology: {e}")
         return super().get(request, *args, **kwargs)
 
+@method_decorator(replica_reads, name='dispatch')
 class HubInfoView(TemplateView):
     template_name = "dashboard_base.html"
 
@@ -194,9 +372,16 @@ class NodeInfoView(HubInfoView):
     template_name = "hub_info.html"
 
     def get(self, request, hub_name, node_address):
-        hubs = self.get_user_hubs(request)
+        try:
+            address = address_to_int(node_address)
+        except ValueError:
+            raise Http404("invalid node address")
         node = NodeModule.objects.filter(
-            address=node_address).first()  # will be unique
+            address=address).select_related('hub').first()  # will be unique
+        if not node:
+            raise Http404("no such node")
+
+        hubs = self.get_user_hubs(request)
         selected_hub = node.hub
 
         context = {
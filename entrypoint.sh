@@ -10,7 +10,10 @@ if [ "$DATABASE" = "postgresdb" ]; then
 
     echo "PostgreSQL started..."
 fi
-python manage.py makemigrations
+if [ "$DJANGO_ENV" = "production" ]; then
+    exec ./bin/serve.sh
+fi
+
 python manage.py migrate
 
 echo "Running tests..."
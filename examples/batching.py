@@ -0,0 +1,87 @@
+"""
+Batching of outbound hub messages.
+
+Each published packet costs a full MQTT publish (and with qos 2 four
+packets on the wire) plus a callback dispatch in the cloud. Hubs that
+send many small messages can instead collect them for up to `linger`
+seconds, or until `max_packets`/`max_bytes` is reached, and publish
+them as one envelope on /<root>/<hub_id>/batch:
+
+    EDPacket(payload=[(topic, pickled packet), ...])
+
+The manager unpacks the envelope and handles every packet as if it had
+arrived on its own topic, in order.
+"""
+
+import logging
+import threading
+import time
+from typing import List, Tuple
+
+
+class PacketBatcher(threading.Thread):
+    """
+    `publish_fn(items)` is called with the collected
+    (topic, encoded packet) pairs of each batch.
+    """
+    def __init__(self,
+                 publish_fn,
+                 linger=0.2,
+                 max_packets=50,
+                 max_bytes=64 * 1024):
+        super().__init__(daemon=True, name="packet-batcher")
+        self.publish_fn = publish_fn
+        self.linger = linger
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+
+        self._items: List[Tuple[str, bytes]] = list()
+        self._bytes = 0
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def add(self, topic: str, encoded: bytes):
+        with self._cond:
+            if self._items and self._bytes + len(encoded) > self.max_bytes:
+                self._flush_locked()
+
+            self._items.append((topic, encoded))
+            self._bytes += len(encoded)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+
+            if len(self._items) >= self.max_packets \
+                    or self._bytes >= self.max_bytes:
+                self._flush_locked()
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._flush_locked()
+            self._cond.notify()
+
+    def run(self):
+        with self._cond:
+            while not self._stopped:
+                if self._first_at is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = self._first_at + self.linger - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._items:
+            return
+        items, self._items = self._items, list()
+        self._bytes = 0
+        self._first_at = None
+        try:
+            self.publish_fn(items)
+        except Exception as e:
+            logging.error(f"failed to publish batch of {len(items)}: {e}")
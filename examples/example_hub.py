@@ -28,17 +28,38 @@ Channel dedicated to listening from devices is
 
 import json
 import logging
+import pickle
 import uuid
 import time
+import paho.mqtt.client as mqtt
 from pathlib import Path
 from passphrase import Passphrase
-from edcomms import EDChannel, EDClient, EDPacket, EDCommand, MessageCallback
+from edcomms import EDChannel, EDClient, EDPacket, EDCommand, MessageCallback, MessageInfo
+from outbox import Outbox, OutboxReplayer, EVICT_OLDEST
+from batching import PacketBatcher
 
 logging.basicConfig(level=logging.DEBUG, filename="hub.log")
 
 _BROKER_HOST = "ed.qubixat.com"
 _BROKER_PORT = 1883
 
+# store-and-forward settings used while the broker is unreachable
+_OUTBOX_PATH = Path(__file__).parent / "outbox.sqlite3"
+_OUTBOX_MAX_MESSAGES = 10000
+_OUTBOX_MAX_BYTES = 16 * 1024 * 1024
+_OUTBOX_EVICTION = EVICT_OLDEST
+_REPLAY_BATCH_SIZE = 50
+_REPLAY_BATCH_INTERVAL = 1.0  # seconds between replayed batches
+
+# cap on paho's own in-memory queue, anything beyond goes to the outbox
+_MAX_QUEUED_MESSAGES = 100
+
+# responses and telemetry are sent in batches when `batch_linger` > 0,
+# these defaults can be overridden per hub in device.info
+_BATCH_LINGER = 0.0  # seconds a packet may wait for others, 0 disables
+_BATCH_MAX_PACKETS = 50
+_BATCH_MAX_BYTES = 64 * 1024
+
 DUMMY_NODE_1 = {
     'id': 1,
     'address64': b'\x00\x13\xa2\x00A\xbd*z',
@@ -121,7 +142,7 @@ class HubMessageCallback(MessageCallback):
             packet = self.handle_unknown()
 
         channel = self.client.talking_channel
-        self.client.publish(channel, packet)
+        self.client.send(channel, packet)
 
     def handle_discovery(self):
         global DUMMY_NODE_1, DUMMY_NODE_2, DUMMY_NODE_3
@@ -148,10 +169,45 @@ class HubClient(EDClient):
     announce_channel = EDChannel('announce/')
     listening_channel = None
     talking_channel = None
+    telemetry_channel = None
+    batch_channel = None
     _device_info = None
 
+    outbox = None
+    replayer = None
+    batcher = None
+
     def init(self):
-        super().init()
+        self.telemetry_channel = EDChannel(f"{self.client_id}/telemetry")
+        self.batch_channel = EDChannel(f"{self.client_id}/batch")
+        self.outbox = Outbox(_OUTBOX_PATH,
+                             max_messages=_OUTBOX_MAX_MESSAGES,
+                             max_bytes=_OUTBOX_MAX_BYTES,
+                             eviction=_OUTBOX_EVICTION)
+        self.replayer = OutboxReplayer(self.outbox,
+                                       self._publish_raw,
+                                       self.is_connected,
+                                       batch_size=_REPLAY_BATCH_SIZE,
+                                       interval=_REPLAY_BATCH_INTERVAL)
+        self.replayer.start()
+        self.max_queued_messages_set(_MAX_QUEUED_MESSAGES)
+
+        info = self._device_info or dict()
+        linger = float(info.get('batch_linger', _BATCH_LINGER))
+        if linger > 0:
+            self.batcher = PacketBatcher(
+                self._publish_batch,
+                linger=linger,
+                max_packets=int(
+                    info.get('batch_max_packets', _BATCH_MAX_PACKETS)),
+                max_bytes=int(info.get('batch_max_bytes', _BATCH_MAX_BYTES)))
+            self.batcher.start()
+
+        # connected by the network loop (`loop_start`), which retries
+        # until the broker is reachable, a hub booting while the
+        # broker is down buffers to the outbox in the meantime
+        self.connect_async(host=self.host, port=self.port)
+        logging.debug(f"Connecting to broker {self.host}:{self.port}")
         self.talking_channel = EDChannel(f"{self.client_id}")
 
         self.listening_channel = EDChannel(f"{self.client_id}/cloud")
@@ -166,6 +222,70 @@ class HubClient(EDClient):
         while True:
             pass
 
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != mqtt.CONNACK_ACCEPTED:
+            logging.error(f"connection refused: {mqtt.connack_string(rc)}")
+            return
+
+        # subscriptions made before the first connection never reached
+        # the broker, renewed on every connect
+        if self._root_subscription:
+            self.subscribe(self._root_subscription, qos=self._QOS)
+
+        if len(self.outbox):
+            logging.info(
+                f"connected, replaying {len(self.outbox)} buffered messages")
+            self.replayer.wake()
+
+    def publish(self, channel: EDChannel, packet: EDPacket):
+        """
+        Publishes packet if connected, otherwise (or while older messages
+        are still waiting to be replayed) it is buffered to the outbox
+        so ordering is kept.
+        """
+        encoded = pickle.dumps(packet)
+        topic = channel.channel
+        if not len(self.outbox) and self.is_connected():
+            info = mqtt.Client.publish(self,
+                                       topic=topic,
+                                       payload=encoded,
+                                       qos=self._QOS)
+            if info.rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+                return MessageInfo(info)
+
+        logging.debug(f"broker unavailable, buffering message for {topic}")
+        self.outbox.put(topic, encoded, self._QOS)
+        self.replayer.wake()
+        return None
+
+    def send(self, channel: EDChannel, packet: EDPacket):
+        """
+        Publishes `packet`, through the batcher when batching is enabled
+        """
+        if self.batcher is None:
+            return self.publish(channel, packet)
+        self.batcher.add(channel.channel, pickle.dumps(packet))
+
+    def _publish_batch(self, items):
+        envelope = self.create_packet(EDCommand.ack, payload=items)
+        self.publish(self.batch_channel, envelope)
+
+    def _publish_raw(self, topic: str, payload: bytes, qos: int) -> bool:
+        info = mqtt.Client.publish(self, topic=topic, payload=payload, qos=qos)
+
+        # qos > 0 messages that miss the connection are still held by
+        # paho and resent on reconnect, so they count as handed over
+        return info.rc == mqtt.MQTT_ERR_SUCCESS or \
+            (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN)
+
+    def publish_telemetry(self, readings):
+        """
+        readings: list of {'address64', 'kind', 'value', 'ts'} dicts
+        """
+        # telemetry is routed by its channel, the command is not inspected
+        packet = self.create_packet(EDCommand.ack, payload=readings)
+        return self.send(self.telemetry_channel, packet)
+
     def announce(self):
         device_info = self._device_info
         announce_packet = self.create_packet(EDCommand.announce,
@@ -188,4 +308,8 @@ if __name__ == "__main__":
     try:
         hub.run()
     except KeyboardInterrupt:
+        if hub.batcher is not None:
+            hub.batcher.stop()
+        hub.replayer.stop()
         hub.loop_stop()
+        hub.outbox.close()
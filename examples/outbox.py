@@ -0,0 +1,223 @@
+"""
+Disk backed store-and-forward outbox for hub devices.
+
+Hubs often sit on flaky rural links. When the broker is unreachable
+anything published is either lost or piles up, without bound, in paho's
+in-memory queue. The outbox keeps those messages in a small SQLite
+database (WAL journal) instead, capped in both message count and bytes,
+and replays them in rate-limited batches once the connection comes back.
+
+Layout of the outbox table:
+
+    seq     - monotonically increasing sequence, replay order
+    topic   - fully qualified mqtt topic, ie: /eagledaddy/<hub_id>
+    payload - raw encoded bytes exactly as they would have been published
+    qos     - qos level to publish with
+    created - unix timestamp the message was buffered
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+EVICT_OLDEST = "oldest"
+EVICT_NEWEST = "newest"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    qos INTEGER NOT NULL,
+    created REAL NOT NULL
+)
+"""
+
+
+class Outbox:
+    """
+    Bounded, persistent FIFO of outbound mqtt messages.
+
+    Args:
+        path (Path): location of the sqlite database file.
+        max_messages (int): maximum number of buffered messages.
+        max_bytes (int): maximum total size of buffered payloads.
+        eviction (str): `EVICT_OLDEST` drops the oldest buffered messages
+            to make room, `EVICT_NEWEST` refuses the incoming message.
+    """
+    def __init__(self,
+                 path: Path,
+                 max_messages=10000,
+                 max_bytes=16 * 1024 * 1024,
+                 eviction=EVICT_OLDEST):
+        if eviction not in (EVICT_OLDEST, EVICT_NEWEST):
+            raise ValueError(f"unknown eviction policy: {eviction}")
+
+        self.path = Path(path)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+        self._count, self._bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM outbox"
+        ).fetchone()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def put(self, topic: str, payload: bytes, qos: int) -> bool:
+        """
+        Buffer a message. Returns False if the message was dropped
+        because of the size cap.
+        """
+        size = len(payload)
+        if size > self.max_bytes:
+            logging.error(
+                f"message of {size} bytes exceeds outbox cap, dropping")
+            self.evicted += 1
+            return False
+
+        with self._lock:
+            if not self._make_room(size):
+                self.evicted += 1
+                logging.warning("outbox full, dropping newest message")
+                return False
+
+            self._db.execute(
+                "INSERT INTO outbox (topic, payload, qos, created) VALUES (?, ?, ?, ?)",
+                (topic, sqlite3.Binary(payload), qos, time.time()))
+            self._db.commit()
+            self._count += 1
+            self._bytes += size
+        return True
+
+    def peek(self, n: int) -> List[Tuple[int, str, bytes, int]]:
+        """Return up to `n` of the oldest messages without removing them."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, topic, payload, qos FROM outbox ORDER BY seq LIMIT ?",
+                (n, )).fetchall()
+        return [(seq, topic, bytes(payload), qos)
+                for seq, topic, payload, qos in rows]
+
+    def ack(self, last_seq: int):
+        """Remove every message up to and including `last_seq`."""
+        with self._lock:
+            removed, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM outbox WHERE seq <= ?",
+                (last_seq, )).fetchone()
+            self._db.execute("DELETE FROM outbox WHERE seq <= ?",
+                             (last_seq, ))
+            self._db.commit()
+            self._count -= removed
+            self._bytes -= size
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _make_room(self, size: int) -> bool:
+        overflow = self._count + 1 > self.max_messages or \
+            self._bytes + size > self.max_bytes
+        if not overflow:
+            return True
+
+        if self.eviction == EVICT_NEWEST:
+            return False
+
+        # drop the oldest messages in one statement until both caps fit
+        while self._count and (self._count + 1 > self.max_messages
+                               or self._bytes + size > self.max_bytes):
+            excess = max(1, self._count + 1 - self.max_messages)
+            removed, freed, last = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0), MAX(seq) FROM "
+                "(SELECT seq, payload FROM outbox ORDER BY seq LIMIT ?)",
+                (excess, )).fetchone()
+            self._db.execute("DELETE FROM outbox WHERE seq <= ?", (last, ))
+            self._count -= removed
+            self._bytes -= freed
+            self.evicted += removed
+            logging.warning(f"outbox full, evicted {removed} oldest messages")
+        return True
+
+
+class OutboxReplayer(threading.Thread):
+    """
+    Drains an `Outbox` through `publish_fn` in batches, pausing
+    `interval` seconds between batches so a reconnecting hub
+    does not flood the cloud with its whole backlog at once.
+
+    `publish_fn(topic, payload, qos)` must return True when the
+    message was handed to the broker connection.
+    `is_connected()` is checked before every batch, replay stops
+    as soon as the connection drops again or a message is refused
+    (ie: paho's queue is full). While messages are left it is retried
+    every `interval` seconds, or sooner on a call to `wake`.
+    """
+    def __init__(self,
+                 outbox: Outbox,
+                 publish_fn,
+                 is_connected,
+                 batch_size=50,
+                 interval=1.0):
+        super().__init__(daemon=True, name="outbox-replayer")
+        self.outbox = outbox
+        self.publish_fn = publish_fn
+        self.is_connected = is_connected
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            # a quiet hub never wakes the replayer, poll while
+            # there is a backlog so it is drained regardless
+            self._wakeup.wait(self.interval if len(self.outbox) else None)
+            self._wakeup.clear()
+
+            while len(self.outbox) and self.is_connected() \
+                    and not self._stopped.is_set():
+                sent = self.replay_batch()
+                logging.info(
+                    f"replayed {sent} buffered messages, {len(self.outbox)} remaining"
+                )
+                if not sent:
+                    break
+                self._stopped.wait(self.interval)
+
+    def replay_batch(self) -> int:
+        batch = self.outbox.peek(self.batch_size)
+        last_sent = None
+        for seq, topic, payload, qos in batch:
+            if not self.publish_fn(topic, payload, qos):
+                break
+            last_sent = seq
+
+        if last_sent is None:
+            return 0
+
+        self.outbox.ack(last_sent)
+        return sum(1 for seq, *_ in batch if seq <= last_sent)
@@ -0,0 +1,46 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from examples.batching import PacketBatcher
+
+
+class PacketBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = list()
+        self.flushed = threading.Event()
+
+    def publish(self, items):
+        self.batches.append([topic for topic, _ in items])
+        self.flushed.set()
+
+    def batcher(self, **kwargs):
+        batcher = PacketBatcher(self.publish, **kwargs)
+        batcher.start()
+        self.addCleanup(batcher.stop)
+        return batcher
+
+    def test_flushes_at_max_packets(self):
+        batcher = self.batcher(linger=60, max_packets=2)
+        for topic in 'abc':
+            batcher.add(topic, b'x')
+        self.assertEqual(self.batches, [['a', 'b']])
+
+    def test_flushes_before_exceeding_max_bytes(self):
+        batcher = self.batcher(linger=60, max_bytes=10)
+        batcher.add('a', b'x' * 6)
+        batcher.add('b', b'x' * 6)
+        self.assertEqual(self.batches, [['a']])
+
+    def test_flushes_after_linger(self):
+        batcher = self.batcher(linger=0.05)
+        batcher.add('a', b'x')
+        batcher.add('b', b'x')
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.batches, [['a', 'b']])
+
+    def test_stop_flushes(self):
+        batcher = self.batcher(linger=60)
+        batcher.add('a', b'x')
+        batcher.stop()
+        self.assertEqual(self.batches, [['a']])
@@ -0,0 +1,87 @@
+import tempfile
+import threading
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+from examples.outbox import EVICT_NEWEST, Outbox, OutboxReplayer
+
+
+class OutboxTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'outbox.sqlite3'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def outbox(self, **kwargs):
+        outbox = Outbox(self.path, **kwargs)
+        self.addCleanup(outbox.close)
+        return outbox
+
+    def fill(self, outbox, n, size=1):
+        for i in range(n):
+            outbox.put(f"t/{i}", bytes([i]) * size, 1)
+
+    def topics(self, outbox):
+        return [topic for _, topic, _, _ in outbox.peek(100)]
+
+    def test_evict_oldest_keeps_newest_in_order(self):
+        outbox = self.outbox(max_messages=3)
+        self.fill(outbox, 5)
+        self.assertEqual(self.topics(outbox), ['t/2', 't/3', 't/4'])
+        self.assertEqual(outbox.evicted, 2)
+
+    def test_evict_newest_refuses_incoming(self):
+        outbox = self.outbox(max_messages=3,
+                             eviction=EVICT_NEWEST)
+        self.fill(outbox, 5)
+        self.assertEqual(self.topics(outbox), ['t/0', 't/1', 't/2'])
+        self.assertEqual(outbox.evicted, 2)
+
+    def test_byte_cap(self):
+        outbox = self.outbox(max_bytes=25)
+        self.fill(outbox, 4, size=10)
+        self.assertEqual(self.topics(outbox), ['t/2', 't/3'])
+        self.assertEqual(outbox.size_bytes, 20)
+        self.assertFalse(outbox.put('t/big', b'x' * 26, 1))
+
+    def test_survives_reopening(self):
+        outbox = self.outbox()
+        self.fill(outbox, 3, size=2)
+        outbox.close()
+        outbox = self.outbox()
+        self.assertEqual((len(outbox), outbox.size_bytes), (3, 6))
+        self.assertEqual(self.topics(outbox), ['t/0', 't/1', 't/2'])
+
+    def test_replay_in_order_resuming_after_refusal(self):
+        outbox = self.outbox()
+        self.fill(outbox, 7)
+        sent, refuse = list(), {'t/4'}
+        drained = threading.Event()
+
+        def publish(topic, payload, qos):
+            if topic in refuse:
+                refuse.discard(topic)  # ie: paho's queue was full once
+                return False
+            sent.append(topic)
+            if len(sent) == 7:
+                drained.set()
+            return True
+
+        replayer = OutboxReplayer(outbox,
+                                  publish,
+                                  lambda: True,
+                                  batch_size=3,
+                                  interval=0.01)
+        replayer.start()
+        self.addCleanup(replayer.stop)
+        replayer.wake()
+
+        # no further wake, the refused message is retried on the interval
+        self.assertTrue(drained.wait(5))
+        replayer.stop()
+        replayer.join(5)
+        self.assertEqual(sent, [f"t/{i}" for i in range(7)])
+        self.assertEqual(len(outbox), 0)